@@ -0,0 +1 @@
+"""Benchmark suite for JSONPyth. Run with ``python -m benchmarks``."""
@@ -0,0 +1,220 @@
+"""Runs the JSONPyth benchmark suite and writes the timings as JSON.
+
+Usage::
+
+    python -m benchmarks [--sizes 1KB,100KB,10MB] [--shapes deep,wide] [--output results.json]
+    python -m benchmarks --decoders available
+    python -m benchmarks --compare before.json after.json
+
+Parsing and evaluation are timed separately for each case. With ``--decoders``, decoding the
+document from JSON and evaluating it are also timed together, for each of the given decoders.
+Each timing is the best of several repeats, to reduce the effect of noise from the rest of the
+system. Results from two runs, such as from before and after a commit, can be compared with
+``--compare``.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonpyth
+from benchmarks.cases import CASES
+from benchmarks.documents import SHAPES
+
+
+DEFAULT_SIZES = "1KB,100KB,10MB"
+DEFAULT_REPEAT = 5
+
+# the minimum total duration to time a batch of parses over, for stable timings
+MIN_PARSE_TIME = 0.2
+
+_UNITS = { "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3 }
+
+
+def parse_size(text):
+    """Converts a size such as ``100KB`` or ``1GB`` into a number of bytes"""
+    text = text.strip().upper()
+    for unit in sorted(_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * _UNITS[unit])
+    return int(text)
+
+
+def time_parse(expr, repeat):
+    # parse() bypasses the compiled query cache, so every call parses the expression
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            jsonpyth.parse(expr)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_PARSE_TIME:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            jsonpyth.parse(expr)
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def time_evaluate(data, steps, repeat):
+    times = []
+    matches = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matches = len(jsonpyth.evaluate(data, steps))
+        times.append(time.perf_counter() - start)
+    return times, matches
+
+
+def time_decode_evaluate(document, steps, decoder, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        jsonpyth.evaluate(document, steps, decoder=decoder)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarise(times):
+    times = sorted(times)
+    return { "min": times[0], "median": times[len(times)//2], "runs": len(times) }
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def run(sizes, shapes, repeat, log, decoders=()):
+    results = []
+    for shape in shapes:
+        for case_type, expr in CASES[shape]:
+            timing = summarise(time_parse(expr, repeat))
+            log('parse     {:<8} {:<12} {:>12.1f}us  {}'.format(
+                shape, case_type, timing['min'] * 1e6, expr))
+            results.append(dict(timing, phase="parse", shape=shape, size=None,
+                                node_class=case_type, expr=expr))
+        for size in sizes:
+            data = SHAPES[shape](size)
+            actual_size = len(json.dumps(data))
+            for case_type, expr in CASES[shape]:
+                # evaluate the optimised steps, as compiled queries do
+                steps = jsonpyth.optimise(jsonpyth.parse(expr))
+                times, matches = time_evaluate(data, steps, repeat)
+                timing = summarise(times)
+                log('evaluate  {:<8} {:<12} {:>12.1f}us  {} ({} bytes, {} matches)'.format(
+                    shape, case_type, timing['min'] * 1e6, expr, actual_size, matches))
+                results.append(dict(timing, phase="evaluate", shape=shape, size=actual_size,
+                                    node_class=case_type, expr=expr, matches=matches))
+            if decoders:
+                document = json.dumps(data).encode('utf-8')
+            del data
+            for decoder in decoders:
+                for case_type, expr in CASES[shape]:
+                    steps = jsonpyth.optimise(jsonpyth.parse(expr))
+                    timing = summarise(time_decode_evaluate(document, steps, decoder, repeat))
+                    log('decode    {:<8} {:<12} {:>12.1f}us  {} ({} bytes, {})'.format(
+                        shape, case_type, timing['min'] * 1e6, expr, actual_size, decoder))
+                    results.append(dict(timing, phase="decode", shape=shape, size=actual_size,
+                                        node_class=case_type, expr=expr, decoder=decoder))
+            document = None
+    return results
+
+
+def result_key(result):
+    return (result['phase'], result['shape'], result['node_class'], result['expr'],
+            result['size'], result.get('decoder'))
+
+
+def compare(before, after, out):
+    """Prints the ratio of each timing in ``after`` to the same timing in ``before``"""
+    previous = { result_key(r): r for r in before['results'] }
+    out.write('{:<9} {:<8} {:<12} {:>12} {:>12} {:>12} {:>8}  {}\n'.format(
+        'phase', 'shape', 'class', 'size', 'before(us)', 'after(us)', 'ratio', 'decoder'))
+    for result in after['results']:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        out.write('{:<9} {:<8} {:<12} {:>12} {:>12.1f} {:>12.1f} {:>7.2f}x  {}\n'.format(
+            result['phase'], result['shape'], result['node_class'], result['size'] or '-',
+            old['min'] * 1e6, result['min'] * 1e6, result['min'] / old['min'], 
+            result.get('decoder') or ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma-separated approximate document sizes, e.g. 1KB,10MB,1GB '
+                             '(default: {})'.format(DEFAULT_SIZES))
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help='comma-separated document shapes (default: all of {})'.format(
+                            ','.join(SHAPES)))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of times to repeat each timing (default: {})'.format(
+                            DEFAULT_REPEAT))
+    parser.add_argument('--decoders', default='',
+                        help='comma-separated JSON decoders to time decoding and evaluating '
+                             'with, e.g. orjson,json, or "available" for all those installed '
+                             '(default: none)')
+    parser.add_argument('--output', '-o', default='-',
+                        help='file to write the JSON results to (default: standard output)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two results files instead of running the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f1, open(args.compare[1]) as f2:
+            compare(json.load(f1), json.load(f2), sys.stdout)
+        return
+
+    shapes = [s.strip() for s in args.shapes.split(',')]
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error('unknown shape: {}'.format(shape))
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    if args.decoders == 'available':
+        decoders = jsonpyth.available_decoders()
+    else:
+        decoders = [d.strip() for d in args.decoders.split(',') if d.strip()]
+        available = jsonpyth.available_decoders()
+        for decoder in decoders:
+            if decoder not in available:
+                parser.error('decoder not available: {}'.format(decoder))
+
+    log = lambda message: print(message, file=sys.stderr, flush=True)
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "repeat": args.repeat,
+            "decoders": decoders,
+        },
+        "results": run(sizes, shapes, args.repeat, log, decoders),
+    }
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
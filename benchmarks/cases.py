@@ -0,0 +1,41 @@
+"""The expressions benchmarked against each document shape, grouped by the node class they
+exercise.
+
+Each case is a 2-tuple of the node class name and a JSONPath expression. Every node class is
+covered for every shape, although some expressions necessarily exercise more than one class.
+"""
+
+CASES = {
+    "deep": [
+        ("PProperty", "$.records[*].child.child.child.name"),
+        ("PSlice", "$.records[1:-1:2].tags[0]"),
+        ("PWildcard", "$.records[*].child.*"),
+        ("PRecursive", "$..name"),
+        ("PExpression", '$.records[*].child[("value")]'),
+        ("PFilter", '$.records[?(@["value"] > 500)].id'),
+    ],
+    "wide": [
+        ("PProperty", "$.records.r0000000.name"),
+        ("PSlice", "$.records.*.tags[1:]"),
+        ("PWildcard", "$.records.*.id"),
+        ("PRecursive", "$..tags"),
+        ("PExpression", '$.records[("r0000001")].value'),
+        ("PFilter", '$.records[?(@["active"])].id'),
+    ],
+    "sparse": [
+        ("PProperty", "$.records[*].outer.inner.meta.target.score"),
+        ("PSlice", "$.records[::100].outer.inner.meta"),
+        ("PWildcard", "$.records[*].*.*.meta.id"),
+        ("PRecursive", "$..target"),
+        ("PExpression", r'$.records[(len\(@\)-1)].outer'),
+        ("PFilter", '$.records[*].outer.inner[?("target" in @)].target'),
+    ],
+    "arrays": [
+        ("PProperty", "$.records[*].name"),
+        ("PSlice", "$.records[*].samples[10:20]"),
+        ("PWildcard", "$.records[*].samples[*]"),
+        ("PRecursive", "$..id"),
+        ("PExpression", r'$.records[*].samples[(len\(@\)-1)]'),
+        ("PFilter", '$.records[*].samples[?(@ > 99)]'),
+    ],
+}
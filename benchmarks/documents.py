@@ -0,0 +1,95 @@
+"""Generators for benchmark documents of different shapes and approximate sizes.
+
+Each generator builds a structure of basic types, as returned by the `json` module, which
+serialises to roughly the requested number of bytes. The same seed always produces the same
+document.
+"""
+
+import json
+import random
+
+
+def _record(rng, i):
+    return {
+        "id": i,
+        "name": "item {}".format(i),
+        "value": round(rng.random() * 1000, 2),
+        "active": rng.random() < 0.5,
+        "tags": [rng.choice(["red", "green", "blue", "amber"]) for _ in range(3)],
+    }
+
+
+def _repeat(size, unit):
+    """Returns the number of units needed to make a document of the given size"""
+    return max(1, size // max(1, len(json.dumps(unit))))
+
+
+def deep(size, seed=0):
+    """Chains of records nested 40 levels deep, under a ``records`` array
+
+    :param size: The approximate size of the document when serialised, in bytes
+    :type size: int
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    def chain(i, depth):
+        node = _record(rng, i)
+        if depth > 1:
+            node["child"] = chain(i, depth-1)
+        return node
+    count = _repeat(size, chain(0, 40))
+    return {"records": [chain(i, 40) for i in range(count)]}
+
+
+def wide(size, seed=0):
+    """A single object with a large number of record properties, under ``records``
+
+    :param size: The approximate size of the document when serialised, in bytes
+    :type size: int
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    count = _repeat(size, {"r0000000": _record(rng, 0)})
+    return {"records": { "r{:07d}".format(i): _record(rng, i) for i in range(count) }}
+
+
+def sparse(size, seed=0):
+    """An array of records, only one in a hundred of which has a ``target`` property buried
+    a few levels down
+
+    :param size: The approximate size of the document when serialised, in bytes
+    :type size: int
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    def entry(i):
+        inner = {"meta": _record(rng, i), "padding": "x" * 40}
+        if i % 100 == 0:
+            inner["meta"]["target"] = {"id": i, "score": rng.random()}
+        return {"outer": {"inner": inner}}
+    count = _repeat(size, entry(1))
+    return {"records": [entry(i) for i in range(count)]}
+
+
+def arrays(size, seed=0):
+    """Records holding long arrays of numbers, under a ``records`` array
+
+    :param size: The approximate size of the document when serialised, in bytes
+    :type size: int
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    def entry(i):
+        record = _record(rng, i)
+        record["samples"] = [round(rng.random() * 100, 3) for _ in range(200)]
+        return record
+    count = _repeat(size, entry(0))
+    return {"records": [entry(i) for i in range(count)]}
+
+
+SHAPES = {
+    "deep": deep,
+    "wide": wide,
+    "sparse": sparse,
+    "arrays": arrays,
+}
@@ -1,6 +1,18 @@
 import re
+import os
+import collections
+import collections.abc
 import logging
-import pyparsing as pp
+import functools
+import bisect
+import time
+import operator
+import itertools
+import builtins
+import codecs
+import json
+import sys
+import threading
 
 
 class ParseError(Exception):
@@ -26,6 +38,251 @@ class JsonPathSyntaxError(ParseError):
         return 'JSONPath syntax error - ' + super().__str__()
 
 
+class _Node:
+    """A node of the queried data structure, linked to the node it was reached from.
+
+    The normalised path of a node is only built, by following its parent links, when it is
+    asked for.
+    """
+
+    __slots__ = ('value', 'parent', 'key')
+
+    def __init__(self, value, parent=None, key=None):
+        self.value = value
+        self.parent = parent
+        self.key = key
+
+    @property
+    def path(self):
+        keys = []
+        node = self
+        while node.parent is not None:
+            keys.append(node.key)
+            node = node.parent
+        parts = ['$']
+        for key in reversed(keys):
+            if isinstance(key, str):
+                parts.append('["{}"]'.format(key.replace('\\','\\\\').replace('"','\\"')))
+            else:
+                parts.append('[{}]'.format(key))
+        return ''.join(parts)
+
+
+class StepStats:
+    """Counts of the nodes which a single step of a path passed over during evaluation
+
+    :ivar step: The step the counts are for
+    :ivar skipped: Nodes of the wrong type for the step, e.g. a property of a list
+    :ivar missing: Nodes without the requested property or index
+    :ivar script_evaluations: Nodes for which a script expression or filter was evaluated 
+        individually
+    :ivar script_errors: Nodes for which a Python script expression or filter raised an error
+    """
+
+    __slots__ = ('step', 'skipped', 'missing', 'script_evaluations', 'script_errors')
+
+    FIELDS = ('skipped', 'missing', 'script_evaluations', 'script_errors')
+
+    def __init__(self, step):
+        self.step = step
+        self.skipped = 0
+        self.missing = 0
+        self.script_evaluations = 0
+        self.script_errors = 0
+
+    def as_dict(self):
+        result = { 'step': repr(self.step) }
+        result.update((name, getattr(self, name)) for name in self.FIELDS)
+        return result
+
+
+class Diagnostics:
+    """An opt-in collector of counts of the nodes which evaluation silently passed over.
+
+    Pass an instance as the `diagnostics` parameter of `evaluate`, `jsonpath` etc. Counts are
+    kept for each step of the path by position and accumulate over successive evaluations, so
+    one collector can be used for many evaluations of the same query. Collecting diagnostics 
+    does not require debug logging to be enabled.
+
+    :ivar steps: List of `StepStats`, one for each step of the path
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    STATS_TYPE = StepStats
+
+    def stats_for(self, index, step):
+        while len(self.steps) <= index:
+            self.steps.append(None)
+        if self.steps[index] is None:
+            self.steps[index] = self.STATS_TYPE(step)
+        return self.steps[index]
+
+    def as_dict(self):
+        """Returns the counts as a list of dicts, one for each step, for serialising"""
+        return [ stats.as_dict() for stats in self.steps if stats is not None ]
+
+    def __str__(self):
+        return '\n'.join('step {}: {}'.format(i, ', '.join('{}={}'.format(k,v) for k,v in d.items()))
+                         for i,d in enumerate(self.as_dict()))
+
+
+class StepProfile(StepStats):
+    """Counts and timings for a single step of a path, collected by a `Profile`
+
+    :ivar nodes_in: Nodes consumed from the previous step
+    :ivar nodes_out: Nodes produced for the next step
+    :ivar time: Seconds spent evaluating the step, not including the time spent by earlier 
+        steps producing its input
+    """
+
+    __slots__ = ('nodes_in', 'nodes_out', 'time')
+
+    FIELDS = ('nodes_in', 'nodes_out', 'time') + StepStats.FIELDS
+
+    def __init__(self, step):
+        super().__init__(step)
+        self.nodes_in = 0
+        self.nodes_out = 0
+        self.time = 0.0
+
+
+class Profile(Diagnostics):
+    """A `Diagnostics` collector which also times each step and counts the nodes passing 
+    between steps, like a database's EXPLAIN ANALYZE.
+
+    Pass an instance as the `diagnostics` parameter of `evaluate`, `jsonpath` etc., or use
+    `Query.explain`. Printing the profile shows the steps as a plan tree. Profiling adds 
+    overhead to each node passed between steps, so timings are only comparable with each
+    other, and evaluation without a profile is unaffected.
+
+    :ivar steps: List of `StepProfile`, one for each step of the path
+    :ivar expr: The expression profiled, if known
+    """
+
+    STATS_TYPE = StepProfile
+
+    def __init__(self, expr=None):
+        super().__init__()
+        self.expr = expr
+
+    @property
+    def time(self):
+        """Total seconds spent evaluating all of the steps"""
+        return sum(stats.time for stats in self.steps if stats is not None)
+
+    @property
+    def results(self):
+        """The number of results produced by the final step"""
+        return self.steps[-1].nodes_out if len(self.steps) > 0 else 0
+
+    def as_dict(self):
+        """Returns the profile as a dict, for serialising"""
+        return { 'expr': self.expr, 'time': self.time, 'results': self.results,
+                 'steps': super().as_dict() }
+
+    def __str__(self):
+        lines = ['{}  (results={}, time={:.3f}ms)'.format(
+                    self.expr if self.expr is not None else 'query', self.results, self.time*1000)]
+        for i,stats in enumerate(self.steps):
+            if stats is None:
+                continue
+            step = stats.step
+            targets = ', '.join(repr(t) for t in getattr(step, 'targets', ()))
+            details = 'in={} out={} time={:.3f}ms'.format(stats.nodes_in, stats.nodes_out, 
+                                                          stats.time*1000)
+            for name in StepStats.FIELDS:
+                if getattr(stats, name):
+                    details += ' {}={}'.format(name.replace('_', ' '), getattr(stats, name))
+            lines.append('{}-> {} {} [{}]  ({})'.format('   ' * i, i, type(step).__name__, 
+                                                       targets, details))
+        return '\n'.join(lines)
+
+
+class _ProfiledInput:
+    """Iterator over a step's input nodes which counts them and times the earlier steps 
+    producing them"""
+
+    __slots__ = ('nodes', 'stats', 'upstream')
+
+    def __init__(self, nodes, stats):
+        self.nodes = iter(nodes)
+        self.stats = stats
+        self.upstream = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            node = next(self.nodes)
+        finally:
+            self.upstream += time.perf_counter() - start
+        self.stats.nodes_in += 1
+        return node
+
+
+def _profiled(step, data, currnodes, ctx):
+    stats = ctx.stats
+    currnodes = _ProfiledInput(currnodes, stats)
+    nodes = step.apply_to(data, currnodes, ctx)
+    while True:
+        start = time.perf_counter()
+        upstream = currnodes.upstream
+        try:
+            node = next(nodes)
+        except StopIteration:
+            return
+        finally:
+            stats.time += time.perf_counter() - start - (currnodes.upstream - upstream)
+        stats.nodes_out += 1
+        yield node
+
+
+ORDER_SORTED = "sorted"
+ORDER_INSERTION = "insertion"
+_ORDERS = (ORDER_SORTED, ORDER_INSERTION)
+
+
+class _Context:
+    """Per-step state passed down through `apply_to` during an evaluation"""
+
+    __slots__ = ('stats', 'engine', 'index', 'order')
+
+    def __init__(self, stats=None, engine=None, index=None, order=ORDER_SORTED):
+        self.stats = stats
+        self.engine = engine
+        self.index = index
+        self.order = order
+
+
+_DEFAULT_CONTEXT = _Context()
+_INSERTION_CONTEXT = _Context(order=ORDER_INSERTION)
+
+# guards state which parsed steps build on first use
+_BUILD_LOCK = threading.Lock()
+
+
+def _debug_enabled():
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+
+def _warning_enabled():
+    return logging.root.isEnabledFor(logging.WARNING)
+
+
+def _structure_key(value):
+    if isinstance(value, _Parsed):
+        return value.key()
+    elif isinstance(value, (list, tuple)) or (_pyparsing_module is not None 
+                                              and isinstance(value, _pyparsing_module.ParseResults)):
+        return tuple(_structure_key(v) for v in value)
+    else:
+        return value
+
+
 class _Parsed:
 
     TEMP_CURR_VAR = '__current'
@@ -40,22 +297,47 @@ class _Parsed:
         return '{}({})'.format(type(self).__name__, 
                                ','.join('{}={}'.format(k,v) for k,v in self._values.items()))
 
+    def key(self):
+        """Returns a hashable value which is equal for structurally equal parsed items"""
+        return (type(self),) + tuple((name, _structure_key(val)) 
+                                     for name,val in sorted(self._values.items()))
+
     def property_of(self, node, propname):
-        obj, path = node
-        return (obj[propname], '{}["{}"]'.format(path, propname.replace('\\','\\\\').replace('"','\\"')))
+        obj = node.value
+        if type(obj) is not dict:
+            obj = _as_mapping(obj)
+        return _Node(obj[propname], node, propname)
 
     def index_of(self, node, index):
-        obj, path = node
-        return (obj[index], '{}[{}]'.format(path, index))
+        return _Node(node.value[index], node, index)
+
+    def all_children_of(self, node, order=ORDER_SORTED):
+        """Yields the child nodes of a node, with the properties of an object sorted by name
+        unless the order is `ORDER_INSERTION`"""
+        obj = node.value
+        if isinstance(obj, _SEQUENCE_TYPES):
+            for index, value in enumerate(obj):
+                yield _Node(value, node, index)
+        elif isinstance(obj, _MAPPING_TYPES):
+            if type(obj) is not dict:
+                obj = _as_mapping(obj)
+            if order == ORDER_INSERTION:
+                for key, value in obj.items():
+                    yield _Node(value, node, key)
+            else:
+                for key in sorted(obj.keys()):
+                    yield _Node(obj[key], node, key)
 
-    def all_children_of(self, node):
-        obj, path = node
-        if isinstance(obj, (list, tuple)):
-            return [self.index_of(node,i) for i in range(len(obj))]
-        elif isinstance(obj, dict):
-            return [self.property_of(node, k) for k in sorted(obj.keys())]
+    def child_keys_of(self, node, order=ORDER_SORTED):
+        obj = node.value
+        if isinstance(obj, _SEQUENCE_TYPES):
+            return range(len(obj))
+        elif isinstance(obj, _MAPPING_TYPES):
+            if type(obj) is not dict:
+                obj = _as_mapping(obj)
+            return list(obj.keys()) if order == ORDER_INSERTION else sorted(obj.keys())
         else:
-            return []
+            return ()
 
     def code_at_regex_sub(self, match):
         return match.group(1) + ( '@' if match.group(2) else self.TEMP_CURR_VAR )
@@ -63,14 +345,35 @@ class _Parsed:
     def code_dollar_regex_sub(self, match):
         return match.group(1) + ( '$' if match.group(2) else self.TEMP_ROOT_VAR )
 
-    def eval_code_for(self, data, node):
-        obj, path = node
+    def compile_code(self):
         # replace non-escaped @ symbols with variable and escaped with plain symbol.
         # Capture all preceeding backslashes to resolve multiply-escaped symbol.        
-        to_eval = re.sub(r'(?<!\\)((?:\\\\)*)(\\?)@', self.code_at_regex_sub, self.code)
+        source = re.sub(r'(?<!\\)((?:\\\\)*)(\\?)@', self.code_at_regex_sub, self.code)
         # same for root ($) symbols
-        to_eval = re.sub(r'(?<!\\)((?:\\\\)*)(\\?)\$', self.code_dollar_regex_sub, to_eval)
-        return eval(to_eval, { self.TEMP_CURR_VAR: obj, self.TEMP_ROOT_VAR: data })
+        source = re.sub(r'(?<!\\)((?:\\\\)*)(\\?)\$', self.code_dollar_regex_sub, source)
+        self.code_func = None
+        self.code_error = None
+        self.code_source = source
+        self.uses_root = self.TEMP_ROOT_VAR in source
+        try:
+            # compile the bare expression first so that error positions match the script
+            builtins.compile(source, '<script>', 'eval')
+        except SyntaxError as e:
+            self.code_error = e
+            return
+        # Wrap the expression in a function taking the current and root nodes as arguments, 
+        # so the code object and its globals are created once and shared by every evaluation
+        func_source = 'lambda {},{}: (\n{}\n)'.format(self.TEMP_CURR_VAR, self.TEMP_ROOT_VAR, source)
+        self.code_func = eval(builtins.compile(func_source, '<script>', 'eval'), {})
+
+    def check_code(self):
+        if getattr(self, 'code_error', None) is not None:
+            raise self.code_error
+        for targ in getattr(self, 'targets', ()):
+            targ.check_code()
+
+    def eval_code_for(self, data, node):
+        return self.code_func(node.value, data)
 
     def replace_values_if_tokens_empty(self, tokens, values, **newvalues):
         if tokens is not None and len(list(tokens.items())) == 0:
@@ -81,83 +384,129 @@ class _Parsed:
 
 class PChild(_Parsed): 
 
-    def apply_to(self, data, currnodes):
-        retval = []
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        if len(self.targets) > 1:
+            # each target is applied to all of the nodes in turn
+            currnodes = list(currnodes)
         for targ in self.targets:
-            retval.extend(targ.apply_to(data, currnodes))
-        return retval
+            yield from targ.apply_to(data, currnodes, ctx)
 
         
 class PRecursive(_Parsed):
 
-    def apply_to(self, data, currnodes):
-        retval = []
-        for targ in self.targets:
-            retval.extend(targ.apply_to(data, currnodes))
-        # recurse down
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        if ctx.index is not None and ctx.index.supports(self, data, ctx.order):
+            return self.apply_indexed(data, currnodes, ctx)
+        return self.search(data, [list(currnodes)], ctx)
+
+    def apply_indexed(self, data, currnodes, ctx):
+        currnodes = list(currnodes)
+        target = self.targets[0]
+        yield from target.apply_to(data, currnodes, ctx)
         for node in currnodes:
-            retval.extend(self.apply_to(data, self.all_children_of(node)))
-        return retval
+            span = ctx.index.descendants_of(node)
+            if span is not None:
+                matches = ctx.index.search(target, span)
+                if len(span) > 0:
+                    # the node may have been reached by a different path than the index's,
+                    # such as with a negative index, which the matches' paths must follow
+                    indexed = ctx.index.nodes[span.start].parent
+                    if not _same_path(indexed, node):
+                        matches = _reparented(matches, indexed, node)
+                yield from matches
+            else:
+                yield from self.search(data, [list(self.all_children_of(node, ctx.order))], ctx)
+
+    def search(self, data, stack, ctx):
+        # A root target matches even without any input nodes, so leaf nodes must be visited too
+        visit_leaves = any(isinstance(targ, PRoot) for targ in self.targets)
+        # Search an explicit stack of node lists rather than recursing, so that the depth of the
+        # data isn't limited. Children are pushed in reverse, to be popped in document order.
+        while stack:
+            nodes = stack.pop()
+            for targ in self.targets:
+                yield from targ.apply_to(data, nodes, ctx)
+            for node in reversed(nodes):
+                if isinstance(node.value, _CONTAINER_TYPES):
+                    children = list(self.all_children_of(node, ctx.order))
+                    if children or visit_leaves:
+                        stack.append(children)
+                elif visit_leaves:
+                    stack.append([])
         
                     
 class PRoot(_Parsed):
 
-    def apply_to(self, data, currnodes):
-        return [ (data, '$') ]
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        yield _Node(data)
 
 
 class PCurrent(_Parsed):
 
-    def apply_to(self, data, currnodes):
-        return list(currnodes)
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        return iter(currnodes)
 
 
 class PWildcard(_Parsed):
 
-    def apply_to(self, data, currnodes):
-        retval = []
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
         for node in currnodes:            
-            retval.extend(self.all_children_of(node))
-        return retval
+            yield from self.all_children_of(node, ctx.order)
                 
 
 class PProperty(_Parsed):
 
-    def apply_to(self, data, currnodes):
-        retval = []
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        stats = ctx.stats
+        debug = _debug_enabled()
         for node in currnodes:
-            obj, path = node
-            if not isinstance(obj, dict): 
-                logging.debug('ignoring property "{}" for {}'.format(self.name, type(obj).__name__))
+            obj = node.value
+            if not isinstance(obj, _MAPPING_TYPES): 
+                if stats is not None:
+                    stats.skipped += 1
+                if debug:
+                    logging.debug('ignoring property "{}" for {}'.format(self.name, type(obj).__name__))
                 continue
             try:
-                retval.append(self.property_of(node, self.name))
+                child = self.property_of(node, self.name)
             except KeyError as e:
-                logging.debug('{} {}'.format(type(e).__name__, str(e)))
-        return retval
+                if stats is not None:
+                    stats.missing += 1
+                if debug:
+                    logging.debug('{} {}'.format(type(e).__name__, str(e)))
+                continue
+            yield child
         
 
 class PSlice(_Parsed):
 
-    def apply_to(self, data, currnodes):
-        retval = []
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        stats = ctx.stats
+        debug = _debug_enabled()
+        index = getattr(self, "index", None)
+        bounds = slice(getattr(self, "start", None), getattr(self, "end", None), 
+                       getattr(self, "step", None))
         for node in currnodes:
-            obj, path = node
-            if not isinstance(obj, (list, tuple)): 
-                logging.debug('ignoring slice "{}" for {}'.format(self._values, type(obj).__name__))
+            obj = node.value
+            if not isinstance(obj, _SEQUENCE_TYPES): 
+                if stats is not None:
+                    stats.skipped += 1
+                if debug:
+                    logging.debug('ignoring slice "{}" for {}'.format(self._values, type(obj).__name__))
                 continue
-            if hasattr(self, "index"):
-                try:
-                    retval.append(self.index_of(node, self.index))
-                except IndexError as e:
-                    logging.debug('{} {}'.format(type(e).__name__, str(e)))
+            length = len(obj)
+            if index is not None:
+                if -length <= index < length:
+                    yield self.index_of(node, index)
+                else:
+                    if stats is not None:
+                        stats.missing += 1
+                    if debug:
+                        logging.debug('ignoring out of range index {} for length {}'.format(index, length))
             else:
-                start = getattr(self, "start", None)
-                end = getattr(self, "end", None)
-                step = getattr(self, "step", None)
-                for i,v in list(enumerate(obj))[start:end:step]:
-                    retval.append(self.index_of(node, i))
-        return retval
+                # resolve the slice arithmetically so only the selected elements are visited
+                for i in range(*bounds.indices(length)):
+                    yield self.index_of(node, i)
         
     
 class PExpression(_Parsed):
@@ -166,56 +515,748 @@ class PExpression(_Parsed):
         # hack to insert empty code property if parser doesn't provide one
         tokens, values = self.replace_values_if_tokens_empty(tokens, values, code='')
         super().__init__(tokens, **values)
+        self.compile_code()
 
-    def apply_to(self, data, currnodes):        
-        retval = []
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):        
+        stats = ctx.stats
+        debug = _debug_enabled()
+        warning = _warning_enabled()
         for node in currnodes:
-            obj, path = node
+            obj = node.value
+            if stats is not None:
+                stats.script_evaluations += 1
             try:
                 key = self.eval_code_for(data, node)
             except SyntaxError:
                 raise
             except Exception as e:
-                logging.warning('{} evaluating python expression script \"{}\": {}'
-                                .format(type(e).__name__, self.code, e))
+                if stats is not None:
+                    stats.script_errors += 1
+                if warning:
+                    logging.warning('{} evaluating python expression script \"{}\": {}'
+                                    .format(type(e).__name__, self.code, e))
                 continue
-            if isinstance(obj, (list, tuple)) and isinstance(key, (int, float)) and not isinstance(key, bool):
+            if isinstance(obj, _SEQUENCE_TYPES) and isinstance(key, _NUMBER_TYPES) and not isinstance(key, bool):
                 try:
-                    retval.append(self.index_of(node, int(key)))
+                    child = self.index_of(node, int(key))
                 except IndexError as e:
-                    logging.debug('{} {}'.format(type(e).__name__, str(e)))
-            elif isinstance(obj, dict) and isinstance(key, str):
+                    if stats is not None:
+                        stats.missing += 1
+                    if debug:
+                        logging.debug('{} {}'.format(type(e).__name__, str(e)))
+                    continue
+            elif isinstance(obj, _MAPPING_TYPES) and isinstance(key, str):
                 try:
-                    retval.append(self.property_of(node, str(key)))
+                    child = self.property_of(node, str(key))
                 except KeyError as e:
-                    logging.debug('{} {}'.format(type(e).__name__, str(e)))
+                    if stats is not None:
+                        stats.missing += 1
+                    if debug:
+                        logging.debug('{} {}'.format(type(e).__name__, str(e)))
+                    continue
+            else:
+                if stats is not None:
+                    stats.skipped += 1
+                if debug:
+                    logging.debug('ignoring key/index {} for {}'.format(repr(key),type(obj).__name__))
+                continue
+            yield child
+
+
+
+class PChain(_Parsed):
+    """Consecutive child steps each selecting a single property or index, optionally after a
+    wildcard, fused into one step by `optimise`. Property names are given as strings and 
+    indices as integers in `keys`, and are looked up directly for each node."""
+
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        if self.wildcard:
+            currnodes = self.children(currnodes, ctx.order)
+        keys = self.keys
+        for node in currnodes:
+            for key in keys:
+                obj = node.value
+                if type(key) is str:
+                    if not isinstance(obj, _MAPPING_TYPES):
+                        break
+                    if type(obj) is not dict:
+                        obj = _as_mapping(obj)
+                    try:
+                        value = obj[key]
+                    except KeyError:
+                        break
+                elif isinstance(obj, _SEQUENCE_TYPES) and -len(obj) <= key < len(obj):
+                    value = obj[key]
+                else:
+                    break
+                node = _Node(value, node, key)
             else:
-                logging.debug('ignoring key/index {} for {}'.format(repr(key),type(obj).__name__))
-        return retval
+                yield node
+
+    @staticmethod
+    def children(nodes, order=ORDER_SORTED):
+        for node in nodes:
+            obj = node.value
+            if isinstance(obj, _MAPPING_TYPES):
+                if type(obj) is not dict:
+                    obj = _as_mapping(obj)
+                if order == ORDER_INSERTION:
+                    for key, value in obj.items():
+                        yield _Node(value, node, key)
+                else:
+                    for key in sorted(obj.keys()):
+                        yield _Node(obj[key], node, key)
+            elif isinstance(obj, _SEQUENCE_TYPES):
+                for key, value in enumerate(obj):
+                    yield _Node(value, node, key)
+
+
+
+_numpy_module = None
+
+
+def _numpy():
+    global _numpy_module
+    if _numpy_module is None:
+        try:
+            import numpy
+        except ImportError as e:
+            raise ImportError('The numpy engine requires the numpy package') from e
+        _numpy_module = numpy
+    return _numpy_module
+
+
+class _VectorFilter:
+    """A filter script made up only of comparisons and boolean operators on fields of the
+    current node, or on the current node itself, which can be evaluated for many nodes at once
+    using NumPy arrays.
+
+    Nodes whose result can't be determined this way, such as those missing a field or having
+    a field of an unsupported type, are reported as undecided so that the script can be 
+    evaluated for them individually.
+    """
+
+    # integers beyond this magnitude can't be compared exactly as 64-bit floats
+    MAX_EXACT_INT = 2**53
+
+    COMPARISONS = { 'Eq': operator.eq, 'NotEq': operator.ne, 'Lt': operator.lt, 
+                    'LtE': operator.le, 'Gt': operator.gt, 'GtE': operator.ge }
+
+    def __init__(self, tree, fields):
+        self.tree = tree
+        self.fields = fields
+
+    @classmethod
+    def from_source(cls, source):
+        """Returns a vectorised filter for the given script source, or None if not possible"""
+        import ast
+        fields = set()
+        try:
+            tree = cls.convert(ast, ast.parse(source.strip(), mode='eval').body, fields)
+        except (SyntaxError, ValueError):
+            return None
+        return cls(tree, fields)
+
+    @classmethod
+    def convert(cls, ast, expr, fields):
+        if isinstance(expr, ast.BoolOp):
+            op = 'and' if isinstance(expr.op, ast.And) else 'or'
+            return (op, [cls.convert(ast, v, fields) for v in expr.values])
+        elif isinstance(expr, ast.UnaryOp) and isinstance(expr.op, ast.Not):
+            return ('not', cls.convert(ast, expr.operand, fields))
+        elif isinstance(expr, ast.Compare):
+            operands = [cls.operand(ast, o, fields) for o in [expr.left] + expr.comparators]
+            comparisons = []
+            for i,op in enumerate(expr.ops):
+                if type(op).__name__ not in cls.COMPARISONS:
+                    raise ValueError(op)
+                comparisons.append(('compare', cls.COMPARISONS[type(op).__name__], 
+                                    operands[i], operands[i+1]))
+            # a chained comparison behaves as the comparisons joined with 'and'
+            return comparisons[0] if len(comparisons) == 1 else ('and', comparisons)
+        else:
+            raise ValueError(expr)
+
+    @classmethod
+    def operand(cls, ast, expr, fields):
+        if isinstance(expr, ast.Name) and expr.id == _Parsed.TEMP_CURR_VAR:
+            # the node's own value is represented as the field None
+            fields.add(None)
+            return ('field', None)
+        if isinstance(expr, ast.Subscript) and isinstance(expr.value, ast.Name) \
+                and expr.value.id == _Parsed.TEMP_CURR_VAR:
+            key = expr.slice
+            if type(key).__name__ == 'Index':
+                key = key.value
+            key = cls.literal(ast, key)
+            if type(key) is not str:
+                raise ValueError(key)
+            fields.add(key)
+            return ('field', key)
+        value = cls.literal(ast, expr)
+        if type(value) is str:
+            return ('value', 'str', value, False)
+        elif type(value) in (bool, int) and abs(value) <= cls.MAX_EXACT_INT or type(value) is float:
+            return ('value', 'num', value, False)
+        else:
+            raise ValueError(value)
+
+    @staticmethod
+    def literal(ast, expr):
+        try:
+            return ast.literal_eval(expr)
+        except (ValueError, TypeError, SyntaxError):
+            raise ValueError(expr)
+
+    def column(self, np, values, key):
+        if isinstance(values, np.ndarray) and values.ndim == 1:
+            column = self.array_column(np, values, key)
+            if column is not None:
+                return column
+        if key is None:
+            items = list(values)
+        else:
+            items = [_as_mapping(value).get(key) if isinstance(value, _MAPPING_TYPES) else None 
+                     for value in values]
+        types = set(map(type, items))
+        # fast paths for columns of a single supported type
+        if types <= {float, int, bool} and (types <= {float} 
+                or all(abs(item) <= self.MAX_EXACT_INT for item in items if type(item) is int)):
+            return ('value', 'num', np.array(items, dtype=np.float64), False)
+        elif types == {str}:
+            return ('value', 'str', np.array(items, dtype=object), False)
+        kinds = [self.kind_of(item) for item in items]
+        kind = next((k for k in kinds if k is not None), None)
+        # values which are missing or of another kind are replaced with a placeholder
+        undecided = [k is None or k != kind for k in kinds]
+        placeholder = '' if kind == 'str' else 0.0
+        items = [placeholder if u else item for item,u in zip(items, undecided)]
+        array = np.array(items, dtype=object if kind == 'str' else np.float64)
+        return ('value', kind, array, np.array(undecided, dtype=bool))
+
+    def array_column(self, np, values, key):
+        """Returns a column referring to the given NumPy array, or to one of its fields, 
+        without copying it, or None if its elements must be compared individually"""
+        if key is None:
+            array = values
+        elif values.dtype.names is not None and key in values.dtype.names:
+            array = values[key]
+        else:
+            return None
+        kind = array.dtype.kind
+        if array.ndim != 1:
+            return None
+        elif kind in 'fb' or kind in 'iu' and (array.dtype.itemsize < 8 or array.size == 0 
+                or -self.MAX_EXACT_INT <= array.min() and array.max() <= self.MAX_EXACT_INT):
+            return ('value', 'num', array, False)
+        elif kind == 'U':
+            return ('value', 'str', array, False)
+        return None
+
+    @classmethod
+    def kind_of(cls, item):
+        itemtype = type(item)
+        if itemtype is str:
+            return 'str'
+        elif itemtype is float or (itemtype is int or itemtype is bool) \
+                and abs(item) <= cls.MAX_EXACT_INT:
+            return 'num'
+        else:
+            # missing, or of a type without vectorised comparisons
+            return None
+
+    def evaluate(self, np, expr, columns, size):
+        if expr[0] == 'compare':
+            _, op, left, right = expr
+            left = columns[left[1]] if left[0] == 'field' else left
+            right = columns[right[1]] if right[0] == 'field' else right
+            undecided = np.logical_or(left[3], right[3])
+            if left[1] == right[1]:
+                result = np.asarray(op(left[2], right[2]), dtype=bool)
+            elif op is operator.eq or op is operator.ne:
+                # values of different types are never equal
+                result = np.full(size, op is operator.ne, dtype=bool)
+            else:
+                # ordering values of different types raises an error
+                result = np.zeros(size, dtype=bool)
+                undecided = np.ones(size, dtype=bool)
+            return np.broadcast_to(result, (size,)), np.broadcast_to(undecided, (size,))
+        elif expr[0] == 'not':
+            result, undecided = self.evaluate(np, expr[1], columns, size)
+            return ~result, undecided
+        else:
+            # operands after the first are only evaluated if the result isn't yet decided
+            result, undecided = self.evaluate(np, expr[1][0], columns, size)
+            for operand in expr[1][1:]:
+                opresult, opundecided = self.evaluate(np, operand, columns, size)
+                if expr[0] == 'and':
+                    undecided = undecided | (result & opundecided)
+                    result = result & opresult
+                else:
+                    undecided = undecided | (~result & opundecided)
+                    result = result | opresult
+            return result, undecided
+
+    def accepted(self, values):
+        """Returns lists of the indices of values which are accepted, and which are undecided"""
+        np = _numpy()
+        columns = { key: self.column(np, values, key) for key in self.fields }
+        result, undecided = self.evaluate(np, self.tree, columns, len(values))
+        return np.flatnonzero(result & ~undecided).tolist(), np.flatnonzero(undecided).tolist()
+
 
-    
 class PFilter(_Parsed):
 
     def __init__(self, tokens=None, **values):
         # hack to insert empty code property if parser doesn't provide one
         tokens, values = self.replace_values_if_tokens_empty(tokens, values, code='')
         super().__init__(tokens, **values)
+        self.compile_code()
 
-    def apply_to(self, data, currnodes):
-        retval = []
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        stats = ctx.stats
+        warning = _warning_enabled()
+        vectorise = ctx.engine == ENGINE_NUMPY
         for node in currnodes:
-            for child in self.all_children_of(node):
-                try:
-                    if not bool(self.eval_code_for(data, child)):
-                        continue
-                except SyntaxError:
-                    raise
-                except Exception as e:
-                    logging.warning("{} evaluating python filter script \"{}\": {}"
-                                    .format(type(e).__name__, self.code, e))
+            # NumPy arrays are filtered in place whichever engine is used
+            if vectorise or _is_array(node.value):
+                vector = self.vector_filter()
+                keys = self.child_keys_of(node, ctx.order) if vector is not None else None
+                if keys is not None and len(keys) >= VECTORISE_MIN_NODES:
+                    yield from self.apply_vectorised(vector, data, node, keys, stats, warning)
                     continue
-                retval.append(child)
-        return retval
+            for child in self.all_children_of(node, ctx.order):
+                if self.accepts(data, child, stats, warning):
+                    yield child
+
+    def apply_vectorised(self, vector, data, node, keys, stats, warning):
+        obj = node.value
+        values = obj if isinstance(obj, _SEQUENCE_TYPES) else [obj[k] for k in keys]
+        accepted, undecided = vector.accepted(values)
+        if stats is not None:
+            stats.script_evaluations += len(values) - len(undecided)
+        # merge the two sorted index lists, to yield the children in their usual order
+        undecided.append(len(keys))
+        u = 0
+        for i in accepted:
+            while undecided[u] < i:
+                child = _Node(values[undecided[u]], node, keys[undecided[u]])
+                if self.accepts(data, child, stats, warning):
+                    yield child
+                u += 1
+            yield _Node(values[i], node, keys[i])
+        for j in undecided[u:-1]:
+            child = _Node(values[j], node, keys[j])
+            if self.accepts(data, child, stats, warning):
+                yield child
+
+    def vector_filter(self):
+        if not hasattr(self, 'vector'):
+            # parsed steps may be shared between threads, so the filter is built only once
+            with _BUILD_LOCK:
+                if not hasattr(self, 'vector'):
+                    if self.code_func is None or self.uses_root:
+                        self.vector = None
+                    else:
+                        self.vector = _VectorFilter.from_source(self.code_source)
+        return self.vector
+
+    def accepts(self, data, node, stats=None, warning=True):
+        if stats is not None:
+            stats.script_evaluations += 1
+        try:
+            return bool(self.eval_code_for(data, node))
+        except SyntaxError:
+            raise
+        except Exception as e:
+            if stats is not None:
+                stats.script_errors += 1
+            if warning:
+                logging.warning("{} evaluating python filter script \"{}\": {}"
+                                .format(type(e).__name__, self.code, e))
+            return False
+
+
+# marks a query which selects nothing, which only compares equal to itself
+_NOTHING = object()
+
+
+def _json_equal(a, b):
+    if a is None or b is None or a is _NOTHING or b is _NOTHING \
+            or type(a) is bool or type(b) is bool:
+        return a is b
+    elif isinstance(a, _NUMBER_TYPES) and isinstance(b, _NUMBER_TYPES):
+        return a == b
+    elif isinstance(a, str) and isinstance(b, str):
+        return a == b
+    elif isinstance(a, _SEQUENCE_TYPES) and isinstance(b, _SEQUENCE_TYPES):
+        return len(a) == len(b) and all(map(_json_equal, a, b))
+    elif isinstance(a, _MAPPING_TYPES) and isinstance(b, _MAPPING_TYPES):
+        a, b = _as_mapping(a), _as_mapping(b)
+        return a.keys() == b.keys() and all(_json_equal(a[k], b[k]) for k in a)
+    else:
+        return False
+
+
+def _json_less(a, b):
+    if type(a) is bool or type(b) is bool:
+        return False
+    elif isinstance(a, _NUMBER_TYPES) and isinstance(b, _NUMBER_TYPES):
+        return a < b
+    elif isinstance(a, str) and isinstance(b, str):
+        return a < b
+    else:
+        return False
+
+
+_JSON_COMPARISONS = {
+    '==': _json_equal,
+    '!=': lambda a, b: not _json_equal(a, b),
+    '<': _json_less,
+    '>': lambda a, b: _json_less(b, a),
+    '<=': lambda a, b: _json_less(a, b) or _json_equal(a, b),
+    '>=': lambda a, b: _json_less(b, a) or _json_equal(a, b),
+}
+
+_MIRRORED_COMPARISONS = { '==': '==', '!=': '!=', '<': '>', '>': '<', '<=': '>=', '>=': '<=' }
+
+_PYTHON_COMPARISONS = { '==': operator.eq, '<': operator.lt, '>': operator.gt, 
+                        '<=': operator.le, '>=': operator.ge }
+
+
+class _SafeQuery:
+    """A query within a safe dialect filter, relative to the current node (``@``) or the root
+    node (``$``)"""
+
+    def __init__(self, from_root, steps):
+        self.from_root = from_root
+        self.steps = list(steps)
+        self.uses_root = from_root or any(_refers_to_root(step) for step in self.steps)
+        # a singular query has only single name or index selectors, and selects at most one node
+        self.keys = []
+        for step in self.steps:
+            targets = getattr(step, 'targets', ())
+            if not isinstance(step, PChild) or len(targets) != 1:
+                self.keys = None
+                break
+            if isinstance(targets[0], PProperty):
+                self.keys.append(targets[0].name)
+            elif isinstance(targets[0], PSlice) and getattr(targets[0], 'index', None) is not None:
+                self.keys.append(targets[0].index)
+            else:
+                self.keys = None
+                break
+
+    def getter(self):
+        """Returns a function of the current and root values, returning the value the singular 
+        query selects or `_NOTHING`"""
+        from_root, keys = self.from_root, self.keys
+        if len(keys) == 0:
+            return (lambda current, root: root) if from_root else (lambda current, root: current)
+        if len(keys) == 1 and type(keys[0]) is str and not from_root:
+            key = keys[0]
+            def get(current, root):
+                return _as_mapping(current).get(key, _NOTHING) \
+                        if isinstance(current, _MAPPING_TYPES) else _NOTHING
+            return get
+        def get(current, root):
+            value = root if from_root else current
+            for key in keys:
+                if type(key) is str:
+                    if not isinstance(value, _MAPPING_TYPES):
+                        return _NOTHING
+                    value = _as_mapping(value).get(key, _NOTHING)
+                    if value is _NOTHING:
+                        return value
+                elif isinstance(value, _SEQUENCE_TYPES) and -len(value) <= key < len(value):
+                    value = value[key]
+                else:
+                    return _NOTHING
+            return value
+        return get
+
+    def exists(self):
+        """Returns a function of the current and root values, returning whether the query 
+        selects any nodes"""
+        if self.keys is not None:
+            get = self.getter()
+            return _safe_predicate(lambda current, root: get(current, root) is not _NOTHING, self)
+        from_root, steps = self.from_root, self.steps
+        def exists(current, root):
+            nodes = [_Node(root if from_root else current)]
+            for step in steps:
+                nodes = step.apply_to(root, nodes)
+            for _ in nodes:
+                return True
+            return False
+        return _safe_predicate(exists, self)
+
+
+def _safe_predicate(predicate, *operands):
+    """Marks a predicate function with whether it refers to the root node, which it does if
+    any of its operands, queries or other predicates, do"""
+    predicate.uses_root = any(getattr(operand, 'uses_root', False) for operand in operands)
+    return predicate
+
+
+def _safe_comparison(left, op, right):
+    return _safe_predicate(_safe_comparison_function(left, op, right), left, right)
+
+
+def _safe_comparison_function(left, op, right):
+    # operands are either a singular query or a literal value
+    if not isinstance(left, _SafeQuery) and not isinstance(right, _SafeQuery):
+        result = _JSON_COMPARISONS[op](left, right)
+        return lambda current, root: result
+    if not isinstance(left, _SafeQuery):
+        left, op, right = right, _MIRRORED_COMPARISONS[op], left
+    get = left.getter()
+    if isinstance(right, _SafeQuery):
+        compare, getright = _JSON_COMPARISONS[op], right.getter()
+        return lambda current, root: compare(get(current, root), getright(current, root))
+    # specialise comparisons of a literal number or string with a property of the current 
+    # node, the most common case, to avoid the overhead of the general comparison functions
+    if isinstance(right, _NUMBER_TYPES + (str,)) and type(right) is not bool:
+        if op == '!=':
+            equal = _safe_comparison(left, '==', right)
+            return lambda current, root: not equal(current, root)
+        pyop = _PYTHON_COMPARISONS[op]
+        types = str if isinstance(right, str) else _NUMBER_TYPES
+        if len(left.keys) == 1 and type(left.keys[0]) is str and not left.from_root:
+            key = left.keys[0]
+            def compare_property(current, root):
+                if isinstance(current, _MAPPING_TYPES):
+                    value = _as_mapping(current).get(key, _NOTHING)
+                    return isinstance(value, types) and type(value) is not bool \
+                            and pyop(value, right)
+                return False
+            return compare_property
+        def compare_literal(current, root):
+            value = get(current, root)
+            return isinstance(value, types) and type(value) is not bool and pyop(value, right)
+        return compare_literal
+    compare = _JSON_COMPARISONS[op]
+    return lambda current, root: compare(get(current, root), right)
+
+
+def _safe_membership(left, right):
+    if isinstance(right, _SafeQuery):
+        getright = right.getter()
+        def items(current, root):
+            value = getright(current, root)
+            return value if isinstance(value, _SEQUENCE_TYPES) else ()
+    else:
+        items = lambda current, root: right
+    if isinstance(left, _SafeQuery):
+        get = left.getter()
+    else:
+        get = lambda current, root: left
+    def contains(current, root):
+        value = get(current, root)
+        return any(_json_equal(value, item) for item in items(current, root))
+    return _safe_predicate(contains, left, right)
+
+
+def _safe_and(left, right):
+    return _safe_predicate(lambda current, root: left(current, root) and right(current, root),
+                           left, right)
+
+
+def _safe_or(left, right):
+    return _safe_predicate(lambda current, root: left(current, root) or right(current, root),
+                           left, right)
+
+
+def _safe_not(operand):
+    return _safe_predicate(lambda current, root: not operand(current, root), operand)
+
+
+class PSafeFilter(PFilter):
+    """A filter in the safe dialect, compiled into a predicate function instead of Python code.
+
+    Comparisons follow JSONPath rather than Python semantics: values of different types are 
+    never equal or ordered, and comparing with a query which selects nothing is not an error.
+    """
+
+    def __init__(self, code, predicate, uses_root):
+        _Parsed.__init__(self, code=code)
+        self.code_func = predicate
+        self.code_error = None
+        self.uses_root = uses_root
+        self.vector = None
+
+    def apply_to(self, data, currnodes, ctx=_DEFAULT_CONTEXT):
+        predicate = self.code_func
+        stats = ctx.stats
+        # the predicate can't fail, so only the accepted children need to be made into nodes
+        for node in currnodes:
+            obj = node.value
+            keys = self.child_keys_of(node, ctx.order)
+            values = obj if isinstance(obj, _SEQUENCE_TYPES) else [obj[k] for k in keys]
+            if stats is not None:
+                stats.script_evaluations += len(values)
+            for key, value in zip(keys, values):
+                if predicate(value, data):
+                    yield _Node(value, node, key)
+
+    def accepts(self, data, node, stats=None, warning=True):
+        if stats is not None:
+            stats.script_evaluations += 1
+        return self.code_func(node.value, data)
+
+
+class DocumentIndex:
+    """An index of the nodes of a data structure, built in a single pass, used to answer
+    recursive descent steps without searching the data.
+
+    Recursive steps with a single property or wildcard target, such as ``$..name`` or 
+    ``$.a..*``, are answered from the index in time proportional to the number of matches,
+    when it is passed as the `index` parameter of `evaluate`, `jsonpath` etc. Other steps are
+    evaluated as usual. The results are the same as without the index, but `Diagnostics` 
+    counts of skipped and missing nodes are not collected for the indexed steps.
+
+    The data must not be modified while the index is in use.
+
+    :ivar data: The indexed data structure
+    :ivar order: The order in which the properties of objects are indexed, which must be the
+        order of the evaluations the index is used for
+    :ivar nodes: Every node of the data structure, in the order in which a recursive descent
+        visits them: each container's children follow those of the containers before it in 
+        document order, so the descendants of any container are contiguous
+    :ivar kinds: The container type of each node in `nodes`: ``dict``, ``list`` or ``None``
+    :ivar names: Dictionary of each property name to the positions, in `nodes`, of the 
+        objects having that property, in ascending order
+    """
+
+    def __init__(self, data, order=ORDER_SORTED):
+        """
+        :param data: The data structure of basic types to index, as returned by the `json` 
+            module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :param order: The order in which the properties of objects are visited, as for 
+            `evaluate`. The index is only used by evaluations in the same order.
+        :type order: str
+        """
+        if order not in _ORDERS:
+            raise ValueError('Unknown order: {}'.format(order))
+        self.data = data = _data_of(data)
+        self.order = order
+        self.nodes = [_Node(data)]
+        self.kinds = [None]
+        self.names = {}
+        self._containers = []
+        # positions in nodes of each container's children, and the end of its descendants
+        self._child_start = [0]
+        self._child_end = [0]
+        self._descendants_end = [0]
+        self._positions = {}
+        self._build()
+
+    def _build(self):
+        nodes, kinds = self.nodes, self.kinds
+        child_start, child_end, descendants_end = \
+            self._child_start, self._child_end, self._descendants_end
+        # depth first, so that children are added in the order a recursive descent visits
+        # their parents. Entries of ~position mark the end of a container's descendants.
+        stack = [0]
+        while stack:
+            pos = stack.pop()
+            if pos < 0:
+                descendants_end[~pos] = len(nodes)
+                continue
+            node = nodes[pos]
+            obj = node.value
+            if isinstance(obj, _MAPPING_TYPES):
+                kinds[pos] = dict
+                obj = _as_mapping(obj)
+                keys = list(obj.keys()) if self.order == ORDER_INSERTION else sorted(obj.keys())
+                for key in keys:
+                    self.names.setdefault(key, []).append(pos)
+            elif isinstance(obj, _SEQUENCE_TYPES):
+                kinds[pos] = list
+                keys = range(len(obj))
+            else:
+                continue
+            self._containers.append(pos)
+            # a container which appears more than once can't be located by its identity
+            self._positions[id(obj)] = -1 if id(obj) in self._positions else pos
+            start = len(nodes)
+            for key in keys:
+                nodes.append(_Node(obj[key], node, key))
+            count = len(nodes) - start
+            kinds.extend([None] * count)
+            child_start.extend([0] * count)
+            child_end.extend([0] * count)
+            descendants_end.extend([0] * count)
+            child_start[pos] = start
+            child_end[pos] = len(nodes)
+            stack.append(~pos)
+            for child in range(len(nodes)-1, start-1, -1):
+                if isinstance(nodes[child].value, _CONTAINER_TYPES):
+                    stack.append(child)
+        # containers are visited depth first, but positioned in recursive descent order
+        self._containers.sort()
+        for positions in self.names.values():
+            positions.sort()
+
+    def supports(self, step, data, order=ORDER_SORTED):
+        """Returns whether the given recursive step can be answered from the index"""
+        return data is self.data and order == self.order and len(step.targets) == 1 \
+                and isinstance(step.targets[0], (PProperty, PWildcard))
+
+    def descendants_of(self, node):
+        """Returns the range of positions in `nodes` of the given node's descendants, or None
+        if the node is not in the index"""
+        obj = node.value
+        if not isinstance(obj, _CONTAINER_TYPES):
+            return range(0)
+        pos = self._positions.get(id(obj), -1)
+        if pos < 0 or self.nodes[pos].value is not obj:
+            return None
+        return range(self._child_start[pos], self._descendants_end[pos])
+
+    def search(self, target, span):
+        """Yields the nodes matched by applying the given property or wildcard target to each
+        of the nodes within the given range of positions"""
+        if isinstance(target, PProperty):
+            name = target.name
+            positions = self.names.get(name, ())
+            lo = bisect.bisect_left(positions, span.start)
+            hi = bisect.bisect_left(positions, span.stop)
+            for pos in positions[lo:hi]:
+                parent = self.nodes[pos]
+                yield _Node(parent.value[name], parent, name)
+        else:
+            containers = self._containers
+            lo = bisect.bisect_left(containers, span.start)
+            hi = bisect.bisect_left(containers, span.stop)
+            for pos in containers[lo:hi]:
+                yield from self.nodes[self._child_start[pos]:self._child_end[pos]]
+
+
+def _same_path(a, b):
+    """Returns whether two nodes have the same path"""
+    while a is not b:
+        if a is None or b is None or type(a.key) is not type(b.key) or a.key != b.key:
+            return False
+        a, b = a.parent, b.parent
+    return True
+
+
+def _reparented(nodes, old, new):
+    """Yields copies of the given descendants of the node `old`, beneath the node `new` in 
+    its place, which must have the same value"""
+    copies = { id(old): new }
+    for node in nodes:
+        chain = []
+        while id(node) not in copies:
+            chain.append(node)
+            node = node.parent
+        parent = copies[id(node)]
+        for node in reversed(chain):
+            parent = copies[id(node)] = _Node(node.value, parent, node.key)
+        yield parent
 
 
 def _token_printer(name):
@@ -224,150 +1265,3515 @@ def _token_printer(name):
     return print_tokens
 
 
-_ROOT = pp.Literal('$') \
-                .setParseAction(PRoot)
+_pyparsing_module = None
 
-_CURRENT = pp.Literal('@') \
-                .setParseAction(PCurrent)
 
-_WILDCARD = pp.Literal('*') \
-                .setParseAction(PWildcard)
+def _pyparsing():
+    global _pyparsing_module
+    if _pyparsing_module is None:
+        try:
+            import pyparsing
+        except ImportError as e:
+            raise ImportError('The pyparsing parser requires the pyparsing package') from e
+        _pyparsing_module = pyparsing
+    return _pyparsing_module
 
-_NAME = pp.Word( pp.alphas+"_", pp.alphanums+"_" ) \
-                .setName('name')
 
-_PROPERTY = ( _NAME 
-                    | pp.QuotedString('"','\\',None,False,True)
-                    | pp.QuotedString("'",'\\',None,False,True) ) \
-                .setResultsName('name').setParseAction(PProperty).setName('property')
+# Safe filter dialect: JSONPath filter expressions, compiled into functions without `eval`
 
-_INTEGER = pp.Combine( pp.Literal("-")*(0,1) + pp.Word( pp.nums ) ) \
-                .setParseAction(lambda t: int(t[0])).setName('integer')
+def _loc_marker():
+    return _pyparsing().Empty().setParseAction(lambda s, l, t: [l])
 
-_SLICE = ( _INTEGER.setResultsName('start')*(0,1) 
-                + ':' + _INTEGER.setResultsName('end')*(0,1)
-                + ( pp.Literal(':') + _INTEGER.setResultsName('step')*(0,1) )*(0,1)
-            | _INTEGER.setResultsName('index') ) \
-                .setParseAction(PSlice).setName('slice')
 
-_EXPRESSION = pp.QuotedString('(','\\',None,False,True,')') \
-                .setResultsName('code').setParseAction(PExpression).setName('script expression')
+def _safe_query_action(tokens):
+    return _SafeQuery(tokens[0] == '$', tokens[1])
 
-_FILTER = pp.QuotedString('?(','\\',None,False,True,')') \
-                .setResultsName('code').setParseAction(PFilter).setName('script filter')
 
-_TARGET = ( _ROOT | _CURRENT | _WILDCARD | _PROPERTY | _SLICE | _EXPRESSION | _FILTER ) \
-                .setName('target')
+def _safe_comparison_action(string, loc, tokens):
+    left, op, right = tokens
+    for operand in (left, right):
+        if isinstance(operand, _SafeQuery) and operand.keys is None:
+            raise _pyparsing().ParseFatalException(string, loc, 'Non-singular query in comparison')
+    return _safe_comparison(left, op, right)
 
-_TARGET_SET = pp.Group(pp.delimitedList( _TARGET, ',' )) \
-                .setName('target set')
 
-_IMPLICIT_CHILD = _TARGET_SET \
-                .setResultsName('targets').setParseAction(PChild)
+def _safe_membership_action(string, loc, tokens):
+    left, right = tokens[0], tokens[2]
+    for operand in (left, right):
+        if isinstance(operand, _SafeQuery) and operand.keys is None:
+            raise _pyparsing().ParseFatalException(string, loc, 'Non-singular query in membership test')
+    return _safe_membership(left, right)
 
-_CHILD = ( pp.Literal(".") + _TARGET_SET.setResultsName('targets') 
-            | pp.Literal('[') + _TARGET_SET.setResultsName('targets') + ']' ) \
-                .setParseAction(PChild).setName('child step')
 
-_RECURSIVE = ( pp.Literal("..") + _TARGET_SET.setResultsName('targets') ) \
-                .setParseAction(PRecursive).setName('recurse step')
+def _safe_filter_action(string, loc, tokens):
+    start, predicate, end = tokens
+    code = string[start:end].strip()
+    return PSafeFilter(code, predicate, predicate.uses_root)
 
-_STEP = _CHILD | _RECURSIVE
 
-_PATH = ( ( _IMPLICIT_CHILD | _STEP ) + _STEP*(0,) ) \
-                .setName('path')
+@functools.lru_cache(maxsize=None)
+def _pyparsing_grammars():
+    """Returns the pyparsing grammars of each dialect, keyed by dialect. They are built when 
+    first asked for, so that pyparsing is only imported if its parser is used."""
+    pp = _pyparsing()
 
+    _ROOT = pp.Literal('$') \
+                    .setParseAction(PRoot)
 
-RESULT_TYPE_VALUE = "VALUE"
-RESULT_TYPE_PATH = "PATH"
-RESULT_TYPE_BOTH = "BOTH"
+    _CURRENT = pp.Literal('@') \
+                    .setParseAction(PCurrent)
 
+    _WILDCARD = pp.Literal('*') \
+                    .setParseAction(PWildcard)
 
-def parse(string):
-    """Returns the parse tree from a string representing a JSONPath expression
+    _NAME = pp.Word( pp.alphas+"_", pp.alphanums+"_" ) \
+                    .setName('name')
 
-    :param string: The JSONPath expression to parse
-    :type string: str
-    :return: Nested objects representing the JSONPath (root will be a list)
-    :rtype: list
-    :raises JsonPathSyntaxError: if the given string does not represent a valid JSONPath 
-        expression. Note that Python script expressions are not parsed until the path is 
-        evaluated.
-    """
-    try:
-        return _PATH.parseString(string, True)
-    except pp.ParseException as e:
-        raise JsonPathSyntaxError(e.line, e.col, e.msg) from e
+    _PROPERTY = ( _NAME 
+                        | pp.QuotedString('"','\\',None,False,True)
+                        | pp.QuotedString("'",'\\',None,False,True) ) \
+                    .setResultsName('name').setParseAction(PProperty).setName('property')
 
+    _INTEGER = pp.Combine( pp.Literal("-")*(0,1) + pp.Word( pp.nums ) ) \
+                    .setParseAction(lambda t: int(t[0])).setName('integer')
 
-def evaluate(data, steps):
-    """Applies a JSONPath representation to a data structure and returns the matching nodes
+    _SLICE = ( _INTEGER.setResultsName('start')*(0,1) 
+                    + ':' + _INTEGER.setResultsName('end')*(0,1)
+                    + ( pp.Literal(':') + _INTEGER.setResultsName('step')*(0,1) )*(0,1)
+                | _INTEGER.setResultsName('index') ) \
+                    .setParseAction(PSlice).setName('slice')
 
-    :param data: The data structure of basic types to query, as returned by the `json` module
-    :type data: bool, int, float, str, tuple, list, dict, None
-    :param steps: The JSONPath representation, as returned by the `parse` function
-    :type steps: list
-    :return: List of 2-tuples, each containing the value followed by the path.
-    :rtype: list
-    :raises PythonSyntaxError: if the JSONPath includes an invalid Python script expression
-    """
-    currnodes = [(data,'$')]
-    try:
-        for step in steps:
-            currnodes = step.apply_to(data, currnodes)
-        return currnodes
-    except SyntaxError as e:
-        raise PythonSyntaxError(e.text, e.offset, e.msg) from e    
+    _EXPRESSION = pp.QuotedString('(','\\',None,False,True,')') \
+                    .setResultsName('code').setParseAction(PExpression).setName('script expression')
 
+    _FILTER = pp.QuotedString('?(','\\',None,False,True,')') \
+                    .setResultsName('code').setParseAction(PFilter).setName('script filter')
 
-def jsonpath(obj, expr, result_type=RESULT_TYPE_VALUE, always_return_list=False):
-    """Queries the given data structure using a JSONPath expression as a string.
+    _TARGET = ( _ROOT | _CURRENT | _WILDCARD | _PROPERTY | _SLICE | _EXPRESSION | _FILTER ) \
+                    .setName('target')
 
-    This is a convenience function that first `parse`es the expression string and then
-    `evaluate`s the expression against the given data structure.
+    _TARGET_SET = pp.Group(pp.delimitedList( _TARGET, ',' )) \
+                    .setName('target set')
 
-    :param obj: The data structure of basic types to query, as returned by the `json` module
-    :type obj: bool, int, float, str, tuple, list, dict, None
-    :param expr: A JSONPath expression to evaluate
-    :type expr: str
-    :param result_type: The type of data to return: `RESULT_TYPE_VALUE`, `RESULT_TYPE_PATH` or 
-        `RESULT_TYPE_BOTH`. Returns values by default.
-    :type result_type: str
-    :param always_return_list: The JSONPath reference implementation returns the value ``false``
-        in the case of no matching results, and this is the default behaviour. However an empty
-        list (perhaps a more Pythonic alternative) can be returned instead by setting this 
-        parameter `True`.
-    :type always_return_list: bool
-    :return: List of results. For values (the default) or paths, each result will be a string.
-        If both are requested, each result will be a 2-tuple containing the value followed by
-        the path.
-    :rtype: list
-    :raises ParseError: if the given string does not represent a valid JSONPath or contains
-        an invalid Python script expression 
-    :example:
+    _IMPLICIT_CHILD = _TARGET_SET \
+                    .setResultsName('targets').setParseAction(PChild)
 
-    >>> from jsonpyth import jsonpath
-    >>> data = {
-    ...     "dogs": [
-    ...         { "name": "Fido", "age": 6 },
-    ...         { "name": "Gruff", "age": 8 }
-    ...     ],
-    ...     "cats": [
-    ...         { "name": "Alfie", "age": 3 },
-    ...         { "name": "Bubbles", "age": 5 },
-    ...     ]
+    _CHILD = ( pp.Literal(".") + _TARGET_SET.setResultsName('targets') 
+                | pp.Literal('[') + _TARGET_SET.setResultsName('targets') + ']' ) \
+                    .setParseAction(PChild).setName('child step')
+
+    _RECURSIVE = ( pp.Literal("..") + _TARGET_SET.setResultsName('targets') ) \
+                    .setParseAction(PRecursive).setName('recurse step')
+
+    _STEP = _CHILD | _RECURSIVE
+
+    _PATH = ( ( _IMPLICIT_CHILD | _STEP ) + _STEP*(0,) ) \
+                    .setName('path')
+
+    # Safe filter dialect: JSONPath filter expressions, compiled into functions without `eval`
+
+    _SAFE_STEP = pp.Forward()
+
+    _SAFE_TARGET = pp.Forward()
+
+    _SAFE_TARGET_SET = pp.Group(pp.delimitedList( _SAFE_TARGET, ',' )) \
+                    .setName('target set')
+
+    _SAFE_QUERY = ( ( pp.Literal('@') | pp.Literal('$') ) + pp.Group(_SAFE_STEP*(0,)) ) \
+                    .setParseAction(_safe_query_action).setName('query')
+
+    # queries within filters have one target after a dot, so that they may be followed by a comma
+    _SAFE_QUERY_STEP = ( ( pp.Literal("..") + pp.Group( _WILDCARD | _PROPERTY ).setResultsName('targets')
+                            | pp.Literal("..") + '[' + _SAFE_TARGET_SET.setResultsName('targets') + ']' )
+                                .setParseAction(PRecursive)
+                        | ( pp.Literal(".") + pp.Group( _WILDCARD | _PROPERTY ).setResultsName('targets')
+                            | pp.Literal('[') + _SAFE_TARGET_SET.setResultsName('targets') + ']' )
+                                .setParseAction(PChild) ) \
+                    .setName('query step')
+
+    _SAFE_STEP <<= _SAFE_QUERY_STEP
+
+    _SAFE_NUMBER = pp.Regex(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?') \
+                    .setParseAction(lambda t: float(t[0]) if any(c in t[0] for c in '.eE') 
+                                              else int(t[0])) \
+                    .setName('number')
+
+    _SAFE_STRING = ( pp.QuotedString('"','\\',None,False,True)
+                        | pp.QuotedString("'",'\\',None,False,True) ) \
+                    .setName('string')
+
+    _SAFE_CONSTANT = ( pp.Keyword('true').setParseAction(lambda: True)
+                        | pp.Keyword('false').setParseAction(lambda: False)
+                        | pp.Keyword('null').setParseAction(lambda: [None]) ) \
+                    .setName('constant')
+
+    _SAFE_LITERAL = ( _SAFE_NUMBER | _SAFE_STRING | _SAFE_CONSTANT ) \
+                    .setName('literal')
+
+    _SAFE_LIST = ( pp.Suppress('[') + pp.Optional(pp.delimitedList(_SAFE_LITERAL, ',')) 
+                        + pp.Suppress(']') ) \
+                    .setParseAction(lambda t: [list(t)]).setName('list')
+
+    _SAFE_COMPARABLE = _SAFE_LITERAL | _SAFE_QUERY
+
+    _SAFE_COMPARISON = ( _SAFE_COMPARABLE + pp.oneOf('== != <= >= < >') + _SAFE_COMPARABLE ) \
+                    .setParseAction(_safe_comparison_action).setName('comparison')
+
+    _SAFE_MEMBERSHIP = ( _SAFE_COMPARABLE + pp.Keyword('in') + ( _SAFE_LIST | _SAFE_QUERY ) ) \
+                    .setParseAction(_safe_membership_action).setName('membership test')
+
+    _SAFE_EXISTENCE = _SAFE_QUERY.copy() \
+                    .setParseAction(_safe_query_action, lambda t: t[0].exists()).setName('existence test')
+
+    _SAFE_LOGICAL = pp.Forward()
+
+    _SAFE_BASIC = pp.Forward()
+
+    _SAFE_BASIC <<= ( pp.Suppress('(') + _SAFE_LOGICAL + pp.Suppress(')')
+                        | ( pp.Suppress('!') + _SAFE_BASIC ).setParseAction(lambda t: _safe_not(t[0]))
+                        | _SAFE_COMPARISON
+                        | _SAFE_MEMBERSHIP
+                        | _SAFE_EXISTENCE ) \
+                    .setName('test')
+
+    _SAFE_AND = pp.delimitedList( _SAFE_BASIC, '&&' ) \
+                    .setParseAction(lambda t: functools.reduce(_safe_and, t)).setName('logical and')
+
+    _SAFE_LOGICAL <<= pp.delimitedList( _SAFE_AND, '||' ) \
+                    .setParseAction(lambda t: functools.reduce(_safe_or, t)).setName('logical or')
+
+    _SAFE_FILTER = ( pp.Suppress('?') + _loc_marker() + _SAFE_LOGICAL + _loc_marker() ) \
+                    .setParseAction(_safe_filter_action).setName('filter')
+
+    _SAFE_TARGET <<= ( _ROOT | _CURRENT | _WILDCARD | _PROPERTY | _SLICE | _SAFE_FILTER ) \
+                    .setName('target')
+
+    _SAFE_IMPLICIT_CHILD = _SAFE_TARGET_SET.copy() \
+                    .setResultsName('targets').setParseAction(PChild)
+
+    _SAFE_CHILD = ( pp.Literal(".") + _SAFE_TARGET_SET.setResultsName('targets') 
+                        | pp.Literal('[') + _SAFE_TARGET_SET.setResultsName('targets') + ']' ) \
+                    .setParseAction(PChild).setName('child step')
+
+    _SAFE_RECURSIVE = ( pp.Literal("..") + '[' + _SAFE_TARGET_SET.setResultsName('targets') + ']'
+                        | pp.Literal("..") + _SAFE_TARGET_SET.setResultsName('targets') ) \
+                    .setParseAction(PRecursive).setName('recurse step')
+
+    _SAFE_PATH_STEP = _SAFE_CHILD | _SAFE_RECURSIVE
+
+    _SAFE_PATH = ( ( _SAFE_IMPLICIT_CHILD | _SAFE_PATH_STEP ) + _SAFE_PATH_STEP*(0,) ) \
+                    .setName('path')
+
+    return { DIALECT_PYTHON: _PATH, DIALECT_SAFE: _SAFE_PATH }
+
+
+# Hand-written parser for both dialects. It builds the same objects as the pyparsing grammars
+# above, and mirrors how they report errors, so that syntax errors are reported at the same
+# positions. Where a choice of alternatives fails, the error is from the alternative which got
+# furthest, or names the whole choice if none of them got past its first character.
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_INTEGER_DIGITS_RE = re.compile(r'[0-9]+')
+_SAFE_NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?')
+_SAFE_COMPARISON_RE = re.compile(r'==|!=|<=|>=|<|>')
+_WHITESPACE_CHARS = frozenset(' \t\n\r')
+_NAME_START_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_')
+_KEYWORD_CHARS = _NAME_START_CHARS | frozenset('0123456789$')
+
+
+def _quoted_re(start, end):
+    return re.compile(r'{}(?:\\.|[^{}\n\r\\])*{}'.format(re.escape(start), re.escape(end), 
+                                                           re.escape(end)))
+
+
+_QUOTED_RES = {
+    '"': _quoted_re('"', '"'),
+    "'": _quoted_re("'", "'"),
+    '(': _quoted_re('(', ')'),
+    '?(': _quoted_re('?(', ')'),
+}
+
+# pyparsing's quoted strings also convert these numeric escapes. Its pattern is reproduced as 
+# it behaves (the repetition counts are read as literal digits), so both parsers agree on names.
+_UNQUOTE_RE = re.compile(r'(\\[tnfr])|(\\[0-7]3|\\0|\\x[0-9a-fA-F]2|\\u[0-9a-fA-F]4)'
+                         r'|\\(.)|(\n|.)')
+
+_WHITESPACE_ESCAPES = { 't': '\t', 'n': '\n', 'f': '\f', 'r': '\r' }
+
+
+def _unescape(match):
+    whitespace, numeric, escaped, char = match.groups()
+    if whitespace:
+        return _WHITESPACE_ESCAPES[whitespace[1]]
+    elif numeric:
+        if numeric == '\\0':
+            return '\0'
+        elif numeric[1] in 'xu':
+            return chr(int(numeric[2:], 16))
+        return numeric[1:]
+    elif escaped is not None:
+        return escaped
+    return char
+
+
+class _ParseFailure(Exception):
+
+    def __init__(self, loc, msg, fatal=False):
+        super().__init__(msg)
+        self.loc = loc
+        self.msg = msg
+        self.fatal = fatal
+
+
+class _Parser:
+    """Recursive descent parser for a JSONPath expression. Each method parses one element of
+    the grammar at the given position, returning the parsed value and the position after it, or
+    raising `_ParseFailure` if the element isn't there. Whitespace before each token is skipped.
+    """
+
+    def __init__(self, string, dialect):
+        # pyparsing expands tabs before parsing, and error positions are counted accordingly
+        self.string = string.expandtabs()
+        self.length = len(self.string)
+        self.safe = dialect == DIALECT_SAFE
+
+    def position_of(self, loc):
+        """Returns the line of text containing the given position, and the column number of the
+        position within it"""
+        string = self.string
+        if 0 < loc < len(string) and string[loc-1] == '\n':
+            col = 1
+        else:
+            col = loc - string.rfind('\n', 0, loc)
+        line_end = string.find('\n', loc)
+        line = string[string.rfind('\n', 0, loc)+1 : line_end if line_end >= 0 else None]
+        return line, col
+
+    def skip(self, loc):
+        if loc < self.length and self.string[loc] not in _WHITESPACE_CHARS:
+            return loc
+        return _WHITESPACE_RE.match(self.string, loc).end()
+
+    def char_at(self, loc):
+        return self.string[loc:loc+1]
+
+    def expect(self, loc, token):
+        loc = self.skip(loc)
+        if not self.string.startswith(token, loc):
+            raise _ParseFailure(loc, "Expected '{}'".format(token))
+        return loc + len(token)
+
+    def first_of(self, loc, name, alternatives):
+        """Returns the result of the first of the given parsing methods which succeeds"""
+        start = self.skip(loc)
+        furthest = None
+        for alternative in alternatives:
+            try:
+                return alternative(loc)
+            except _ParseFailure as failure:
+                if failure.fatal:
+                    raise
+                if furthest is None or failure.loc > furthest.loc:
+                    furthest = failure
+        if furthest.loc == start:
+            furthest.msg = 'Expected ' + name
+        raise furthest
+
+    def path(self):
+        steps = []
+        step, loc = self.first_of(0, '{target set | child step | recurse step}', 
+                                  (self.implicit_child, self.child, self.recursive))
+        steps.append(step)
+        while True:
+            start = self.skip(loc)
+            if self.string.startswith('..', start):
+                alternative = self.recursive
+            elif self.char_at(start) in ('.', '['):
+                alternative = self.child
+            else:
+                break
+            try:
+                step, loc = alternative(start)
+            except _ParseFailure as failure:
+                if failure.fatal:
+                    raise
+                break
+            steps.append(step)
+        loc = self.skip(loc)
+        if loc < self.length:
+            raise _ParseFailure(loc, 'Expected end of text')
+        return steps
+
+    def implicit_child(self, loc):
+        targets, loc = self.target_set(loc)
+        return PChild(targets=targets), loc
+
+    def child(self, loc):
+        start = self.skip(loc)
+        char = self.char_at(start)
+        if char == '.':
+            targets, loc = self.target_set(start + 1)
+        elif char == '[':
+            targets, loc = self.target_set(start + 1)
+            loc = self.expect(loc, ']')
+        else:
+            raise _ParseFailure(start, 'Expected child step')
+        return PChild(targets=targets), loc
+
+    def recursive(self, loc):
+        start = self.skip(loc)
+        if not self.string.startswith('..', start):
+            raise _ParseFailure(start, "Expected '..'")
+        if not self.safe:
+            targets, loc = self.target_set(start + 2)
+            return PRecursive(targets=targets), loc
+        bracket = self.skip(start + 2)
+        if self.char_at(bracket) == '[':
+            targets, loc = self.target_set(bracket + 1)
+            loc = self.expect(loc, ']')
+            return PRecursive(targets=targets), loc
+        try:
+            targets, loc = self.target_set(start + 2)
+        except _ParseFailure as failure:
+            # the bracketed alternative is tried first, so wins a tie
+            if not failure.fatal and failure.loc == bracket:
+                failure.msg = "Expected '['"
+            raise
+        return PRecursive(targets=targets), loc
+
+    def target_set(self, loc):
+        try:
+            target, loc = self.target(loc)
+        except _ParseFailure as failure:
+            if not failure.fatal:
+                failure.msg = 'Expected target set'
+            raise
+        targets = [target]
+        while True:
+            start = self.skip(loc)
+            if self.char_at(start) != ',':
+                break
+            try:
+                target, loc = self.target(start + 1)
+            except _ParseFailure as failure:
+                if failure.fatal:
+                    raise
+                break
+            targets.append(target)
+        return targets, loc
+
+    def target(self, loc):
+        start = self.skip(loc)
+        char = self.char_at(start)
+        try:
+            if char == '$':
+                return PRoot(), start + 1
+            elif char == '@':
+                return PCurrent(), start + 1
+            elif char == '*':
+                return PWildcard(), start + 1
+            elif char in ('"', "'") or char in _NAME_START_CHARS:
+                return self.property(start)
+            elif char in ('-', ':') or '0' <= char <= '9':
+                return self.slice(start)
+            elif char == '(' and not self.safe:
+                code, loc = self.quoted(start, '(', 'script expression')
+                return PExpression(code=code), loc
+            elif char == '?' and not self.safe:
+                code, loc = self.quoted(start, '?(', 'script filter')
+                return PFilter(code=code), loc
+            elif char == '?':
+                return self.safe_filter(start)
+        except _ParseFailure as failure:
+            if failure.fatal or failure.loc > start:
+                raise
+        raise _ParseFailure(start, 'Expected target')
+
+    def property(self, loc):
+        start = self.skip(loc)
+        match = _NAME_RE.match(self.string, start)
+        if match is not None:
+            return PProperty(name=match.group()), match.end()
+        char = self.char_at(start)
+        if char not in ('"', "'"):
+            raise _ParseFailure(start, 'Expected property')
+        name, loc = self.quoted(start, char, 'property')
+        return PProperty(name=name), loc
+
+    def quoted(self, loc, quote, name):
+        match = _QUOTED_RES[quote].match(self.string, loc)
+        if match is None:
+            raise _ParseFailure(loc, 'Expected ' + name)
+        content = match.group()[len(quote):-1]
+        if '\\' in content:
+            content = _UNQUOTE_RE.sub(_unescape, content)
+        return content, match.end()
+
+    def integer(self, loc):
+        start = self.skip(loc)
+        digits = start + 1 if self.char_at(start) == '-' else start
+        match = _INTEGER_DIGITS_RE.match(self.string, digits)
+        if match is None:
+            raise _ParseFailure(digits, 'Expected integer')
+        return int(self.string[start:match.end()]), match.end()
+
+    def slice(self, loc):
+        start = loc = self.skip(loc)
+        values = {}
+        try:
+            try:
+                values['start'], loc = self.integer(start)
+            except _ParseFailure:
+                pass
+            loc = self.expect(loc, ':')
+            try:
+                values['end'], loc = self.integer(loc)
+            except _ParseFailure:
+                pass
+            try:
+                loc = self.expect(loc, ':')
+            except _ParseFailure:
+                pass
+            else:
+                try:
+                    values['step'], loc = self.integer(loc)
+                except _ParseFailure:
+                    pass
+            return PSlice(**values), loc
+        except _ParseFailure as failure:
+            range_failure = failure
+        try:
+            index, loc = self.integer(start)
+        except _ParseFailure as failure:
+            furthest = failure if failure.loc > range_failure.loc else range_failure
+            if furthest.loc == start:
+                furthest.msg = 'Expected slice'
+            raise furthest
+        return PSlice(index=index), loc
+
+    # safe dialect filters
+
+    def safe_filter(self, loc):
+        start = self.skip(loc) + 1
+        predicate, loc = self.logical(start)
+        code = self.string[start:loc].strip()
+        return PSafeFilter(code, predicate, predicate.uses_root), loc
+
+    def logical(self, loc):
+        return self.operands(loc, '||', self.conjunction, _safe_or, 'logical or')
+
+    def conjunction(self, loc):
+        return self.operands(loc, '&&', self.test, _safe_and, 'logical and')
+
+    def operands(self, loc, operator, operand, combine, name):
+        try:
+            result, loc = operand(loc)
+        except _ParseFailure as failure:
+            if not failure.fatal:
+                failure.msg = 'Expected ' + name
+            raise
+        while True:
+            start = self.skip(loc)
+            if not self.string.startswith(operator, start):
+                break
+            try:
+                right, loc = operand(start + len(operator))
+            except _ParseFailure as failure:
+                if failure.fatal:
+                    raise
+                break
+            result = combine(result, right)
+        return result, loc
+
+    def test(self, loc):
+        start = self.skip(loc)
+        char = self.char_at(start)
+        if char == '(':
+            result, loc = self.logical(start + 1)
+            return result, self.expect(loc, ')')
+        elif char == '!':
+            result, loc = self.test(start + 1)
+            return _safe_not(result), loc
+        try:
+            left, loc = self.comparable(start)
+        except _ParseFailure as failure:
+            if not failure.fatal and failure.loc == start:
+                failure.msg = 'Expected test'
+            raise
+        # the comparison, membership test and existence test alternatives all begin with the
+        # same operand, so it is only parsed once
+        failures = []
+        op_start = self.skip(loc)
+        match = _SAFE_COMPARISON_RE.match(self.string, op_start)
+        if match is not None:
+            try:
+                right, end = self.comparable(match.end())
+            except _ParseFailure as failure:
+                if failure.fatal:
+                    raise
+                failures.append(failure)
+            else:
+                self.check_singular(start, (left, right), 'comparison')
+                return _safe_comparison(left, match.group(), right), end
+        else:
+            failures.append(_ParseFailure(op_start, "Expected '==' | '!=' | '<=' | '>=' | '<' | '>'"))
+        try:
+            end = self.keyword(loc, 'in')
+            right, end = self.membership_operand(end)
+        except _ParseFailure as failure:
+            if failure.fatal:
+                raise
+            failures.append(failure)
+        else:
+            self.check_singular(start, (left, right), 'membership test')
+            return _safe_membership(left, right), end
+        if isinstance(left, _SafeQuery):
+            return left.exists(), loc
+        furthest = failures[0] if failures[0].loc >= failures[1].loc else failures[1]
+        raise furthest
+
+    def check_singular(self, loc, operands, name):
+        for operand in operands:
+            if isinstance(operand, _SafeQuery) and operand.keys is None:
+                raise _ParseFailure(loc, 'Non-singular query in ' + name, True)
+
+    def keyword(self, loc, word):
+        start = self.skip(loc)
+        end = start + len(word)
+        if not self.string.startswith(word, start):
+            raise _ParseFailure(start, "Expected Keyword '{}'".format(word))
+        if start > 0 and self.string[start-1] in _KEYWORD_CHARS:
+            raise _ParseFailure(start - 1, "Expected Keyword '{}', keyword was immediately "
+                                           "preceded by keyword character".format(word))
+        if end < self.length and self.string[end] in _KEYWORD_CHARS:
+            raise _ParseFailure(end, "Expected Keyword '{}', keyword was immediately "
+                                     "followed by keyword character".format(word))
+        return end
+
+    def comparable(self, loc):
+        start = self.skip(loc)
+        if self.char_at(start) in ('@', '$'):
+            return self.query(start)
+        try:
+            return self.literal(start)
+        except _ParseFailure as failure:
+            if not failure.fatal and failure.loc == start:
+                failure.msg = 'Expected {literal | query}'
+            raise
+
+    def membership_operand(self, loc):
+        start = self.skip(loc)
+        char = self.char_at(start)
+        if char in ('@', '$'):
+            return self.query(start)
+        elif char != '[':
+            raise _ParseFailure(start, 'Expected {list | query}')
+        values = []
+        try:
+            value, loc = self.literal(start + 1)
+        except _ParseFailure:
+            loc = start + 1
+        else:
+            values.append(value)
+            while True:
+                comma = self.skip(loc)
+                if self.char_at(comma) != ',':
+                    break
+                try:
+                    value, loc = self.literal(comma + 1)
+                except _ParseFailure:
+                    break
+                values.append(value)
+        return values, self.expect(loc, ']')
+
+    def literal(self, loc):
+        start = self.skip(loc)
+        match = _SAFE_NUMBER_RE.match(self.string, start)
+        if match is not None:
+            text = match.group()
+            return float(text) if any(c in text for c in '.eE') else int(text), match.end()
+        char = self.char_at(start)
+        if char in ('"', "'"):
+            try:
+                return self.quoted(start, char, 'string')
+            except _ParseFailure:
+                pass
+        for word, value in (('true', True), ('false', False), ('null', None)):
+            if self.string.startswith(word, start):
+                try:
+                    return value, self.keyword(start, word)
+                except _ParseFailure as failure:
+                    # a keyword preceded by a keyword character fails before this position,
+                    # so the other constants' failures here are reported instead
+                    if failure.loc > start:
+                        raise
+        raise _ParseFailure(start, 'Expected literal')
+
+    def query(self, loc):
+        start = self.skip(loc)
+        char = self.char_at(start)
+        if char not in ('@', '$'):
+            raise _ParseFailure(start, "Expected {'@' | '$'}")
+        steps = []
+        loc = start + 1
+        while True:
+            step_start = self.skip(loc)
+            if self.string.startswith('..', step_start):
+                kind, step_start = PRecursive, self.skip(step_start + 2)
+                dotted = self.char_at(step_start) != '['
+            elif self.char_at(step_start) == '.':
+                kind, dotted, step_start = PChild, True, step_start + 1
+            elif self.char_at(step_start) == '[':
+                kind, dotted = PChild, False
+            else:
+                break
+            try:
+                if dotted:
+                    targets, end = self.dotted_target(step_start)
+                else:
+                    targets, end = self.target_set(step_start + 1)
+                    end = self.expect(end, ']')
+            except _ParseFailure as failure:
+                if failure.fatal:
+                    raise
+                break
+            steps.append(kind(targets=targets))
+            loc = end
+        return _SafeQuery(char == '$', steps), loc
+
+    def dotted_target(self, loc):
+        """Parses the wildcard or property after a dot in a filter query, which unlike in a path
+        is a single target, so that the query may be followed by a comma"""
+        start = self.skip(loc)
+        if self.char_at(start) == '*':
+            return [PWildcard()], start + 1
+        target, loc = self.property(start)
+        return [target], loc
+
+
+RESULT_TYPE_VALUE = "VALUE"
+RESULT_TYPE_PATH = "PATH"
+RESULT_TYPE_BOTH = "BOTH"
+
+DIALECT_PYTHON = "python"
+DIALECT_SAFE = "safe"
+_DIALECTS = (DIALECT_PYTHON, DIALECT_SAFE)
+
+PARSER_NATIVE = "native"
+PARSER_PYPARSING = "pyparsing"
+_PARSERS = (PARSER_NATIVE, PARSER_PYPARSING)
+
+ENGINE_PYTHON = "python"
+ENGINE_NUMPY = "numpy"
+_ENGINES = (ENGINE_PYTHON, ENGINE_NUMPY)
+
+BACKEND_INTERPRETER = "interpreter"
+BACKEND_CODEGEN = "codegen"
+_BACKENDS = (BACKEND_INTERPRETER, BACKEND_CODEGEN)
+
+DECODER_AUTO = "auto"
+DECODER_ORJSON = "orjson"
+DECODER_MSGSPEC = "msgspec"
+DECODER_UJSON = "ujson"
+DECODER_JSON = "json"
+
+# the fewest child nodes for which the numpy engine evaluates a filter as arrays
+VECTORISE_MIN_NODES = 16
+
+# the fewest child nodes of a wildcard, filter or recursive step which are split across an
+# evaluation's executor
+PARALLEL_MIN_NODES = 4096
+
+# the number of child nodes evaluated by each task when they are split across an executor
+PARALLEL_CHUNK_SIZE = 1024
+
+STREAM_CHUNK_SIZE = 65536
+
+# the number of nodes evaluated between giving other tasks the chance to run, in async methods
+ASYNC_YIELD_EVERY = 1000
+
+
+def parse(string, dialect=DIALECT_PYTHON, parser=PARSER_NATIVE):
+    """Returns the parse tree from a string representing a JSONPath expression
+
+    :param string: The JSONPath expression to parse
+    :type string: str
+    :param dialect: The language of filters and script expressions in the path: 
+        `DIALECT_PYTHON` (the default) for Python scripts, or `DIALECT_SAFE` for JSONPath
+        filter expressions, which are not evaluated as Python.
+    :type dialect: str
+    :param parser: `PARSER_NATIVE` (the default) for the built-in parser, or `PARSER_PYPARSING`
+        for the original pyparsing grammar, which requires the pyparsing package. Both produce
+        the same parse tree and report errors at the same positions.
+    :type parser: str
+    :return: Nested objects representing the JSONPath (root will be a list)
+    :rtype: list
+    :raises JsonPathSyntaxError: if the given string does not represent a valid JSONPath 
+        expression. Note that Python script expressions are compiled as the path is parsed,
+        but invalid scripts are not reported until the path is compiled or evaluated.
+    """
+    if dialect not in _DIALECTS:
+        raise ValueError('Unknown dialect: {}'.format(dialect))
+    if parser not in _PARSERS:
+        raise ValueError('Unknown parser: {}'.format(parser))
+    if parser == PARSER_PYPARSING:
+        pp = _pyparsing()
+        try:
+            return list(_pyparsing_grammars()[dialect].parseString(string, True))
+        except pp.ParseBaseException as e:
+            raise JsonPathSyntaxError(e.line, e.col, e.msg) from e
+    native = _Parser(string, dialect)
+    try:
+        return native.path()
+    except _ParseFailure as e:
+        line, col = native.position_of(e.loc)
+        raise JsonPathSyntaxError(line, col, e.msg) from None
+
+
+def _constant_key(expression):
+    """Returns the property name or index which a script expression always evaluates to, or
+    None if it refers to the current or root node, or isn't made up only of literals"""
+    import ast
+    if expression.code_func is None or expression.TEMP_CURR_VAR in expression.code_source \
+            or expression.TEMP_ROOT_VAR in expression.code_source:
+        return None
+    for node in ast.walk(ast.parse(expression.code_source.strip(), mode='eval')):
+        if not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.operator, ast.unaryop)) \
+                and type(node).__name__ not in ('Constant', 'Num', 'Str'):
+            return None
+    try:
+        key = expression.code_func(None, None)
+        if isinstance(key, str):
+            return key
+        elif isinstance(key, (int, float)) and not isinstance(key, bool):
+            return int(key)
+    except Exception:
+        pass
+    # errors and keys of other types are reported for each node as usual
+    return None
+
+
+def _fold_constants(step):
+    targets = []
+    for targ in step.targets:
+        key = _constant_key(targ) if type(targ) is PExpression else None
+        if isinstance(key, str):
+            targ = PProperty(name=key)
+        elif key is not None:
+            targ = PSlice(index=key)
+        targets.append(targ)
+    if all(new is old for new,old in zip(targets, step.targets)):
+        return step
+    return type(step)(targets=targets)
+
+
+def _chain_key(step):
+    if type(step) is not PChild or len(step.targets) != 1:
+        return None
+    targ = step.targets[0]
+    if type(targ) is PProperty:
+        return targ.name
+    elif type(targ) is PSlice and getattr(targ, 'index', None) is not None:
+        return targ.index
+    return None
+
+
+def optimise(steps):
+    """Returns an equivalent JSONPath representation which is faster to evaluate.
+
+    Script expressions which don't refer to `@` or `$` are evaluated once, in place of every
+    time they are applied. Steps selecting the current node are removed, and runs of steps 
+    selecting a single property or index, optionally after a wildcard, are fused into one
+    `PChain` step. The results are the same as for the original steps.
+
+    :param steps: Nested objects representing the JSONPath, as returned by `parse`
+    :type steps: list
+    :return: Nested objects representing the optimised JSONPath
+    :rtype: list
+    """
+    result = []
+    for step in steps:
+        if type(step) in (PChild, PRecursive):
+            step = _fold_constants(step)
+        if type(step) is PChild and len(step.targets) == 1 and type(step.targets[0]) is PCurrent:
+            continue
+        key = _chain_key(step)
+        if key is not None and len(result) > 0 and type(result[-1]) is PChain:
+            result[-1] = PChain(wildcard=result[-1].wildcard, keys=result[-1].keys + (key,))
+        elif key is not None:
+            result.append(PChain(wildcard=False, keys=(key,)))
+        elif type(step) is PChild and len(step.targets) == 1 and type(step.targets[0]) is PWildcard:
+            result.append(PChain(wildcard=True, keys=()))
+        else:
+            result.append(step)
+    # a wildcard on its own is no faster as a chain
+    return [ PChild(targets=[PWildcard()]) if type(step) is PChain and len(step.keys) == 0 
+             else step for step in result ]
+
+
+class _CodeGenerator:
+    """Generates the source of Python functions evaluating a JSONPath representation with 
+    nested loops, for the `BACKEND_CODEGEN` backend.
+
+    Two functions are generated, ``_jp_nodes`` and ``_jp_values``, each taking the data 
+    structure and returning an iterator of the matching nodes, or of their values only. 
+    Consecutive steps selecting a single target are nested in the same loop, with filter and 
+    expression scripts inlined. Steps applying several targets, or searching recursively, are 
+    each generated as a separate generator function.
+    """
+
+    TARGET_TYPES = (PCurrent, PWildcard, PProperty, PSlice, PExpression, PFilter, PSafeFilter)
+
+    def __init__(self, steps, order=ORDER_SORTED):
+        self.steps = list(steps)
+        self.order = order
+        self.lines = []
+        self.constants = { '_jp_Node': _Node, '_jp_logging': logging, 
+                           '_jp_warning_enabled': _warning_enabled, 
+                           '_jp_mapping': _MAPPING_TYPES, '_jp_sequence': _SEQUENCE_TYPES,
+                           '_jp_number': _NUMBER_TYPES, '_jp_as_mapping': _as_mapping }
+        self.depth = 0
+        self.count = 0
+        self.nodes = False
+
+    @classmethod
+    def supports(cls, steps):
+        for step in steps:
+            if type(step) is PChain:
+                continue
+            if type(step) not in (PChild, PRecursive):
+                return False
+            for targ in step.targets:
+                # a recursive root target matches once for every node searched, leaves included
+                if not (type(targ) in cls.TARGET_TYPES or type(targ) is PRoot and type(step) is PChild):
+                    return False
+        return True
+
+    def generate(self):
+        for nodes in (True, False):
+            self.function(nodes)
+        return '\n'.join(self.lines) + '\n'
+
+    def line(self, text):
+        self.lines.append('    ' * self.depth + text)
+
+    def constant(self, value):
+        name = '_jp_const{}'.format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def result(self, item):
+        return '_jp_{}{}'.format('n' if self.nodes else 'v', item)
+
+    def root(self):
+        return '_jp_Node(_jp_data)' if self.nodes else '_jp_data'
+
+    def function(self, nodes):
+        self.nodes = nodes
+        name = '_jp_nodes' if nodes else '_jp_values'
+        stages = []
+        segment = []
+        for step in self.steps + [None]:
+            if type(step) is PChain or type(step) is PChild and len(step.targets) == 1 \
+                    and type(step.targets[0]) is not PRoot:
+                segment.append(step)
+                continue
+            if len(segment) > 0:
+                stages.append(self.segment_stage(segment, '{}_{}'.format(name, len(stages))))
+                segment = []
+            if step is None:
+                break
+            elif type(step) is PChild and len(step.targets) == 1:
+                # the root step ignores the nodes before it, so they are never evaluated
+                stages = [None]
+            elif type(step) is PChild:
+                stages.append(self.multiple_stage(step, '{}_{}'.format(name, len(stages))))
+            else:
+                stages.append(self.recursive_stage(step, '{}_{}'.format(name, len(stages))))
+        self.line('def {}(_jp_data):'.format(name))
+        self.depth += 1
+        self.line('_jp_warning = _jp_warning_enabled()')
+        self.line('_jp_items = ({},)'.format(self.root()))
+        for stage in stages:
+            if stage is not None:
+                self.line('_jp_items = {}(_jp_items, _jp_data, _jp_warning)'.format(stage))
+        self.line('return iter(_jp_items)')
+        self.depth -= 1
+        self.line('')
+
+    def stage(self, name):
+        self.line('def {}(_jp_in, _jp_data, _jp_warning):'.format(name))
+        self.depth += 1
+        self.line('__root = _jp_data')
+
+    def end_stage(self, name):
+        self.depth = 0
+        self.line('')
+        return name
+
+    def loop(self, iterable):
+        self.count += 1
+        item = self.count
+        if self.nodes:
+            self.line('for _jp_n{} in {}:'.format(item, iterable))
+            self.line('    _jp_v{0} = _jp_n{0}.value'.format(item))
+        else:
+            self.line('for _jp_v{} in {}:'.format(item, iterable))
+        self.depth += 1
+        return item
+
+    def yield_item(self, item):
+        self.line('yield {}'.format(self.result(item)))
+
+    def segment_stage(self, steps, name):
+        self.stage(name)
+        self.steps_code(steps, self.loop('_jp_in'))
+        return self.end_stage(name)
+
+    def steps_code(self, steps, item):
+        if len(steps) == 0:
+            self.yield_item(item)
+            return
+        body = lambda child: self.steps_code(steps[1:], child)
+        if type(steps[0]) is PChain:
+            self.chain(steps[0], item, body)
+        else:
+            self.target(steps[0].targets[0], item, body)
+
+    def multiple_stage(self, step, name):
+        self.stage(name)
+        # each target is applied to all of the nodes in turn
+        self.line('_jp_in = list(_jp_in)')
+        for targ in step.targets:
+            if type(targ) is PRoot:
+                self.line('yield {}'.format(self.root()))
+            else:
+                depth = self.depth
+                self.target(targ, self.loop('_jp_in'), self.yield_item)
+                self.depth = depth
+        return self.end_stage(name)
+
+    def recursive_stage(self, step, name):
+        self.stage(name)
+        self.line('_jp_stack = [list(_jp_in)]')
+        self.line('while _jp_stack:')
+        self.depth += 1
+        self.line('_jp_group = _jp_stack.pop()')
+        for targ in step.targets:
+            depth = self.depth
+            self.target(targ, self.loop('_jp_group'), self.yield_item)
+            self.depth = depth
+        # children are pushed in reverse, to be popped in document order
+        self.line('for _jp_parent in reversed(_jp_group):')
+        self.depth += 1
+        insertion = self.order == ORDER_INSERTION
+        if self.nodes:
+            self.line('_jp_o = _jp_parent.value')
+            self.line('if isinstance(_jp_o, _jp_mapping):')
+            self.line('    if type(_jp_o) is not dict:')
+            self.line('        _jp_o = _jp_as_mapping(_jp_o)')
+            if insertion:
+                self.line('    _jp_children = [_jp_Node(_jp_v, _jp_parent, _jp_k) '
+                          'for _jp_k, _jp_v in _jp_o.items()]')
+            else:
+                self.line('    _jp_children = [_jp_Node(_jp_o[_jp_k], _jp_parent, _jp_k) '
+                          'for _jp_k in sorted(_jp_o.keys())]')
+            self.line('elif isinstance(_jp_o, _jp_sequence):')
+            self.line('    _jp_children = [_jp_Node(_jp_v, _jp_parent, _jp_k) '
+                      'for _jp_k, _jp_v in enumerate(_jp_o)]')
+        else:
+            self.line('_jp_o = _jp_parent')
+            self.line('if isinstance(_jp_o, _jp_mapping):')
+            self.line('    if type(_jp_o) is not dict:')
+            self.line('        _jp_o = _jp_as_mapping(_jp_o)')
+            if insertion:
+                self.line('    _jp_children = list(_jp_o.values())')
+            else:
+                self.line('    _jp_children = [_jp_o[_jp_k] for _jp_k in sorted(_jp_o.keys())]')
+            self.line('elif isinstance(_jp_o, _jp_sequence):')
+            self.line('    _jp_children = list(_jp_o)')
+        self.line('else:')
+        self.line('    continue')
+        self.line('if _jp_children:')
+        self.line('    _jp_stack.append(_jp_children)')
+        self.depth -= 2
+        return self.end_stage(name)
+
+    def target(self, targ, item, body):
+        kind = type(targ)
+        if kind is PCurrent:
+            body(item)
+        elif kind is PProperty:
+            self.key(targ.name, item, body)
+        elif kind is PSlice and getattr(targ, 'index', None) is not None:
+            self.key(targ.index, item, body)
+        elif kind is PSlice:
+            bounds = slice(getattr(targ, 'start', None), getattr(targ, 'end', None), 
+                           getattr(targ, 'step', None))
+            self.line('if not isinstance(_jp_v{}, _jp_sequence):'.format(item))
+            self.line('    continue')
+            self.count += 1
+            self.line('for _jp_k{0} in range(*{1}.indices(len(_jp_v{2}))):'.format(
+                self.count, repr(bounds), item))
+            self.depth += 1
+            self.line('_jp_v{0} = _jp_v{1}[_jp_k{0}]'.format(self.count, item))
+            self.child(self.count, item, '_jp_k{}'.format(self.count), body)
+        elif kind is PExpression:
+            self.expression(targ, item, body)
+        else:
+            self.children(item)
+            child = self.count
+            if kind is PSafeFilter:
+                self.line('if not {}(_jp_v{}, _jp_data):'.format(self.constant(targ.code_func), child))
+                self.line('    continue')
+            elif kind is PFilter:
+                self.script('_jp_accept', '__current = _jp_v{}'.format(child), 
+                            'bool(\n{}\n)'.format(targ.code_source), 'filter', targ.code)
+                self.line('if not _jp_accept:')
+                self.line('    continue')
+            self.child(child, item, '_jp_k{}'.format(child), body)
+
+    def key(self, key, item, body):
+        self.count += 1
+        if isinstance(key, str):
+            self.line('if not isinstance(_jp_v{}, _jp_mapping):'.format(item))
+            self.line('    continue')
+            self.line('try:')
+            self.line('    _jp_v{0} = (_jp_v{1} if type(_jp_v{1}) is dict else _jp_as_mapping(_jp_v{1}))[{2}]'
+                      .format(self.count, item, repr(key)))
+            self.line('except KeyError:')
+            self.line('    continue')
+        else:
+            self.line('if not isinstance(_jp_v{0}, _jp_sequence) or not -len(_jp_v{0}) <= {1} < len(_jp_v{0}):'
+                      .format(item, key))
+            self.line('    continue')
+            self.line('_jp_v{} = _jp_v{}[{}]'.format(self.count, item, key))
+        self.child(self.count, item, repr(key), body)
+
+    def chain(self, step, item, body):
+        if step.wildcard:
+            self.children(item)
+            self.child(self.count, item, '_jp_k{}'.format(self.count), lambda child: 
+                       self.keys(step.keys, child, body))
+        else:
+            self.keys(step.keys, item, body)
+
+    def keys(self, keys, item, body):
+        if len(keys) == 0:
+            body(item)
+        else:
+            self.key(keys[0], item, lambda child: self.keys(keys[1:], child, body))
+
+    def children(self, item):
+        """Emits a loop over the children of an item, leaving the loop body open"""
+        self.count += 1
+        self.line('if isinstance(_jp_v{}, _jp_mapping):'.format(item))
+        self.line('    _jp_m = _jp_v{0} if type(_jp_v{0}) is dict else _jp_as_mapping(_jp_v{0})'.format(item))
+        insertion = self.order == ORDER_INSERTION
+        if self.nodes:
+            if insertion:
+                self.line('    _jp_pairs{} = _jp_m.items()'.format(self.count))
+            else:
+                self.line('    _jp_pairs{} = [(_jp_k, _jp_m[_jp_k]) for _jp_k in sorted(_jp_m.keys())]'
+                          .format(self.count))
+            self.line('elif isinstance(_jp_v{}, _jp_sequence):'.format(item))
+            self.line('    _jp_pairs{} = enumerate(_jp_v{})'.format(self.count, item))
+        else:
+            if insertion:
+                self.line('    _jp_pairs{} = _jp_m.values()'.format(self.count))
+            else:
+                self.line('    _jp_pairs{} = [_jp_m[_jp_k] for _jp_k in sorted(_jp_m.keys())]'
+                          .format(self.count))
+            self.line('elif isinstance(_jp_v{}, _jp_sequence):'.format(item))
+            self.line('    _jp_pairs{} = _jp_v{}'.format(self.count, item))
+        self.line('else:')
+        self.line('    continue')
+        if self.nodes:
+            self.line('for _jp_k{0}, _jp_v{0} in _jp_pairs{0}:'.format(self.count))
+        else:
+            self.line('for _jp_v{0} in _jp_pairs{0}:'.format(self.count))
+        self.depth += 1
+
+    def child(self, child, parent, key, body):
+        if self.nodes:
+            self.line('_jp_n{} = _jp_Node(_jp_v{}, _jp_n{}, {})'.format(child, child, parent, key))
+        body(child)
+
+    def script(self, variable, setup, expression, kind, code):
+        self.line(setup)
+        self.line('try:')
+        self.line('    {} = ({})'.format(variable, expression))
+        self.line('except SyntaxError:')
+        self.line('    raise')
+        self.line('except Exception as _jp_e:')
+        self.line('    if _jp_warning:')
+        self.line('        _jp_logging.warning(\'{{}} evaluating python {} script "{{}}": {{}}\''
+                  '.format(type(_jp_e).__name__, {}, _jp_e))'.format(kind, self.constant(code)))
+        self.line('    continue')
+
+    def expression(self, targ, item, body):
+        self.script('_jp_key', '__current = _jp_v{}'.format(item), 
+                    '\n{}\n'.format(targ.code_source), 'expression', targ.code)
+        self.count += 1
+        child = self.count
+        self.line('if isinstance(_jp_v{}, _jp_sequence) and isinstance(_jp_key, _jp_number) '
+                  'and not isinstance(_jp_key, bool):'.format(item))
+        self.line('    _jp_k{} = int(_jp_key)'.format(child))
+        self.line('    try:')
+        self.line('        _jp_v{} = _jp_v{}[_jp_k{}]'.format(child, item, child))
+        self.line('    except IndexError:')
+        self.line('        continue')
+        self.line('elif isinstance(_jp_v{}, _jp_mapping) and isinstance(_jp_key, str):'.format(item))
+        self.line('    _jp_k{} = str(_jp_key)'.format(child))
+        self.line('    try:')
+        self.line('        _jp_v{} = _jp_as_mapping(_jp_v{})[_jp_k{}]'.format(child, item, child))
+        self.line('    except KeyError:')
+        self.line('        continue')
+        self.line('else:')
+        self.line('    continue')
+        self.child(child, item, '_jp_k{}'.format(child), body)
+
+
+def evaluate(data, steps, diagnostics=None, engine=ENGINE_PYTHON, index=None, executor=None,
+             decoder=None, order=ORDER_SORTED):
+    """Applies a JSONPath representation to a data structure and returns the matching nodes
+
+    :param data: The data structure of basic types to query, as returned by the `json` module
+    :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+        numpy.ndarray, LazyDocument, bytes
+    :param steps: The JSONPath representation, as returned by the `parse` function
+    :type steps: list
+    :param diagnostics: Optional collector for counts of the nodes each step passed over
+    :type diagnostics: Diagnostics
+    :param engine: The engine used to evaluate filters: `ENGINE_PYTHON` (the default) or 
+        `ENGINE_NUMPY`, which requires the numpy package
+    :type engine: str
+    :param index: Optional index of the data, used to answer recursive steps
+    :type index: DocumentIndex
+    :param executor: Optional thread pool, such as a `concurrent.futures.ThreadPoolExecutor`, 
+        across which the large sets of child nodes of wildcard, filter and recursive steps 
+        are split. See `PARALLEL_MIN_NODES`.
+    :type executor: concurrent.futures.Executor
+    :param decoder: The decoder used if the data is a JSON document as bytes or text, as for 
+        `decode`. Bytes are always decoded, with the fastest decoder installed by default, 
+        while text is only decoded if a decoder is given, as it is otherwise a string value.
+    :type decoder: str
+    :param order: The order in which the properties of objects are visited by wildcard, 
+        filter and recursive steps: `ORDER_SORTED` (the default), by name, or 
+        `ORDER_INSERTION`, the order of the dictionaries' keys, which avoids sorting them
+    :type order: str
+    :return: List of 2-tuples, each containing the value followed by the path.
+    :rtype: list
+    :raises PythonSyntaxError: if the JSONPath includes an invalid Python script expression
+    :raises json.JSONDecodeError: if the data is a document which is not valid JSON
+    """
+    return list(iterate(data, steps, diagnostics, engine, index, executor, decoder, order))
+
+
+def iterate(data, steps, diagnostics=None, engine=ENGINE_PYTHON, index=None, executor=None,
+            decoder=None, order=ORDER_SORTED):
+    """Lazily applies a JSONPath representation to a data structure, yielding matching nodes
+
+    Each step of the path consumes the nodes produced by the previous one as they are 
+    generated, so the data is only traversed as far as is needed to produce the results
+    which are actually consumed.
+
+    :param data: The data structure of basic types to query, as returned by the `json` module
+    :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+        numpy.ndarray, LazyDocument, bytes
+    :param steps: The JSONPath representation, as returned by the `parse` function
+    :type steps: list
+    :param diagnostics: Optional collector for counts of the nodes each step passed over
+    :type diagnostics: Diagnostics
+    :param engine: The engine used to evaluate filters: `ENGINE_PYTHON` (the default) or 
+        `ENGINE_NUMPY`, which requires the numpy package
+    :type engine: str
+    :param index: Optional index of the data, used to answer recursive steps
+    :type index: DocumentIndex
+    :param executor: Optional thread pool, such as a `concurrent.futures.ThreadPoolExecutor`, 
+        across which the large sets of child nodes of wildcard, filter and recursive steps 
+        are split. See `PARALLEL_MIN_NODES`.
+    :type executor: concurrent.futures.Executor
+    :param decoder: The decoder used if the data is a JSON document as bytes or text, as for 
+        `decode`. Bytes are always decoded, with the fastest decoder installed by default, 
+        while text is only decoded if a decoder is given, as it is otherwise a string value.
+    :type decoder: str
+    :param order: The order in which the properties of objects are visited by wildcard, 
+        filter and recursive steps: `ORDER_SORTED` (the default), by name, or 
+        `ORDER_INSERTION`, the order of the dictionaries' keys, which avoids sorting them
+    :type order: str
+    :return: Iterator of 2-tuples, each containing the value followed by the path.
+    :rtype: iterator
+    :raises PythonSyntaxError: if the JSONPath includes an invalid Python script expression
+    :raises json.JSONDecodeError: if the data is a document which is not valid JSON
+    """
+    return _results(_iterate_nodes(data, steps, diagnostics, engine, index, executor, decoder, 
+                                   order), RESULT_TYPE_BOTH)
+
+
+def _check_code(steps):
+    try:
+        for step in steps:
+            step.check_code()
+    except SyntaxError as e:
+        raise PythonSyntaxError(e.text, e.offset, e.msg) from e
+
+
+def _iterate_nodes(data, steps, diagnostics=None, engine=ENGINE_PYTHON, index=None, 
+                   executor=None, decoder=None, order=ORDER_SORTED):
+    _check_code(steps)
+    if engine not in _ENGINES:
+        raise ValueError('Unknown engine: {}'.format(engine))
+    if order not in _ORDERS:
+        raise ValueError('Unknown order: {}'.format(order))
+    data = _data_of(data, decoder)
+    currnodes = [_Node(data)]
+    # a context without diagnostics, engine or index is shared by all of the steps
+    plain = _DEFAULT_CONTEXT if order == ORDER_SORTED else _INSERTION_CONTEXT
+    split = len(steps)
+    if executor is not None and diagnostics is None and engine == ENGINE_PYTHON and index is None:
+        split = _fan_out_point(steps)
+    profile = isinstance(diagnostics, Profile)
+    for i,step in enumerate(steps[:split]):
+        if diagnostics is None and engine == ENGINE_PYTHON and index is None:
+            ctx = plain
+        else:
+            stats = diagnostics.stats_for(i, step) if diagnostics is not None else None
+            ctx = _Context(stats, engine, index, order)
+        if profile:
+            currnodes = _profiled(step, data, currnodes, ctx)
+        else:
+            currnodes = step.apply_to(data, currnodes, ctx)
+    if split < len(steps):
+        currnodes = _fan_out(data, steps[split], steps[split+1:], currnodes, executor, plain)
+    return _reraise_syntax_errors(currnodes)
+
+
+def _node_wise(step):
+    # whether the step's results for a list of nodes are its results for each node in turn,
+    # so that the list can be split between tasks and their results joined back together
+    if isinstance(step, PChain):
+        return True
+    return isinstance(step, PChild) and len(step.targets) == 1 \
+            and not isinstance(step.targets[0], PRoot)
+
+
+def _fans_out(step):
+    if isinstance(step, PRecursive):
+        return True
+    if isinstance(step, PChain):
+        return step.wildcard
+    return isinstance(step, PChild) and len(step.targets) == 1 \
+            and isinstance(step.targets[0], (PWildcard, PFilter))
+
+
+def _fan_out_point(steps):
+    """Returns the position of the first wildcard, filter or recursive step which is followed
+    only by node-wise steps, or the number of steps if there is none"""
+    split = len(steps)
+    tail_node_wise = True
+    for i in reversed(range(len(steps))):
+        if tail_node_wise and _fans_out(steps[i]):
+            split = i
+        tail_node_wise = tail_node_wise and _node_wise(steps[i])
+    return split
+
+
+def _fan_out(data, step, rest, currnodes, executor, ctx):
+    """Applies the given step followed by the rest of the steps, splitting large sets of
+    child nodes across the executor. The results are yielded in the usual order."""
+    if isinstance(step, PRecursive):
+        return _fan_out_recursive(data, step, rest, currnodes, executor, ctx)
+    if isinstance(step, PChain):
+        # the keys of the chain are looked up from each child selected by its wildcard
+        return _fan_out_children(data, PWildcard(), 
+                                 (PChain(wildcard=False, keys=step.keys),) + tuple(rest), 
+                                 currnodes, executor, ctx)
+    return _fan_out_children(data, step.targets[0], rest, currnodes, executor, ctx)
+
+
+def _fan_out_children(data, targ, rest, currnodes, executor, ctx):
+    filt = targ if isinstance(targ, PFilter) else None
+    # nodes with few children are evaluated together in this thread
+    small = []
+    for node in currnodes:
+        obj = node.value
+        if not isinstance(obj, _CONTAINER_TYPES) or len(obj) < PARALLEL_MIN_NODES:
+            small.append(node)
+            if len(small) >= PARALLEL_CHUNK_SIZE:
+                yield from _apply_steps(data, rest, targ.apply_to(data, small, ctx), ctx)
+                small = []
+            continue
+        if small:
+            yield from _apply_steps(data, rest, targ.apply_to(data, small, ctx), ctx)
+            small = []
+        if filt is not None and _is_array(obj) and filt.vector_filter() is not None:
+            # a NumPy array is filtered all at once here, and only the later steps fanned out
+            yield from _run_tasks(executor, _children_task, list(filt.apply_to(data, [node], ctx)),
+                                  data, None, rest, ctx)
+            continue
+        yield from _run_tasks(executor, _children_task, list(targ.all_children_of(node, ctx.order)),
+                              data, filt, rest, ctx)
+    if small:
+        yield from _apply_steps(data, rest, targ.apply_to(data, small, ctx), ctx)
+
+
+def _fan_out_recursive(data, step, rest, currnodes, executor, ctx):
+    visit_leaves = any(isinstance(targ, PRoot) for targ in step.targets)
+    # the same search as PRecursive, except that the descendants of a large list of nodes
+    # are searched by tasks, each taking a range of the nodes
+    stack = [list(currnodes)]
+    while stack:
+        nodes = stack.pop()
+        for targ in step.targets:
+            if isinstance(targ, (PWildcard, PFilter)):
+                yield from _fan_out_children(data, targ, rest, nodes, executor, ctx)
+            else:
+                yield from _apply_steps(data, rest, targ.apply_to(data, nodes, ctx), ctx)
+        if len(nodes) >= PARALLEL_MIN_NODES:
+            yield from _run_tasks(executor, _descendants_task, nodes, data, step, rest, ctx)
+            continue
+        for node in reversed(nodes):
+            children = list(step.all_children_of(node, ctx.order))
+            if children or visit_leaves:
+                stack.append(children)
+
+
+def _apply_steps(data, steps, nodes, ctx=_DEFAULT_CONTEXT):
+    for step in steps:
+        nodes = step.apply_to(data, nodes, ctx)
+    return nodes
+
+
+def _children_task(data, filt, rest, ctx, nodes):
+    if filt is not None:
+        warning = _warning_enabled()
+        nodes = [node for node in nodes if filt.accepts(data, node, None, warning)]
+    return list(_apply_steps(data, rest, nodes, ctx))
+
+
+def _descendants_task(data, step, rest, ctx, nodes):
+    visit_leaves = any(isinstance(targ, PRoot) for targ in step.targets)
+    results = []
+    # the descendants of each node follow those of the nodes before it
+    for node in nodes:
+        children = list(step.all_children_of(node, ctx.order))
+        if children or visit_leaves:
+            results.extend(_apply_steps(data, rest, step.search(data, [children], ctx), ctx))
+    return results
+
+
+def _run_tasks(executor, task, nodes, *args):
+    """Submits the task for each chunk of the nodes, and yields the results of each chunk in
+    turn"""
+    futures = [executor.submit(task, *args, nodes[i:i+PARALLEL_CHUNK_SIZE])
+               for i in range(0, len(nodes), PARALLEL_CHUNK_SIZE)]
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        # don't start the remaining tasks if the results are no longer wanted
+        for future in futures:
+            future.cancel()
+
+
+def _reraise_syntax_errors(nodes):
+    try:
+        yield from nodes
+    except SyntaxError as e:
+        raise PythonSyntaxError(e.text, e.offset, e.msg) from e    
+
+
+def _results(nodes, result_type):
+    if result_type == RESULT_TYPE_VALUE:
+        return (node.value for node in nodes)
+    elif result_type == RESULT_TYPE_PATH:
+        return (node.path for node in nodes)
+    else:
+        return ((node.value, node.path) for node in nodes)
+
+
+class Query:
+    """A compiled JSONPath expression, as returned by the `compile` function.
+
+    Queries are immutable and may be reused to evaluate the same expression against many
+    data structures without parsing it again. The evaluation methods accept the same keyword
+    options as `evaluate`, such as `diagnostics`.
+
+    :ivar expr: The JSONPath expression string the query was compiled from
+    :ivar steps: The parsed steps of the expression, as returned by the `parse` function
+    :ivar plan: The steps as rewritten by `optimise`, which are evaluated unless diagnostics 
+        or debug logging are enabled, as these report on the parsed steps
+    :ivar dialect: The dialect the expression was parsed with
+    :ivar backend: The backend the query was compiled for
+    :ivar source: For `BACKEND_CODEGEN`, the source code generated for the query, or None if
+        the query is evaluated by the interpreter
+    """
+
+    __slots__ = ('expr', 'steps', 'plan', 'dialect', 'backend', 'source', '_functions')
+
+    def __init__(self, expr, steps, dialect=DIALECT_PYTHON, backend=BACKEND_INTERPRETER):
+        object.__setattr__(self, 'expr', expr)
+        object.__setattr__(self, 'steps', tuple(steps))
+        object.__setattr__(self, 'plan', tuple(optimise(steps)))
+        object.__setattr__(self, 'dialect', dialect)
+        object.__setattr__(self, 'backend', backend)
+        source = functions = None
+        if backend == BACKEND_CODEGEN and _CodeGenerator.supports(self.plan):
+            source, sorted_functions = self._generate(ORDER_SORTED)
+            # the functions for the other orders are generated when first used
+            functions = { ORDER_SORTED: sorted_functions }
+        object.__setattr__(self, 'source', source)
+        object.__setattr__(self, '_functions', functions)
+
+    def _generate(self, order):
+        generator = _CodeGenerator(self.plan, order)
+        source = generator.generate()
+        namespace = dict(generator.constants)
+        exec(builtins.compile(source, '<query {}>'.format(self.expr), 'exec'), namespace)
+        return source, (namespace['_jp_nodes'], namespace['_jp_values'])
+
+    def _functions_for(self, order):
+        functions = self._functions.get(order)
+        if functions is None:
+            if order not in _ORDERS:
+                raise ValueError('Unknown order: {}'.format(order))
+            with _BUILD_LOCK:
+                functions = self._functions.get(order)
+                if functions is None:
+                    functions = self._functions[order] = self._generate(order)[1]
+        return functions
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} object is immutable'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} object is immutable'.format(type(self).__name__))
+
+    def __repr__(self):
+        args = [repr(self.expr)]
+        if self.dialect != DIALECT_PYTHON:
+            args.append('dialect={}'.format(repr(self.dialect)))
+        if self.backend != BACKEND_INTERPRETER:
+            args.append('backend={}'.format(repr(self.backend)))
+        return '{}({})'.format(type(self).__name__, ', '.join(args))
+
+    def __reduce__(self):
+        # steps hold compiled script functions, so pickle as the expression and recompile
+        return compile, (self.expr, self.dialect, self.backend)
+
+    def iterate(self, data, **options):
+        """Lazily yields the matching nodes for the given data structure
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :return: Iterator of 2-tuples, each containing the value followed by the path.
+        :rtype: iterator
+        """
+        return _results(self._nodes(data, options), RESULT_TYPE_BOTH)
+
+    def find(self, data, limit=None, **options):
+        """Returns the matching nodes for the given data structure
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :param limit: The maximum number of results to return. Evaluation stops as soon as this
+            many have been found.
+        :type limit: int
+        :return: List of 2-tuples, each containing the value followed by the path.
+        :rtype: list
+        """
+        return self._collect(data, RESULT_TYPE_BOTH, limit, options)
+
+    def values(self, data, limit=None, **options):
+        """Returns the values of the matching nodes for the given data structure
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :param limit: The maximum number of results to return
+        :type limit: int
+        :rtype: list
+        """
+        return self._collect(data, RESULT_TYPE_VALUE, limit, options)
+
+    def paths(self, data, limit=None, **options):
+        """Returns the normalised paths of the matching nodes for the given data structure
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :param limit: The maximum number of results to return
+        :type limit: int
+        :rtype: list
+        """
+        return self._collect(data, RESULT_TYPE_PATH, limit, options)
+
+    def first(self, data, default=None, **options):
+        """Returns the value of the first matching node, without evaluating any further
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :param default: The value to return if there is no match
+        :return: The value of the first match, or `default`
+        """
+        for value in self._values(data, options):
+            return value
+        return default
+
+    def exists(self, data, **options):
+        """Tests whether the query matches anything, stopping at the first match
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :rtype: bool
+        """
+        for value in self._values(data, options):
+            return True
+        return False
+
+    def explain(self, data, **options):
+        """Evaluates the query against the given data structure, timing each step.
+
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :return: The profile of the evaluation, which may be printed as a plan tree
+        :rtype: Profile
+        :example:
+
+        >>> import jsonpyth
+        >>> query = jsonpyth.compile("$.cats[*].name")
+        >>> print(query.explain({"cats": [{"name": "Alfie"}]}))  # doctest: +ELLIPSIS
+        $.cats[*].name  (results=1, time=...ms)
+        -> 0 PChild [PRoot()]  (in=0 out=1 time=...ms)
+           -> 1 PChild [PProperty(name=cats)]  (in=1 out=1 time=...ms)
+              -> 2 PChild [PWildcard()]  (in=1 out=1 time=...ms)
+                 -> 3 PChild [PProperty(name=name)]  (in=1 out=1 time=...ms)
+        """
+        profile = Profile(self.expr)
+        for _ in _iterate_nodes(data, self.steps, diagnostics=profile, **options):
+            pass
+        return profile
+
+    def stream(self, fp, chunk_size=STREAM_CHUNK_SIZE):
+        """Lazily yields the matching nodes for JSON read incrementally from a file object.
+
+        See the `stream` function for details.
+
+        :param fp: The file object to read JSON from, in binary (UTF-8) or text mode
+        :param chunk_size: The number of bytes to read from the file at a time
+        :type chunk_size: int
+        :return: Iterator of 2-tuples, each containing the value followed by the path.
+        :rtype: iterator
+        """
+        return stream(fp, self.steps, chunk_size)
+
+    async def find_async(self, documents, limit=None, yield_every=ASYNC_YIELD_EVERY, **options):
+        """Asynchronously yields the matching nodes for each of the documents from an async 
+        iterable, such as the decoded payloads of a message queue.
+
+        Each document is evaluated in memory as by `find`, in the event loop's default 
+        executor, so that the event loop can run other tasks however long the evaluation takes,
+        even if it finds no matches. The matches are collected from the executor in batches of 
+        the given number.
+
+        :param documents: Async iterable of data structures of basic types to query
+        :param limit: The maximum number of results to return for each document
+        :type limit: int
+        :param yield_every: The number of matches to collect from the executor at a time
+        :type yield_every: int
+        :return: Async iterator of lists, one for each document, of 2-tuples each containing
+            the value followed by the path.
+        :rtype: async iterator
+        :raises ValueError: if `yield_every` is less than 1
+        """
+        import asyncio
+        if yield_every < 1:
+            raise ValueError('yield_every must be at least 1')
+        loop = asyncio.get_event_loop()
+        async for data in documents:
+            results = []
+            nodes = _results(self._nodes(data, options), RESULT_TYPE_BOTH)
+            if limit is not None:
+                nodes = itertools.islice(nodes, limit)
+            while True:
+                batch = await loop.run_in_executor(None, _take, nodes, yield_every)
+                results.extend(batch)
+                if len(batch) < yield_every:
+                    break
+            yield results
+
+    def stream_async(self, source, chunk_size=STREAM_CHUNK_SIZE, yield_every=ASYNC_YIELD_EVERY):
+        """Asynchronously yields the matching nodes for JSON read incrementally from an async
+        stream, such as the body of an HTTP request.
+
+        See the `stream_async` function for details.
+
+        :param source: The stream to read JSON from: an object with a `read` coroutine method,
+            or an async iterable of chunks of bytes or text
+        :param chunk_size: The number of bytes to read from a `read` method at a time
+        :type chunk_size: int
+        :param yield_every: The number of nodes to visit between yielding to the event loop
+        :type yield_every: int
+        :return: Async iterator of 2-tuples, each containing the value followed by the path.
+        :rtype: async iterator
+        """
+        return stream_async(source, self.steps, chunk_size, yield_every)
+
+    def _steps_for(self, options):
+        if options.get('diagnostics') is not None or _debug_enabled():
+            return self.steps
+        return self.plan
+
+    def _generated(self, options):
+        # the generated functions don't collect diagnostics, use other engines or indexes, or
+        # split work across executors
+        return self._functions is not None and not _debug_enabled() \
+                and options.get('diagnostics') is None and options.get('index') is None \
+                and options.get('executor') is None \
+                and options.get('engine', ENGINE_PYTHON) == ENGINE_PYTHON \
+                and set(options) <= {'diagnostics', 'index', 'engine', 'executor', 'decoder', 
+                                     'order'}
+
+    def _nodes(self, data, options):
+        if self._generated(options):
+            functions = self._functions_for(options.get('order', ORDER_SORTED))
+            return _reraise_syntax_errors(functions[0](_data_of(data, options.get('decoder'))))
+        return _iterate_nodes(data, self._steps_for(options), **options)
+
+    def _values(self, data, options):
+        if self._generated(options):
+            functions = self._functions_for(options.get('order', ORDER_SORTED))
+            return _reraise_syntax_errors(functions[1](_data_of(data, options.get('decoder'))))
+        return _results(_iterate_nodes(data, self._steps_for(options), **options), 
+                        RESULT_TYPE_VALUE)
+
+    def _collect(self, data, result_type, limit, options):
+        if result_type == RESULT_TYPE_VALUE:
+            results = self._values(data, options)
+        else:
+            results = _results(self._nodes(data, options), result_type)
+        if limit is not None:
+            results = itertools.islice(results, limit)
+        return list(results)
+
+
+CACHE_SIZE = 512
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compile_cached(expr, dialect, backend):
+    steps = parse(expr, dialect)
+    _check_code(steps)
+    return Query(expr, steps, dialect, backend)
+
+
+def compile(expr, dialect=DIALECT_PYTHON, backend=BACKEND_INTERPRETER):
+    """Parses a JSONPath expression into a reusable `Query` object.
+
+    Compiled queries are kept in a process-wide, size-bounded LRU cache (holding up to 
+    `CACHE_SIZE` expressions), so compiling the same expression again is cheap.
+
+    :param expr: The JSONPath expression to compile
+    :type expr: str
+    :param dialect: The language of filters and script expressions: `DIALECT_PYTHON` (the 
+        default) or `DIALECT_SAFE`. See `parse`.
+    :type dialect: str
+    :param backend: How the query is evaluated: `BACKEND_INTERPRETER` (the default) applies
+        each step in turn, while `BACKEND_CODEGEN` generates and compiles a Python function 
+        for the whole path, which is faster to evaluate but slower to compile. The generated
+        code can be viewed as the query's `source`. Evaluations which collect diagnostics, 
+        use another engine, an index or an executor, or have debug logging enabled, use the
+        interpreter.
+    :type backend: str
+    :return: The compiled query
+    :rtype: Query
+    :raises JsonPathSyntaxError: if the given string does not represent a valid JSONPath 
+        expression
+    :raises PythonSyntaxError: if the JSONPath includes an invalid Python script expression
+    :example:
+
+    >>> import jsonpyth
+    >>> query = jsonpyth.compile("$.cats[*].name")
+    >>> query.values({"cats": [{"name": "Alfie"}, {"name": "Bubbles"}]})
+    ['Alfie', 'Bubbles']
+    """
+    if backend not in _BACKENDS:
+        raise ValueError('Unknown backend: {}'.format(backend))
+    return _compile_cached(expr, dialect, backend)
+
+
+def cache_info():
+    """Returns statistics for the compiled query cache used by `compile` and `jsonpath`
+
+    :return: Named tuple of ``hits``, ``misses``, ``maxsize`` and ``currsize``
+    :rtype: functools._CacheInfo
+    """
+    return _compile_cached.cache_info()
+
+
+def cache_clear():
+    """Empties the compiled query cache used by `compile` and `jsonpath`"""
+    _compile_cached.cache_clear()
+
+
+def jsonpath(obj, expr, result_type=RESULT_TYPE_VALUE, always_return_list=False, limit=None,
+             diagnostics=None, engine=ENGINE_PYTHON, dialect=DIALECT_PYTHON, index=None,
+             executor=None, decoder=None, order=ORDER_SORTED):
+    """Queries the given data structure using a JSONPath expression as a string.
+
+    This is a convenience function that first `compile`s the expression string and then
+    evaluates the resulting query against the given data structure. Compiled expressions are
+    cached, so repeated calls with the same expression only parse it once.
+
+    :param obj: The data structure of basic types to query, as returned by the `json` module
+    :type obj: bool, int, float, str, tuple, list, dict, None, LazyDocument, bytes
+    :param expr: A JSONPath expression to evaluate
+    :type expr: str
+    :param result_type: The type of data to return: `RESULT_TYPE_VALUE`, `RESULT_TYPE_PATH` or 
+        `RESULT_TYPE_BOTH`. Returns values by default.
+    :type result_type: str
+    :param always_return_list: The JSONPath reference implementation returns the value ``false``
+        in the case of no matching results, and this is the default behaviour. However an empty
+        list (perhaps a more Pythonic alternative) can be returned instead by setting this 
+        parameter `True`.
+    :type always_return_list: bool
+    :param limit: The maximum number of results to return. Evaluation stops as soon as this
+        many have been found.
+    :type limit: int
+    :param diagnostics: Optional collector for counts of the nodes each step passed over
+    :type diagnostics: Diagnostics
+    :param engine: The engine used to evaluate filters: `ENGINE_PYTHON` (the default) or 
+        `ENGINE_NUMPY`, which requires the numpy package
+    :type engine: str
+    :param dialect: The language of filters and script expressions: `DIALECT_PYTHON` (the 
+        default) or `DIALECT_SAFE`. See `parse`.
+    :type dialect: str
+    :param index: Optional index of the data, used to answer recursive steps
+    :type index: DocumentIndex
+    :param executor: Optional thread pool, such as a `concurrent.futures.ThreadPoolExecutor`, 
+        across which the large sets of child nodes of wildcard, filter and recursive steps 
+        are split. See `PARALLEL_MIN_NODES`.
+    :type executor: concurrent.futures.Executor
+    :param decoder: The decoder used if the data is a JSON document as bytes or text, as for 
+        `decode`. Bytes are always decoded, with the fastest decoder installed by default, 
+        while text is only decoded if a decoder is given, as it is otherwise a string value.
+    :type decoder: str
+    :param order: The order in which the properties of objects are visited by wildcard, 
+        filter and recursive steps: `ORDER_SORTED` (the default), by name, or 
+        `ORDER_INSERTION`, the order of the dictionaries' keys, which avoids sorting them
+    :type order: str
+    :return: List of results. For values (the default) or paths, each result will be a string.
+        If both are requested, each result will be a 2-tuple containing the value followed by
+        the path.
+    :rtype: list
+    :raises ParseError: if the given string does not represent a valid JSONPath or contains
+        an invalid Python script expression 
+    :example:
+
+    >>> from jsonpyth import jsonpath
+    >>> data = {
+    ...     "dogs": [
+    ...         { "name": "Fido", "age": 6 },
+    ...         { "name": "Gruff", "age": 8 }
+    ...     ],
+    ...     "cats": [
+    ...         { "name": "Alfie", "age": 3 },
+    ...         { "name": "Bubbles", "age": 5 },
+    ...     ]
     ... }
     >>> jsonpath(data, "$.cats[*].name")
     ['Alfie', 'Bubbles']
     """
-    result = evaluate(obj, parse(expr))
+    result = list(ijsonpath(obj, expr, result_type, limit, diagnostics, engine, dialect, index,
+                            executor, decoder, order))
+    
+    if len(result) == 0 and not always_return_list:
+        return False
+    else:
+        return result
+
+
+def ijsonpath(obj, expr, result_type=RESULT_TYPE_VALUE, limit=None, diagnostics=None, 
+              engine=ENGINE_PYTHON, dialect=DIALECT_PYTHON, index=None, executor=None, 
+              decoder=None, order=ORDER_SORTED):
+    """Lazily queries the given data structure using a JSONPath expression as a string.
+
+    This is the same as `jsonpath`, but returns an iterator of results. The data is only
+    traversed as far as is needed to produce the results which are consumed.
+
+    :param obj: The data structure of basic types to query, as returned by the `json` module
+    :type obj: bool, int, float, str, tuple, list, dict, None, LazyDocument, bytes
+    :param expr: A JSONPath expression to evaluate
+    :type expr: str
+    :param result_type: The type of data to return: `RESULT_TYPE_VALUE`, `RESULT_TYPE_PATH` or 
+        `RESULT_TYPE_BOTH`. Returns values by default.
+    :type result_type: str
+    :param limit: The maximum number of results to return
+    :type limit: int
+    :param diagnostics: Optional collector for counts of the nodes each step passed over
+    :type diagnostics: Diagnostics
+    :param engine: The engine used to evaluate filters: `ENGINE_PYTHON` (the default) or 
+        `ENGINE_NUMPY`, which requires the numpy package
+    :type engine: str
+    :param dialect: The language of filters and script expressions, as for `jsonpath`
+    :type dialect: str
+    :param index: Optional index of the data, used to answer recursive steps
+    :type index: DocumentIndex
+    :param executor: Optional thread pool, such as a `concurrent.futures.ThreadPoolExecutor`, 
+        across which the large sets of child nodes of wildcard, filter and recursive steps 
+        are split. See `PARALLEL_MIN_NODES`.
+    :type executor: concurrent.futures.Executor
+    :param decoder: The decoder used if the data is a JSON document, as for `jsonpath`
+    :type decoder: str
+    :param order: The order in which the properties of objects are visited, as for `jsonpath`
+    :type order: str
+    :return: Iterator of results, as described for `jsonpath`
+    :rtype: iterator
+    :raises ParseError: if the given string does not represent a valid JSONPath or contains
+        an invalid Python script expression 
+    """
+    query = compile(expr, dialect)
+    steps = query._steps_for({'diagnostics': diagnostics})
+    nodes = _iterate_nodes(obj, steps, diagnostics, engine, index, executor, decoder, order)
+    if limit is not None:
+        nodes = itertools.islice(nodes, limit)
+    return _results(nodes, result_type)
+
+
+
+class _StepTrie:
+
+    __slots__ = ('step', 'children', 'names')
+
+    def __init__(self, step=None):
+        self.step = step
+        self.children = {}
+        self.names = []
+
+    def add(self, steps, name):
+        trie = self
+        for step in steps:
+            key = step.key()
+            if key not in trie.children:
+                trie.children[key] = _StepTrie(step)
+            trie = trie.children[key]
+        trie.names.append(name)
+
+
+class QuerySet:
+    """A named collection of compiled queries which are evaluated together in a single pass.
+
+    The steps of the queries are merged into a trie, so that a path prefix shared by several
+    of the queries, such as ``$.payload.items[*]``, is only evaluated once per data structure.
+
+    :ivar queries: Dictionary of the compiled queries, keyed by name
+    :example:
+
+    >>> import jsonpyth
+    >>> queries = jsonpyth.QuerySet({"names": "$.cats[*].name", "ages": "$.cats[*].age"})
+    >>> queries.evaluate({"cats": [{"name": "Alfie", "age": 3}, {"name": "Bubbles"}]})
+    {'names': ['Alfie', 'Bubbles'], 'ages': [3]}
+    """
+
+    __slots__ = ('queries', '_trie')
+
+    def __init__(self, queries, dialect=DIALECT_PYTHON):
+        """
+        :param queries: Mapping, or iterable of 2-tuples, of names to queries. Each query may
+            be a compiled `Query` or an expression string.
+        :type queries: dict, iterable
+        :param dialect: The dialect to compile expression strings with. See `parse`.
+        :type dialect: str
+        :raises ParseError: if a string does not represent a valid JSONPath or contains
+            an invalid Python script expression 
+        """
+        self.queries = {}
+        self._trie = _StepTrie()
+        for name, query in dict(queries).items():
+            if not isinstance(query, Query):
+                query = compile(query, dialect)
+            self.queries[name] = query
+            self._trie.add(query.steps, name)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, repr(self.queries))
+
+    def __reduce__(self):
+        return type(self), (self.queries,)
+
+    def evaluate(self, data, result_type=RESULT_TYPE_VALUE, engine=ENGINE_PYTHON, index=None,
+                 decoder=None, order=ORDER_SORTED):
+        """Applies all of the queries to the given data structure
+        
+        :param data: The data structure of basic types to query, as returned by the `json` module
+        :type data: bool, int, float, str, tuple, list, dict, None, Mapping, Sequence, 
+            numpy.ndarray, LazyDocument, bytes
+        :param result_type: The type of data to return: `RESULT_TYPE_VALUE`, `RESULT_TYPE_PATH` 
+            or `RESULT_TYPE_BOTH`. Returns values by default.
+        :type result_type: str
+        :param engine: The engine used to evaluate filters, as for `evaluate`
+        :type engine: str
+        :param index: Optional index of the data, used to answer recursive steps
+        :type index: DocumentIndex
+        :param decoder: The decoder used if the data is a JSON document, as for `evaluate`
+        :type decoder: str
+        :param order: The order in which the properties of objects are visited, as for 
+            `evaluate`
+        :type order: str
+        :return: Dictionary of the list of results for each query, keyed by query name
+        :rtype: dict
+        """
+        if engine not in _ENGINES:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        if order not in _ORDERS:
+            raise ValueError('Unknown order: {}'.format(order))
+        ctx = _Context(engine=engine, index=index, order=order)
+        data = _data_of(data, decoder)
+        found = {}
+        pending = [(self._trie, [_Node(data)])]
+        while len(pending) > 0:
+            trie, nodes = pending.pop()
+            for name in trie.names:
+                found[name] = nodes
+            for child in trie.children.values():
+                pending.append((child, list(child.step.apply_to(data, nodes, ctx))))
+        return { name: list(_results(found[name], result_type)) for name in self.queries }
+
+
+BATCH_SIZE = 1000
+
+_batch_worker_state = None
+
+
+def _init_batch_worker(query, result_type, decoder):
+    global _batch_worker_state
+    _batch_worker_state = (query, result_type, decoder)
+
+
+def _evaluate_batch(batch):
+    query, result_type, decoder = _batch_worker_state
+    return _evaluate_lines(query, result_type, decoder, *batch)
+
+
+def _evaluate_lines(query, result_type, decoder, start, lines):
+    results = []
+    for index, line in enumerate(lines, start):
+        if not line.strip():
+            continue
+        data = decode(line, decoder)
+        if isinstance(query, QuerySet):
+            results.append((index, query.evaluate(data, result_type)))
+        else:
+            results.append((index, query._collect(data, result_type, None, {})))
+    return results
+
+
+def _batches(documents, batch_size):
+    documents = iter(documents)
+    start = 0
+    while True:
+        lines = list(itertools.islice(documents, batch_size))
+        if len(lines) == 0:
+            return
+        yield start, lines
+        start += len(lines)
+
+
+def evaluate_many(query, documents, workers=None, result_type=RESULT_TYPE_VALUE, ordered=True, 
+                  batch_size=BATCH_SIZE, decoder=DECODER_AUTO):
+    """Applies a JSONPath query to each of many JSON documents, using a pool of processes.
+
+    The documents are typically the lines of a JSON Lines file. They are sent to the worker 
+    processes in batches of raw text and decoded there, as by `decode`, and the query is only
+    sent to each worker once. Only a few batches are in flight at a time, so the documents 
+    may be a lazy iterator over a large file. Blank lines are skipped.
+
+    :param query: The query to apply, as a compiled `Query`, a `QuerySet` or an expression 
+        string
+    :type query: Query, QuerySet, str
+    :param documents: Iterable of JSON documents as text or UTF-8 encoded bytes
+    :type documents: iterable
+    :param workers: The number of worker processes. Defaults to the number of CPUs. With a
+        single worker, the documents are evaluated in the current process.
+    :type workers: int
+    :param result_type: The type of data to return for each document: `RESULT_TYPE_VALUE`, 
+        `RESULT_TYPE_PATH` or `RESULT_TYPE_BOTH`. Returns values by default.
+    :type result_type: str
+    :param ordered: Whether to yield results in the order of the documents. If `False`, the
+        results of each batch are yielded as soon as it has been evaluated.
+    :type ordered: bool
+    :param batch_size: The number of documents to send to a worker at a time
+    :type batch_size: int
+    :param decoder: The name of the decoder to decode the documents with, as for `decode`
+    :type decoder: str
+    :return: Iterator of 2-tuples, each containing the position of the document in the input
+        followed by its results: a list, or a dictionary of lists for a `QuerySet`.
+    :rtype: iterator
+    :raises json.JSONDecodeError: if a document is not valid JSON
+    :raises ImportError: if the decoder's package is not installed
+    :raises ParseError: if the given string does not represent a valid JSONPath or contains
+        an invalid Python script expression 
+    :example:
+
+    >>> import jsonpyth
+    >>> lines = ['{"name": "Alfie"}', '{"name": "Bubbles"}']
+    >>> list(jsonpyth.evaluate_many("$.name", lines, workers=2))
+    [(0, ['Alfie']), (1, ['Bubbles'])]
+    """
+    if not isinstance(query, (Query, QuerySet)):
+        query = compile(query)
+    _decoder(decoder)
+    workers = workers or os.cpu_count() or 1
+    batches = _batches(documents, batch_size)
+    if workers == 1:
+        for batch in batches:
+            yield from _evaluate_lines(query, result_type, decoder, *batch)
+        return
+
+    import multiprocessing
+    import queue
     
-    if len(result) == 0 and not always_return_list:
-        return False
-    elif result_type == RESULT_TYPE_VALUE:
-        return [val for val,path in result]
-    elif result_type == RESULT_TYPE_PATH:
-        return [path for val,path in result]
+    window = workers * 2
+    with multiprocessing.Pool(workers, _init_batch_worker, (query, result_type, decoder)) as pool:
+        if ordered:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(pool.apply_async(_evaluate_batch, (batch,)))
+                if len(pending) >= window:
+                    yield from pending.popleft().get()
+            while len(pending) > 0:
+                yield from pending.popleft().get()
+        else:
+            finished = queue.Queue()
+            outstanding = 0
+            for batch in itertools.chain(batches, [None]):
+                if batch is not None:
+                    pool.apply_async(_evaluate_batch, (batch,), callback=finished.put, 
+                                     error_callback=finished.put)
+                    outstanding += 1
+                while outstanding >= (window if batch is not None else 1):
+                    result = finished.get()
+                    outstanding -= 1
+                    if isinstance(result, BaseException):
+                        raise result
+                    yield from result
+
+# the approximate number of bytes of array elements in each range evaluated by a task of
+# `evaluate_partitioned`
+PARTITION_SIZE = 16 * 1024 * 1024
+
+_RAW_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_RAW_STRING = re.compile(rb'(?s)"[^"\\]*(?:\\.[^"\\]*)*"')
+_RAW_SCALAR = re.compile(rb'[^ \t\n\r,:\]}]+')
+# text up to the next bracket, skipping over strings, and for elements also up to a comma
+_RAW_NESTED = re.compile(rb'(?s)[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+_RAW_ELEMENTS = re.compile(rb'(?s)[^"\[\]{},]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{},]*)*')
+_RAW_OPENING = frozenset(b'[{')
+_RAW_COMMA = ord(',')
+_RAW_QUOTE = ord('"')
+_RAW_BACKSLASH = ord('\\')
+_RAW_OPEN_ARRAY = ord('[')
+_RAW_OPEN_OBJECT = ord('{')
+_RAW_ARRAY_END = ord(']')
+_RAW_OBJECT_END = ord('}')
+# the initial and largest number of bytes scanned at once for the end of a container
+_SCAN_WINDOW = 65536
+_SCAN_WINDOW_MAX = 4 * 1024 * 1024
+_UTF8_BOM = codecs.BOM_UTF8
+
+
+def _raw_error(msg, pos):
+    err = json.JSONDecodeError(msg, '', pos)
+    err.args = ('{} (byte {})'.format(msg, pos),)
+    return err
+
+
+class _RawScanner:
+    """Finds the positions of values in undecoded JSON bytes, such as a memory-mapped file.
+
+    Strings are matched without being decoded, and the contents of containers are skipped by 
+    counting brackets, so the document is not built. The document is assumed to be valid; 
+    errors are only detected where they stop the scan.
+    """
+
+    def __init__(self, buf, decoder=DECODER_AUTO):
+        self.buf = buf
+        # the decoder which values found by the scan are decoded with
+        self.decoder = decoder
+        # the numpy module, used to scan large containers faster if it is installed
+        self.np = None
+
+    def skip_whitespace(self, pos):
+        return _RAW_WHITESPACE.match(self.buf, pos).end()
+
+    def root(self):
+        pos = len(_UTF8_BOM) if self.buf[:len(_UTF8_BOM)] == _UTF8_BOM else 0
+        return self.skip_whitespace(pos)
+
+    def skip_value(self, pos):
+        buf = self.buf
+        pos = self.skip_whitespace(pos)
+        if pos >= len(buf):
+            raise _raw_error('Expecting value', pos)
+        if buf[pos] not in _RAW_OPENING:
+            match = (_RAW_STRING if buf[pos:pos+1] == b'"' else _RAW_SCALAR).match(buf, pos)
+            if match is None:
+                raise _raw_error('Expecting value', pos)
+            return match.end()
+        depth = 0
+        while pos < len(buf):
+            if buf[pos] in _RAW_OPENING:
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            pos = _RAW_NESTED.match(buf, pos + 1).end()
+        raise _raw_error('Unterminated container', pos)
+
+    def separators(self, pos, end=None):
+        """Returns the positions of the commas between the members or elements of the object 
+        or array at the given position, followed by the position of its closing bracket. The
+        end of the container, if known, limits the bytes scanned."""
+        if self.np is None:
+            try:
+                self.np = _numpy()
+            except ImportError:
+                self.np = False
+        if self.np:
+            return self.separators_vectorised(self.np, pos, end)
+        buf = self.buf
+        separators = []
+        depth = 0
+        pos += 1
+        while True:
+            end = (_RAW_NESTED if depth else _RAW_ELEMENTS).match(buf, pos).end()
+            if end >= len(buf):
+                raise _raw_error('Unterminated container', end)
+            char = buf[end]
+            if char == _RAW_COMMA:
+                separators.append(end)
+            elif char in _RAW_OPENING:
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+            else:
+                separators.append(end)
+                return separators
+            pos = end + 1
+
+    def separators_vectorised(self, np, pos, end):
+        # Classifies the bytes of a window of the buffer at once. Quotes which aren't escaped
+        # by an odd number of backslashes toggle whether the following bytes are in a string,
+        # and brackets outside of strings change the depth. Only the quotes, brackets and 
+        # commas are kept after the first pass, and each window's state is carried over.
+        buf = self.buf
+        table = np.zeros(256, np.uint8)
+        table[_RAW_QUOTE] = 1
+        table[[_RAW_OPEN_ARRAY, _RAW_OPEN_OBJECT]] = 2
+        table[[_RAW_ARRAY_END, _RAW_OBJECT_END]] = 3
+        table[_RAW_COMMA] = 4
+        separators = []
+        depth = quotes = backslashes = 0
+        size = min(end - pos if end is not None else _SCAN_WINDOW, _SCAN_WINDOW_MAX)
+        start = pos
+        while start < len(buf):
+            count = min(size, len(buf) - start)
+            # a copy, so that no array exports the buffer and stops it from being closed
+            window = np.frombuffer(buf[start:start+count], np.uint8)
+            kinds = table[window]
+            backslash = window == _RAW_BACKSLASH
+            if backslashes or backslash.any():
+                index = np.arange(count)
+                # the position of the last byte, up to each one, which isn't a backslash
+                last = np.maximum.accumulate(np.where(backslash, -1 - backslashes, index))
+                quoted = np.flatnonzero(kinds == 1)
+                preceding = np.where(quoted > 0, quoted - 1 - last[quoted - 1], backslashes)
+                kinds[quoted[preceding % 2 == 1]] = 0
+                backslashes = count - 1 - int(last[-1])
+            positions = np.flatnonzero(kinds)
+            kinds = kinds[positions]
+            strings = np.bitwise_xor.accumulate((kinds == 1).view(np.uint8)) ^ quotes
+            outside = strings == 0
+            depths = np.cumsum((kinds == 2) & outside, dtype=np.int32) \
+                    - np.cumsum((kinds == 3) & outside, dtype=np.int32) + depth
+            closed = np.flatnonzero(depths == 0)
+            stop = closed[0] if len(closed) else len(kinds)
+            commas = (kinds[:stop] == 4) & outside[:stop] & (depths[:stop] == 1)
+            separators.extend((positions[:stop][commas] + start).tolist())
+            if len(closed):
+                separators.append(start + int(positions[closed[0]]))
+                return separators
+            if len(kinds):
+                depth = int(depths[-1])
+                quotes = int(strings[-1])
+            start += count
+            size = min(size * 2, _SCAN_WINDOW_MAX)
+        raise _raw_error('Unterminated container', len(buf))
+
+    def members(self, pos, end=None):
+        """Returns a dictionary of each property name of the object at the given position to
+        the start and end positions of its value, or None if it is not an object. As with the
+        `json` module, the last of any duplicate properties is used."""
+        buf = self.buf
+        if buf[pos:pos+1] != b'{':
+            return None
+        members = {}
+        start = pos + 1
+        for separator in self.separators(pos, end):
+            pos = self.skip_whitespace(start)
+            if pos == separator and not members and buf[pos:pos+1] == b'}':
+                break
+            match = _RAW_STRING.match(buf, pos, separator)
+            if match is None:
+                raise _raw_error('Expecting property name enclosed in double quotes', pos)
+            name = match.group()
+            # only names with escapes need decoding as JSON
+            name = json.loads(name) if b'\\' in name else name[1:-1].decode('utf-8')
+            pos = self.skip_whitespace(match.end())
+            if buf[pos:pos+1] != b':':
+                raise _raw_error("Expecting ':' delimiter", pos)
+            members[name] = (self.skip_whitespace(pos + 1), separator)
+            start = separator + 1
+        return members
+
+    def elements(self, pos, end=None):
+        """Returns a list of the start and end positions of each element of the array at the 
+        given position. Elements may be preceded by whitespace."""
+        separators = self.separators(pos, end)
+        if len(separators) == 1 and self.skip_whitespace(pos + 1) == separators[0]:
+            return []
+        starts = [pos + 1]
+        starts.extend(separator + 1 for separator in separators[:-1])
+        return list(zip(starts, separators))
+
+    def element_ranges(self, pos, size):
+        """Yields ranges of the elements of the array at the given position, each of at least
+        the given number of bytes except the last. Ranges are 4-tuples of the start and end 
+        positions of the comma-separated elements, the index of the first, and their number."""
+        buf = self.buf
+        start = pos = pos + 1
+        first = count = depth = 0
+        while True:
+            end = (_RAW_NESTED if depth else _RAW_ELEMENTS).match(buf, pos).end()
+            if end >= len(buf):
+                raise _raw_error('Unterminated array', end)
+            char = buf[end]
+            if char == _RAW_COMMA:
+                count += 1
+                if end - start >= size:
+                    yield start, end, first, count
+                    start = end + 1
+                    first += count
+                    count = 0
+            elif char in _RAW_OPENING:
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+            elif char != _RAW_ARRAY_END:
+                raise _raw_error("Expecting ',' delimiter", end)
+            else:
+                if count > 0 or self.skip_whitespace(start) < end:
+                    yield start, end, first, count + 1
+                return
+            pos = end + 1
+
+
+def _refers_to_root(step):
+    return any(isinstance(targ, PRoot) or getattr(targ, 'uses_root', False)
+               for targ in getattr(step, 'targets', ()))
+
+
+def _slice_range(targ, length):
+    index = getattr(targ, 'index', None)
+    if index is not None:
+        return range(index % length, index % length + 1) if -length <= index < length else range(0)
+    return range(*slice(getattr(targ, 'start', None), getattr(targ, 'end', None), 
+                        getattr(targ, 'step', None)).indices(length))
+
+
+def _range_overlaps(selected, start, stop):
+    # whether the range includes any of the integers from start up to stop
+    if selected.step < 0:
+        selected = selected[::-1]
+    i = max(0, -((start - selected.start) // -selected.step))
+    return i < len(selected) and selected[i] < stop
+
+
+class _Partitioning:
+    """How the steps of a path are evaluated against the elements of a single array in a 
+    document, in ranges of elements which are decoded separately.
+
+    The path must begin with properties leading to the array, and none of its later steps may
+    refer to the root. If the next step is a wildcard, filter, slice or recursive step, and 
+    is followed only by node-wise steps, it is applied to each range of the elements in turn.
+    The results of a range are returned as a list of sections, and the results of the whole 
+    array are each section's results for every range, in turn.
+    """
+
+    def __init__(self, steps):
+        steps = list(steps)
+        self.prefix = []
+        self.local = False
+        self.split = None
+        self.rest = []
+        self.steps = []
+        if not steps or not (isinstance(steps[0], PChild) and len(steps[0].targets) == 1
+                             and isinstance(steps[0].targets[0], PRoot)):
+            return
+        i = 1
+        while i < len(steps):
+            step = steps[i]
+            if isinstance(step, PChain) and not step.wildcard:
+                names = list(itertools.takewhile(lambda key: type(key) is str, step.keys))
+                self.prefix.extend(names)
+                if len(names) < len(step.keys):
+                    # the chain continues from the array with an index
+                    steps[i] = PChain(wildcard=False, keys=step.keys[len(names):])
+                    break
+            elif isinstance(step, PChild) and len(step.targets) == 1 \
+                    and type(step.targets[0]) is PProperty:
+                self.prefix.append(step.targets[0].name)
+            else:
+                break
+            i += 1
+        self.steps = steps[i:]
+        self.local = not any(_refers_to_root(step) for step in self.steps)
+        if not self.local or not self.steps:
+            return
+        split, rest = self.steps[0], self.steps[1:]
+        if isinstance(split, PChain):
+            # a chain begins with a wildcard or, as it doesn't continue the properties, an index
+            keys = split.keys if split.wildcard else split.keys[1:]
+            rest = [PChain(wildcard=False, keys=keys)] + rest if keys else rest
+            split = PChild(targets=[PWildcard() if split.wildcard else PSlice(index=split.keys[0])])
+        if not all(_node_wise(step) for step in rest):
+            return
+        if isinstance(split, PRecursive):
+            if all(isinstance(targ, (PProperty, PWildcard, PFilter)) 
+                   or (isinstance(targ, PSlice) and (getattr(targ, 'step', None) or 1) > 0)
+                   for targ in split.targets):
+                self.split, self.rest = split, rest
+        elif isinstance(split, PChild) and len(split.targets) == 1 \
+                and isinstance(split.targets[0], (PWildcard, PFilter, PSlice)):
+            self.split, self.rest = split, rest
+
+    @property
+    def needs_length(self):
+        # slices of the array can only be resolved once all of its elements are counted
+        return self.split is not None and any(isinstance(targ, PSlice) 
+                                              for targ in self.split.targets)
+
+    def slice_range(self, length):
+        """Returns the range of indices selected by a slice step over the array, or None"""
+        targ = self.split.targets[0]
+        if isinstance(self.split, PChild) and isinstance(targ, PSlice):
+            return _slice_range(targ, length)
+        return None
+
+    def container(self, value=None):
+        """Returns a node for the array, or its container if it has no value"""
+        node = _Node(None)
+        for key in self.prefix[:len(self.prefix) - (value is not None)]:
+            node = _Node(None, node, key)
+        if value is not None:
+            node = _Node(value, node, self.prefix[-1]) if self.prefix else _Node(value)
+        return node
+
+    def select(self, targ, nodes, length):
+        # the target applied to the array node itself, for those of its elements in the range
+        if isinstance(targ, PWildcard):
+            return nodes
+        if isinstance(targ, PFilter):
+            warning = _warning_enabled()
+            return [node for node in nodes if targ.accepts(None, node, None, warning)]
+        if isinstance(targ, PSlice):
+            selected = _slice_range(targ, length)
+            nodes = [node for node in (nodes if selected.step > 0 else reversed(nodes)) 
+                     if node.key in selected]
+            index = getattr(targ, 'index', None)
+            # an index is kept in the path as it was given, even if it is negative
+            return [_Node(node.value, node.parent, index) for node in nodes] \
+                    if index is not None else nodes
+        return []
+
+    def sections(self, elements, first, length):
+        parent = self.container()
+        nodes = [_Node(value, parent, i) for i, value in enumerate(elements, first)]
+        split = self.split
+        if not isinstance(split, PRecursive):
+            return [self.select(split.targets[0], nodes, length)]
+        # as PRecursive.search of the array: the targets applied to the array, then to its 
+        # elements, then the descendants of each element in turn
+        sections = [self.select(targ, nodes, length) for targ in split.targets]
+        sections.extend(targ.apply_to(None, nodes) for targ in split.targets)
+        sections.append(itertools.chain.from_iterable(
+            split.search(None, [children], _DEFAULT_CONTEXT) 
+            for children in (list(split.all_children_of(node)) for node in nodes) if children))
+        return sections
+
+    def evaluate(self, buf, start, end, first, count, length, result_type, decoder=DECODER_AUTO):
+        try:
+            elements = decode(b'[' + buf[start:end] + b']', decoder)
+        except json.JSONDecodeError as e:
+            raise _raw_error(e.msg, start + e.pos - 1) from None
+        return [list(_results(_apply_steps(None, self.rest, nodes), result_type)) 
+                for nodes in self.sections(elements, first, length)]
+
+
+_partition_worker_state = None
+
+
+def _init_partition_worker(query, filename, result_type, decoder):
+    global _partition_worker_state
+    import mmap
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _partition_worker_state = (_Partitioning(query.plan), buf, result_type, decoder)
+
+
+def _evaluate_partition(task):
+    partitioning, buf, result_type, decoder = _partition_worker_state
+    return partitioning.evaluate(buf, *task, result_type, decoder)
+
+
+def evaluate_partitioned(query, filename, workers=None, result_type=RESULT_TYPE_VALUE, 
+                         partition_size=PARTITION_SIZE, decoder=DECODER_AUTO):
+    """Applies a JSONPath query to a single large JSON file, using a pool of processes.
+
+    The file is memory-mapped and its bytes are scanned, without decoding them, for the 
+    array the query selects elements of: the top level array for a query such as 
+    ``$[*].name``, or a property's array for ``$.items[?(@.price > 10)]`` or ``$.items..id``. 
+    The array's elements are split into ranges of about `partition_size` bytes, and each 
+    worker process decodes and evaluates its ranges from its own mapping of the file. 
+    
+    The results are the same as evaluating the query against the whole decoded document. 
+    If the query's path does not lead through an array in this way, the value it leads to
+    is decoded and evaluated in the current process instead, and if it refers to the root of
+    the document in a later step, such as in a filter, the whole document is.
+
+    :param query: The query to apply, as a compiled `Query` or an expression string
+    :type query: Query, str
+    :param filename: The path of the UTF-8 encoded JSON file
+    :type filename: str
+    :param workers: The number of worker processes. Defaults to the number of CPUs. With a
+        single worker, the ranges are evaluated in the current process.
+    :type workers: int
+    :param result_type: The type of data to return: `RESULT_TYPE_VALUE`, `RESULT_TYPE_PATH` 
+        or `RESULT_TYPE_BOTH`. Returns values by default.
+    :type result_type: str
+    :param partition_size: The approximate number of bytes of elements in each range
+    :type partition_size: int
+    :param decoder: The name of the decoder to decode the elements with, as for `decode`
+    :type decoder: str
+    :return: List of results, as for `Query.values`, `Query.paths` or `Query.find`
+    :rtype: list
+    :raises json.JSONDecodeError: if the file is not valid JSON
+    :raises ImportError: if the decoder's package is not installed
+    :raises ParseError: if the given string does not represent a valid JSONPath or contains
+        an invalid Python script expression 
+    """
+    if not isinstance(query, Query):
+        query = compile(query)
+    _decoder(decoder)
+    partitioning = _Partitioning(query.plan)
+    if not partitioning.local:
+        with open(filename, 'rb') as f:
+            return query._collect(decode(f.read(), decoder), result_type, None, {})
+
+    import mmap
+
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise _raw_error('Expecting value', 0)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with buf:
+        scanner = _RawScanner(buf, decoder)
+        pos = scanner.root()
+        for name in partitioning.prefix:
+            members = scanner.members(pos)
+            if members is None or name not in members:
+                return []
+            pos = members[name][0]
+        if partitioning.split is None or buf[pos:pos+1] != b'[':
+            value = decode(buf[pos:scanner.skip_value(pos)], decoder)
+            nodes = _apply_steps(None, partitioning.steps, [partitioning.container(value)])
+            return list(_results(nodes, result_type))
+
+        tasks = scanner.element_ranges(pos, partition_size)
+        length = None
+        reverse = False
+        if partitioning.needs_length:
+            tasks = list(tasks)
+            length = tasks[-1][2] + tasks[-1][3] if tasks else 0
+            selected = partitioning.slice_range(length)
+            if selected is not None:
+                # only the ranges including selected elements need to be evaluated
+                tasks = [task for task in tasks 
+                         if _range_overlaps(selected, task[2], task[2] + task[3])]
+                reverse = selected.step < 0
+        tasks = (task + (length,) for task in tasks)
+
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            outputs = [partitioning.evaluate(buf, *task, result_type, decoder) for task in tasks]
+        else:
+            import multiprocessing
+            with multiprocessing.Pool(workers, _init_partition_worker, 
+                                      (query, filename, result_type, decoder)) as pool:
+                try:
+                    outputs = list(pool.imap(_evaluate_partition, tasks))
+                except json.JSONDecodeError as e:
+                    # the message of an error is rebuilt when it is sent from a worker
+                    raise _raw_error(e.msg, e.pos) from None
+    if reverse:
+        outputs.reverse()
+    return [result for section in zip(*outputs) for results in section for result in results]
+
+
+# containers in a `LazyDocument` of fewer bytes than this are decoded in full when visited
+LAZY_MIN_SIZE = 4096
+
+# the most bytes of consecutive small elements of a lazy array decoded at once
+_LAZY_BATCH_SIZE = 65536
+
+
+def _lazy_value(scanner, start, end):
+    start = scanner.skip_whitespace(start)
+    if end - start >= LAZY_MIN_SIZE:
+        if scanner.buf[start:start+1] == b'{':
+            return LazyObject(scanner, start, end)
+        if scanner.buf[start:start+1] == b'[':
+            return LazyArray(scanner, start, end)
+    return decode(scanner.buf[start:end], scanner.decoder)
+
+
+class LazyObject(collections.abc.Mapping):
+    """A JSON object in a `LazyDocument`, which is decoded as it is used.
+
+    Its property names are found, by scanning over the values, when it is first used, and 
+    each value is decoded when it is first looked up. Large objects and arrays are decoded
+    lazily in turn, while smaller ones are decoded in full. Lazy objects can be used as 
+    read-only dictionaries.
+    """
+
+    __slots__ = ('_scanner', '_start', '_end', '_members', '_values')
+
+    def __init__(self, scanner, start, end=None):
+        self._scanner = scanner
+        self._start = start
+        self._end = end
+        self._members = None
+        self._values = {}
+
+    def _spans(self):
+        if self._members is None:
+            self._members = self._scanner.members(self._start, self._end)
+        return self._members
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        start, end = self._spans()[key]
+        value = self._values[key] = _lazy_value(self._scanner, start, end)
+        return value
+
+    def __iter__(self):
+        return iter(self._spans())
+
+    def __len__(self):
+        return len(self._spans())
+
+    def __contains__(self, key):
+        return key in self._spans()
+
+    def keys(self):
+        return self._spans().keys()
+
+    def __repr__(self):
+        return '<{} at byte {}>'.format(type(self).__name__, self._start)
+
+    def decode(self):
+        """Returns the object fully decoded as a dictionary, as by the `json` module"""
+        if self._end is None:
+            self._end = self._scanner.skip_value(self._start)
+        return decode(self._scanner.buf[self._start:self._end], self._scanner.decoder)
+
+
+class LazyArray(collections.abc.Sequence):
+    """A JSON array in a `LazyDocument`, which is decoded as it is used.
+
+    The positions of its elements are found, by scanning over them, when it is first used, 
+    and each element is decoded when it is first looked up, as for `LazyObject`. Lazy arrays 
+    can be used as read-only lists.
+    """
+
+    __slots__ = ('_scanner', '_start', '_end', '_elements', '_values')
+
+    def __init__(self, scanner, start, end=None):
+        self._scanner = scanner
+        self._start = start
+        self._end = end
+        self._elements = None
+        self._values = None
+
+    def _spans(self):
+        if self._elements is None:
+            self._elements = self._scanner.elements(self._start, self._end)
+            self._values = [_NOTHING] * len(self._elements)
+        return self._elements
+
+    def __getitem__(self, index):
+        spans = self._spans()
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(spans)))]
+        if index < 0:
+            index += len(spans)
+        if not 0 <= index < len(spans):
+            raise IndexError('list index out of range')
+        value = self._values[index]
+        if value is _NOTHING:
+            self._decode(index)
+            value = self._values[index]
+        return value
+
+    def _decode(self, index):
+        spans, values = self._elements, self._values
+        start, end = spans[index]
+        if end - start >= LAZY_MIN_SIZE:
+            values[index] = _lazy_value(self._scanner, start, end)
+            return
+        # small elements are usually visited in turn, so the small elements following one
+        # are decoded with it, in a single call
+        last = index
+        while last + 1 < len(spans) and values[last + 1] is _NOTHING \
+                and spans[last + 1][1] - start <= _LAZY_BATCH_SIZE \
+                and spans[last + 1][1] - spans[last + 1][0] < LAZY_MIN_SIZE:
+            last += 1
+        values[index:last + 1] = decode(b'[' + self._scanner.buf[start:spans[last][1]] + b']', 
+                                        self._scanner.decoder)
+
+    def __iter__(self):
+        for i in range(len(self._spans())):
+            yield self[i]
+
+    def __len__(self):
+        return len(self._spans())
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, LazyArray)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<{} at byte {}>'.format(type(self).__name__, self._start)
+
+    def decode(self):
+        """Returns the array fully decoded as a list, as by the `json` module"""
+        if self._end is None:
+            self._end = self._scanner.skip_value(self._start)
+        return decode(self._scanner.buf[self._start:self._end], self._scanner.decoder)
+
+
+class LazyDocument:
+    """A JSON file which is memory-mapped and only decoded as far as it is queried.
+
+    The document can be queried in place of its decoded data, by `evaluate`, `jsonpath`, a 
+    query's methods and so on, and its `root` used as the decoded data. Objects and arrays 
+    are decoded only when a step visits them, and the rest of the file is skipped over 
+    without being decoded. Values selected by a query may be `LazyObject` or `LazyArray`
+    instances, which can be decoded in full with their ``decode`` method.
+
+    Values which have not been decoded can't be used once the document is closed. The file
+    must not be modified while the document is open.
+
+    :ivar root: The top level value of the document: a `LazyObject`, a `LazyArray`, or a
+        decoded value if it is not a container
+    """
+
+    def __init__(self, filename, decoder=DECODER_AUTO):
+        """
+        :param filename: The path of the UTF-8 encoded JSON file
+        :type filename: str
+        :param decoder: The name of the decoder to decode values with, as for `decode`
+        :type decoder: str
+        :raises json.JSONDecodeError: if the file is empty
+        :raises ImportError: if the decoder's package is not installed
+        """
+        _decoder(decoder)
+        import mmap
+
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise _raw_error('Expecting value', 0)
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        scanner = _RawScanner(self._buf, decoder)
+        start = scanner.root()
+        if self._buf[start:start+1] == b'{':
+            self.root = LazyObject(scanner, start)
+        elif self._buf[start:start+1] == b'[':
+            self.root = LazyArray(scanner, start)
+        else:
+            self.root = decode(self._buf[start:], decoder)
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Kinds of values in queried data. Objects may be any `collections.abc.Mapping` and arrays 
+# any `collections.abc.Sequence` other than strings, or NumPy arrays, whose structured 
+# records are objects of their fields. The kind of each type is determined when it is first
+# seen, and cached.
+
+_KIND_SCALAR = 0
+_KIND_MAPPING = 1
+_KIND_SEQUENCE = 2
+# a numpy array, which is a sequence unless it has no dimensions
+_KIND_ARRAY = 3
+# a numpy structured array record, which is a mapping unless it has no fields
+_KIND_RECORD = 4
+# a numpy number
+_KIND_NUMBER = 5
+
+_kinds = { dict: _KIND_MAPPING, list: _KIND_SEQUENCE, tuple: _KIND_SEQUENCE, 
+           str: _KIND_SCALAR, int: _KIND_SCALAR, float: _KIND_SCALAR, bool: _KIND_SCALAR, 
+           type(None): _KIND_SCALAR }
+
+
+def _kind_of_type(cls):
+    if issubclass(cls, (str, bytes, bytearray, memoryview)):
+        return _KIND_SCALAR
+    if issubclass(cls, collections.abc.Mapping):
+        return _KIND_MAPPING
+    if issubclass(cls, collections.abc.Sequence):
+        return _KIND_SEQUENCE
+    # there can only be numpy values if numpy has been imported
+    numpy = sys.modules.get('numpy')
+    if numpy is not None:
+        if issubclass(cls, numpy.ndarray):
+            return _KIND_ARRAY
+        if issubclass(cls, numpy.void):
+            return _KIND_RECORD
+        if issubclass(cls, (numpy.integer, numpy.floating)):
+            return _KIND_NUMBER
+    return _KIND_SCALAR
+
+
+def _kind_of(value):
+    try:
+        kind = _kinds[type(value)]
+    except KeyError:
+        kind = _kinds[type(value)] = _kind_of_type(type(value))
+    if kind == _KIND_ARRAY:
+        return _KIND_ARRAY if value.ndim > 0 else _KIND_SCALAR
+    if kind == _KIND_RECORD:
+        return _KIND_RECORD if value.dtype.names is not None else _KIND_SCALAR
+    return kind
+
+
+class _KindCheck(type):
+    """Metaclass of classes which stand for kinds of values in `isinstance` checks"""
+
+    def __instancecheck__(cls, value):
+        return _kind_of(value) in cls.kinds
+
+
+class _Mapping(metaclass=_KindCheck):
+    kinds = frozenset([_KIND_MAPPING, _KIND_RECORD])
+
+
+class _Sequence(metaclass=_KindCheck):
+    kinds = frozenset([_KIND_SEQUENCE, _KIND_ARRAY])
+
+
+class _Container(metaclass=_KindCheck):
+    kinds = _Mapping.kinds | _Sequence.kinds
+
+
+class _Number(metaclass=_KindCheck):
+    kinds = frozenset([_KIND_NUMBER])
+
+
+# the types of objects, arrays and numbers in queried data. The built-in types are listed 
+# first, as these are checked for quickly.
+_MAPPING_TYPES = (dict, _Mapping)
+_SEQUENCE_TYPES = (list, tuple, _Sequence)
+_CONTAINER_TYPES = (dict, list, tuple, _Container)
+_NUMBER_TYPES = (int, float, _Number)
+
+
+class _RecordView(collections.abc.Mapping):
+    """A read-only mapping of the fields of a NumPy structured array record, which refers to
+    the record's array rather than copying it"""
+
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    def __getitem__(self, key):
+        if key not in self.record.dtype.names:
+            raise KeyError(key)
+        return self.record[key]
+
+    def __iter__(self):
+        return iter(self.record.dtype.names)
+
+    def __len__(self):
+        return len(self.record.dtype.names)
+
+
+def _as_mapping(value):
+    """Returns an object supporting the `collections.abc.Mapping` methods for a value of the
+    mapping kind"""
+    return _RecordView(value) if _kinds.get(type(value)) == _KIND_RECORD else value
+
+
+def _is_array(value):
+    return _kind_of(value) == _KIND_ARRAY
+
+
+# Decoders: functions which decode JSON documents given as bytes or text
+
+def _orjson_loads():
+    import orjson
+    return orjson.loads, (orjson.JSONDecodeError,)
+
+
+def _msgspec_loads():
+    import msgspec
+    # msgspec's decode error is not a ValueError
+    return msgspec.json.Decoder().decode, (msgspec.DecodeError, ValueError)
+
+
+def _ujson_loads():
+    import ujson
+    return ujson.loads, (ValueError,)
+
+
+# functions importing the available decoders' loads functions, returning them with the 
+# exception types they raise for documents they can't decode, in order of preference
+_decoder_loaders = collections.OrderedDict([
+    (DECODER_ORJSON, _orjson_loads),
+    (DECODER_MSGSPEC, _msgspec_loads),
+    (DECODER_UJSON, _ujson_loads),
+    (DECODER_JSON, lambda: (json.loads, (ValueError,))),
+])
+
+_decoders = {}
+
+
+def register_decoder(name, loads, errors=(ValueError,)):
+    """Adds a decoder which documents can be decoded with, by passing its name as the 
+    ``decoder`` option. A decoder registered with the name of an existing one replaces it.
+
+    :param name: The name of the decoder
+    :type name: str
+    :param loads: Function which decodes a JSON document given as UTF-8 encoded bytes or as
+        text
+    :type loads: callable
+    :param errors: The exception types which the function raises for documents it can't 
+        decode, which are then decoded with the `json` module instead
+    :type errors: tuple
+    """
+    errors = tuple(errors)
+    _decoder_loaders[name] = lambda: (loads, errors)
+    _decoders.pop(name, None)
+    _decoders.pop(DECODER_AUTO, None)
+
+
+def available_decoders():
+    """Returns the names of the decoders which can be used, as their packages are installed,
+    in the order `DECODER_AUTO` prefers them
+
+    :rtype: list
+    """
+    names = []
+    for name in _decoder_loaders:
+        try:
+            _decoder(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def _decoder(name):
+    """Returns the loads function of the named decoder, with the exception types it raises 
+    for documents it can't decode"""
+    try:
+        return _decoders[name]
+    except KeyError:
+        pass
+    if name == DECODER_AUTO:
+        decoder = _decoder(available_decoders()[0])
+    elif name not in _decoder_loaders:
+        raise ValueError('Unknown decoder: {}'.format(name))
     else:
+        try:
+            decoder = _decoder_loaders[name]()
+        except ImportError as e:
+            raise ImportError('The {} decoder requires the {} package'.format(name, name)) from e
+    _decoders[name] = decoder
+    return decoder
+
+
+# a run of digits long enough to be an integer beyond 64 bits, which decoders other than the 
+# json module may decode inexactly, as a float
+_LONG_DIGITS = re.compile(r'\d{19}')
+_LONG_DIGITS_BYTES = re.compile(rb'\d{19}')
+
+
+def decode(document, decoder=DECODER_AUTO):
+    """Decodes a JSON document into a data structure of basic types, as the `json` module 
+    does, using the given decoder.
+
+    Documents which the decoder rejects are decoded with the `json` module instead, so that 
+    the values it supports beyond the JSON standard, such as ``NaN``, can still be decoded, 
+    and invalid documents raise the same error as they would with the `json` module. So are
+    documents containing integers which may be too large for 64 bits, as some decoders 
+    decode these as floats, so the result is always the same as with the `json` module.
+
+    :param document: The JSON document as UTF-8 encoded bytes, or as text
+    :type document: bytes, bytearray, memoryview, str
+    :param decoder: The name of the decoder to use: `DECODER_AUTO` (the default), for the 
+        fastest one installed, `DECODER_ORJSON`, `DECODER_MSGSPEC`, `DECODER_UJSON`, 
+        `DECODER_JSON` or one added with `register_decoder`
+    :type decoder: str
+    :return: The decoded data structure
+    :raises json.JSONDecodeError: if the document is not valid JSON
+    :raises ImportError: if the decoder's package is not installed
+    :example:
+
+    >>> import jsonpyth
+    >>> jsonpyth.decode(b'{"cats": ["Alfie"]}')
+    {'cats': ['Alfie']}
+    """
+    loads, errors = _decoder(decoder)
+    if loads is not json.loads:
+        digits = _LONG_DIGITS if isinstance(document, str) else _LONG_DIGITS_BYTES
+        if digits.search(document) is None:
+            try:
+                return loads(document)
+            except errors:
+                pass
+    if isinstance(document, memoryview):
+        document = document.tobytes()
+    return json.loads(document)
+
+
+_RAW_TYPES = (bytes, bytearray, memoryview)
+
+
+def _data_of(data, decoder=None):
+    if isinstance(data, LazyDocument):
+        return data.root
+    if isinstance(data, _RAW_TYPES) or (decoder is not None and isinstance(data, str)):
+        return decode(data, decoder or DECODER_AUTO)
+    return data
+
+
+_EV_START_MAP = 'start_map'
+_EV_END_MAP = 'end_map'
+_EV_START_ARRAY = 'start_array'
+_EV_END_ARRAY = 'end_array'
+_EV_KEY = 'key'
+_EV_VALUE = 'value'
+# yielded when a reader without a file object has run out of input, before it is fed more
+_EV_MORE = 'more'
+# yielded by the stream matcher after visiting a given number of nodes
+_EV_PAUSE = 'pause'
+
+_JSON_TOKEN = re.compile(r"""[ \t\n\r]*(?:
+      ([{}\[\],:])                                           # punctuation
+    | "((?:[^"\\]|\\.)*)"                                    # string
+    | (-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?)(?![\w.+-]) # number
+    | (true|false|null|NaN|Infinity|-Infinity)(?!\w)         # constant
+)""", re.VERBOSE | re.DOTALL)
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_CONSTANTS = { 'true': True, 'false': False, 'null': None, 'NaN': float('nan'),
+                    'Infinity': float('inf'), '-Infinity': float('-inf') }
+
+
+class _JsonReader:
+    """Incrementally tokenizes JSON read from a file object into a stream of parse events.
+
+    Events are 2-tuples of the event type and, for keys and scalar values, the decoded value.
+    Only a chunk of the file is held in memory at a time. Without a file object, the reader
+    yields an `_EV_MORE` event whenever it needs more input, which must then be given to 
+    `feed` before the events are resumed.
+    """
+
+    # parser states
+    VALUE, ARRAY_FIRST, ARRAY_NEXT, MAP_FIRST, MAP_KEY, MAP_COLON, MAP_NEXT, END = range(8)
+
+    def __init__(self, fp, chunk_size=STREAM_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        self.feed(self.fp.read(self.chunk_size))
+        return True
+
+    def feed(self, chunk):
+        """Adds the next chunk of input, or an empty chunk at the end of the input"""
+        if isinstance(chunk, bytes):
+            text = self.decoder.decode(chunk, final=not chunk)
+        else:
+            text = chunk
+        if not chunk:
+            self.eof = True
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+
+    def error(self, msg, pos):
+        pos = _JSON_WHITESPACE.match(self.buf, pos).end()
+        err = json.JSONDecodeError(msg, self.buf, pos)
+        err.pos = self.offset + pos
+        err.args = ('{} (char {})'.format(msg, err.pos),)
+        return err
+
+    def events(self):
+        token = _JSON_TOKEN
+        constants = _JSON_CONSTANTS
+        scanstring = json.decoder.scanstring
+        stack = []
+        state = self.VALUE
+        while True:
+            start = self.pos
+            match = token.match(self.buf, start)
+            # the token may continue past the end of the buffer, so read more until it can't
+            if (match is None or match.end() == len(self.buf)) and not self.eof:
+                if self.fp is not None:
+                    self.read_more()
+                else:
+                    yield (_EV_MORE, None)
+                continue
+            if match is None:
+                if _JSON_WHITESPACE.match(self.buf, start).end() < len(self.buf):
+                    raise self.error('Expecting value', start)
+                if state != self.END:
+                    raise self.error('Unexpected end of data', start)
+                return
+            if state == self.END:
+                raise self.error('Extra data', start)
+            self.pos = match.end()
+            kind = match.lastindex
+            if kind == 1:
+                punct = match.group(1)
+            else:
+                punct = None
+                if kind == 2:
+                    value = match.group(2)
+                    if '\\' in value:
+                        value = scanstring(value+'"', 0)[0]
+                elif kind == 3:
+                    value = match.group(3)
+                    value = float(value) if '.' in value or 'e' in value or 'E' in value else int(value)
+                else:
+                    value = constants[match.group(4)]
+
+            if state == self.VALUE or state == self.ARRAY_FIRST:
+                if punct is None:
+                    yield (_EV_VALUE, value)
+                elif punct == '{':
+                    stack.append(self.MAP_NEXT)
+                    state = self.MAP_FIRST
+                    yield (_EV_START_MAP, None)
+                    continue
+                elif punct == '[':
+                    stack.append(self.ARRAY_NEXT)
+                    state = self.ARRAY_FIRST
+                    yield (_EV_START_ARRAY, None)
+                    continue
+                elif punct == ']' and state == self.ARRAY_FIRST:
+                    stack.pop()
+                    yield (_EV_END_ARRAY, None)
+                else:
+                    raise self.error('Expecting value', start)
+            elif state == self.ARRAY_NEXT or state == self.MAP_NEXT:
+                if punct == ',':
+                    state = self.VALUE if state == self.ARRAY_NEXT else self.MAP_KEY
+                    continue
+                elif punct == ']' and state == self.ARRAY_NEXT:
+                    stack.pop()
+                    yield (_EV_END_ARRAY, None)
+                elif punct == '}' and state == self.MAP_NEXT:
+                    stack.pop()
+                    yield (_EV_END_MAP, None)
+                else:
+                    raise self.error('Expecting \',\' delimiter', start)
+            elif state == self.MAP_FIRST or state == self.MAP_KEY:
+                if kind == 2:
+                    state = self.MAP_COLON
+                    yield (_EV_KEY, value)
+                    continue
+                elif punct == '}' and state == self.MAP_FIRST:
+                    stack.pop()
+                    yield (_EV_END_MAP, None)
+                else:
+                    raise self.error('Expecting property name enclosed in double quotes', start)
+            else:
+                if punct != ':':
+                    raise self.error('Expecting \':\' delimiter', start)
+                state = self.VALUE
+                continue
+            # a value has been completed
+            state = stack[-1] if stack else self.END
+
+
+def _build_value(event, value, events):
+    """Materialises the value starting with the given event from the rest of the events. This
+    is a generator which passes on any `_EV_MORE` events, and returns the value."""
+    if event == _EV_VALUE:
+        return value
+    root = {} if event == _EV_START_MAP else []
+    stack = [root]
+    key = None
+    for event, value in events:
+        if event == _EV_MORE:
+            yield event
+            continue
+        if event == _EV_KEY:
+            key = value
+            continue
+        if event == _EV_END_MAP or event == _EV_END_ARRAY:
+            stack.pop()
+            if not stack:
+                return root
+            continue
+        if event == _EV_START_MAP:
+            value = {}
+        elif event == _EV_START_ARRAY:
+            value = []
+        top = stack[-1]
+        if type(top) is dict:
+            top[key] = value
+        else:
+            top.append(value)
+        if event != _EV_VALUE:
+            stack.append(value)
+
+
+def _skip_value(event, events):
+    """Consumes the events of the value starting with the given event without building it. 
+    This is a generator which passes on any `_EV_MORE` events."""
+    if event != _EV_START_MAP and event != _EV_START_ARRAY:
+        return
+    depth = 1
+    for event, value in events:
+        if event == _EV_MORE:
+            yield event
+        elif event == _EV_START_MAP or event == _EV_START_ARRAY:
+            depth += 1
+        elif event == _EV_END_MAP or event == _EV_END_ARRAY:
+            depth -= 1
+            if depth == 0:
+                return
+
+
+class _StreamMatcher:
+    """Matches the steps of a path against a stream of JSON parse events.
+
+    Each node of the stream is given the list of positions in the path which it has been 
+    reached at, much like the states of a non-deterministic automaton. A position equal to the
+    length of the path means the node is a match. A node is only materialised if it matches
+    or a filter needs to test it; any remaining steps are then evaluated in memory.
+    """
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.targets = []
+        self.recursive = []
+        for i,step in enumerate(self.steps):
+            if not isinstance(step, (PChild, PRecursive)):
+                raise ValueError('Step {} cannot be evaluated on a stream'.format(repr(step)))
+            for targ in step.targets:
+                self.check_target(i, step, targ)
+            self.targets.append(tuple(step.targets))
+            self.recursive.append(isinstance(step, PRecursive))
+
+    def check_target(self, i, step, targ):
+        if isinstance(targ, (PCurrent, PProperty, PWildcard)):
+            return
+        if isinstance(targ, PRoot) and i == 0 and isinstance(step, PChild) and len(step.targets) == 1:
+            return
+        if isinstance(targ, PSlice):
+            index = getattr(targ, 'index', None)
+            start = getattr(targ, 'start', None)
+            end = getattr(targ, 'end', None)
+            stride = getattr(targ, 'step', None)
+            if index is not None and index >= 0 or index is None and (start or 0) >= 0 \
+                    and (end is None or end >= 0) and (stride is None or stride > 0):
+                return
+        if isinstance(targ, PFilter) and not targ.uses_root:
+            return
+        raise ValueError('{} cannot be evaluated on a stream'.format(repr(targ)))
+
+    def start_states(self):
+        if len(self.steps) > 0 and isinstance(self.steps[0].targets[0], PRoot):
+            return [1]
+        return [0]
+
+    def closure(self, states):
+        """Adds the positions reached by current node (@) targets, which don't move the node"""
+        result = []
+        pending = list(states)
+        while pending:
+            state = pending.pop()
+            result.append(state)
+            if state < len(self.steps):
+                for targ in self.targets[state]:
+                    if isinstance(targ, PCurrent):
+                        pending.append(state+1)
         return result
 
+    def child_states(self, states, key):
+        """Returns the positions a child with the given key is reached at, and a list of 
+        (filter, position) pairs to be tested against the child's value"""
+        reached = []
+        filters = []
+        for state in states:
+            if state == len(self.steps):
+                continue
+            if self.recursive[state]:
+                reached.append(state)
+            for targ in self.targets[state]:
+                if isinstance(targ, PFilter):
+                    filters.append((targ, state))
+                elif self.target_matches(targ, key):
+                    reached.append(state+1)
+        return reached, filters
+
+    def target_matches(self, targ, key):
+        if isinstance(targ, PWildcard):
+            return True
+        if isinstance(targ, PProperty):
+            return isinstance(key, str) and key == targ.name
+        if isinstance(targ, PSlice) and isinstance(key, int):
+            index = getattr(targ, 'index', None)
+            if index is not None:
+                return key == index
+            start = getattr(targ, 'start', None) or 0
+            end = getattr(targ, 'end', None)
+            stride = getattr(targ, 'step', None) or 1
+            return key >= start and (end is None or key < end) and (key - start) % stride == 0
+        return False
+
+    def finish_in_memory(self, node, states):
+        """Yields the matches for a materialised node reached at the given positions, in 
+        document order"""
+        matches = []
+        for state in states:
+            currnodes = [node]
+            for step in self.steps[state:]:
+                currnodes = step.apply_to(None, currnodes)
+            matches.extend(currnodes)
+        if len(matches) > 1:
+            # the steps visit properties in sorted order and children before grandchildren,
+            # so the matches are sorted by their position in the node, which comes before
+            # any of its descendants
+            positions = {}
+            matches.sort(key=lambda match: self.position_in(node, match, positions))
+        yield from matches
+
+    @staticmethod
+    def position_in(node, match, positions):
+        """Returns the position of a node within a materialised ancestor, as a tuple of the 
+        index of each key along the path to it"""
+        indices = []
+        while match is not node:
+            parent = match.parent
+            if isinstance(parent.value, dict):
+                # the properties of built objects are in document order
+                try:
+                    keys = positions[id(parent.value)]
+                except KeyError:
+                    keys = positions[id(parent.value)] = { k: i for i, k in enumerate(parent.value) }
+                indices.append(keys[match.key])
+            else:
+                indices.append(match.key)
+            match = parent
+        indices.reverse()
+        return tuple(indices)
+
+    def match(self, events, pause_every=None):
+        """Yields the matching nodes for the given parse events. Any `_EV_MORE` events are 
+        passed on, and if `pause_every` is given, an `_EV_PAUSE` event is yielded after each
+        time that many nodes have been visited."""
+        event, value = next(events)
+        while event == _EV_MORE:
+            yield event
+            event, value = next(events)
+        warning = _warning_enabled()
+        final = len(self.steps)
+        stack = []
+        pending = (_Node(None), self.start_states(), event, value)
+        visited = 0
+        while True:
+            if pending is not None:
+                node, reached, event, value = pending
+                pending = None
+                states = self.closure(reached)
+                if not states:
+                    yield from _skip_value(event, events)
+                elif final in states:
+                    # evaluating the steps from each reached position in memory also covers the
+                    # positions added by the closure
+                    node.value = yield from _build_value(event, value, events)
+                    yield from self.finish_in_memory(node, reached)
+                elif event == _EV_START_MAP or event == _EV_START_ARRAY:
+                    stack.append([node, states, event == _EV_START_MAP, 0])
+            if not stack:
+                # check there is nothing but whitespace after the document
+                for event, value in events:
+                    if event == _EV_MORE:
+                        yield event
+                return
+            frame = stack[-1]
+            event, value = next(events)
+            while event == _EV_MORE:
+                yield event
+                event, value = next(events)
+            if event == _EV_END_MAP or event == _EV_END_ARRAY:
+                stack.pop()
+                continue
+            if frame[2]:
+                key = value
+                event, value = next(events)
+                while event == _EV_MORE:
+                    yield event
+                    event, value = next(events)
+            else:
+                key = frame[3]
+                frame[3] += 1
+            if pause_every is not None:
+                visited += 1
+                if visited >= pause_every:
+                    visited = 0
+                    yield _EV_PAUSE
+            child = _Node(None, frame[0], key)
+            reached, filters = self.child_states(frame[1], key)
+            if filters:
+                child.value = yield from _build_value(event, value, events)
+                for filt, state in filters:
+                    if filt.accepts(None, child, None, warning):
+                        reached.append(state+1)
+                yield from self.finish_in_memory(child, reached)
+            else:
+                pending = (child, reached, event, value)
+
+
+def stream(fp, steps, chunk_size=STREAM_CHUNK_SIZE):
+    """Applies a JSONPath representation to JSON read incrementally from a file object.
+
+    The JSON is tokenized a chunk at a time rather than loaded in full, and only the values of
+    matching nodes (and of nodes tested by filters) are materialised, so memory use is bounded
+    by the size of the largest match rather than that of the document. Results are yielded as
+    they are found, in document order, which may differ from the order `evaluate` would 
+    return them in.
+
+    Streaming supports property, wildcard and current node targets, non-negative indices and 
+    slices, and filters which don't refer to the root node, in child and recursive steps. A
+    root node target is only supported at the start of the path.
+
+    :param fp: The file object to read JSON from, in binary (UTF-8) or text mode
+    :param steps: The JSONPath representation, as returned by the `parse` function
+    :type steps: list
+    :param chunk_size: The number of bytes to read from the file at a time
+    :type chunk_size: int
+    :return: Iterator of 2-tuples, each containing the value followed by the path.
+    :rtype: iterator
+    :raises ValueError: if the path includes a step which cannot be evaluated on a stream
+    :raises json.JSONDecodeError: if the file does not contain valid JSON
+    :raises PythonSyntaxError: if the JSONPath includes an invalid Python script expression
+    """
+    _check_code(steps)
+    matcher = _StreamMatcher(steps)
+    events = _JsonReader(fp, chunk_size).events()
+    return _results(_reraise_syntax_errors(matcher.match(events)), RESULT_TYPE_BOTH)
+
+
+def _take(iterator, count):
+    return list(itertools.islice(iterator, count))
+
+
+async def stream_async(source, steps, chunk_size=STREAM_CHUNK_SIZE, yield_every=ASYNC_YIELD_EVERY):
+    """Applies a JSONPath representation to JSON read incrementally from an async stream.
+
+    This is the `asyncio` form of `stream`, and is evaluated in the same way. The event loop is
+    given the chance to run other tasks after each chunk of input, and each time the given 
+    number of nodes have been visited, so that a large document doesn't hold it up.
+
+    :param source: The stream to read JSON from: an object with a `read` coroutine method,
+        such as `asyncio.StreamReader`, or an async iterable of chunks. Chunks may be UTF-8
+        encoded bytes or text.
+    :param steps: The JSONPath representation, as returned by the `parse` function
+    :type steps: list
+    :param chunk_size: The number of bytes to read from a `read` method at a time
+    :type chunk_size: int
+    :param yield_every: The number of nodes to visit between yielding to the event loop
+    :type yield_every: int
+    :return: Async iterator of 2-tuples, each containing the value followed by the path.
+    :rtype: async iterator
+    :raises ValueError: if the path includes a step which cannot be evaluated on a stream, or
+        if `yield_every` is less than 1
+    :raises json.JSONDecodeError: if the stream does not contain valid JSON
+    :raises PythonSyntaxError: if the JSONPath includes an invalid Python script expression
+    """
+    import asyncio
+    if yield_every < 1:
+        raise ValueError('yield_every must be at least 1')
+    _check_code(steps)
+    matcher = _StreamMatcher(steps)
+    reader = _JsonReader(None, chunk_size)
+    chunks = _read_chunks(source, chunk_size) if hasattr(source, 'read') else source.__aiter__()
+    for node in _reraise_syntax_errors(matcher.match(reader.events(), yield_every)):
+        if node == _EV_MORE:
+            reader.feed(await _next_chunk(chunks))
+            await asyncio.sleep(0)
+        elif node == _EV_PAUSE:
+            await asyncio.sleep(0)
+        else:
+            yield node.value, node.path
+
+
+async def _read_chunks(source, chunk_size):
+    while True:
+        chunk = await source.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _next_chunk(chunks):
+    """Returns the next non-empty chunk from an async iterator, or an empty one at the end"""
+    async for chunk in chunks:
+        if chunk:
+            return chunk
+    return b''
@@ -19,8 +19,8 @@ setup(
     license='MIT',
     keywords='json jsonpath xpath query',
     url='https://github.com/Frimkron/JSONPyth',
-    python_requires='>=3.5',
-    install_requires=['pyparsing>=2.2.2'],
+    python_requires='>=3.6',
+    extras_require={'pyparsing': ['pyparsing>=2.2.2'], 'orjson': ['orjson>=3']},
     test_suite='tests',
     classifiers=[
         "Programming Language :: Python :: 3 :: Only",
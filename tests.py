@@ -1,7 +1,28 @@
 import unittest
+import unittest.mock
+import asyncio
+import collections.abc
+import concurrent.futures
+import io
+import json
+import pickle
+import tempfile
+import os
+import sys
 import logging
+import types
 import jsonpyth as jp
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyparsing
+except ImportError:
+    pyparsing = None
+
 
 logging.getLogger().setLevel(logging.ERROR)
 
@@ -588,6 +609,64 @@ class TestParse(unittest.TestCase):
         self.assertEqual(expected, tuple(targs))
 
 
+class TestParsers(unittest.TestCase):
+
+    PYTHON_EXPRESSIONS = ['$', '@.a', '.a', '..a', '[0]', '$.a.b[*]..c', '$["a", \'b\', 0, -1, *]',
+                          '$[1:2]', '$[:-1:2]', '$[::]', '$[ 1 : 2 ]', '$.("a")', '$[?(@ > 1)]',
+                          '$."a\\tb\\"c"', ' $ . a ']
+    SAFE_EXPRESSIONS = ['$', '.a', '..a', '$["a", 0, *][1:2]', '$..[0]', '$[?@.a]', '$[?@.a == 1 && (@.b != "x" || !@.c)]', '$[?@.a in [1, 2.5, null]]',
+                        '$[?@.a in $.b]', '$..[?@["a"][0] >= -1e3]', '$..[*]', '$[?@..a]']
+    BAD_EXPRESSIONS = ['', '~', '[', '[a', '$.', '$.a,', '$[1', '$[-]', '$.a.\n.b', '$."a',
+                       '$[?(1)', '$[?@.a ==]', '$[?@.a in]', '$[?truex]', '$[?@.a && ]', '..[']
+
+    def test_raises_error_for_unknown_parser(self):
+        with self.assertRaises(ValueError):
+            jp.parse('$', parser='foo')
+
+    def test_reports_error_position(self):
+        with self.assertRaises(jp.JsonPathSyntaxError) as cm:
+            jp.parse('$.a,')
+        self.assertEqual(('$.a,', 4), (cm.exception.linetext, cm.exception.col))
+
+    def test_reports_error_position_on_line(self):
+        with self.assertRaises(jp.JsonPathSyntaxError) as cm:
+            jp.parse('$.a\n .b.~')
+        self.assertEqual((' .b.~', 4), (cm.exception.linetext, cm.exception.col))
+
+    def test_reports_non_singular_query_in_comparison(self):
+        with self.assertRaises(jp.JsonPathSyntaxError) as cm:
+            jp.parse('$.a[?@.* == 1]', jp.DIALECT_SAFE)
+        self.assertEqual(6, cm.exception.col)
+        self.assertIn('Non-singular', cm.exception.msg)
+
+    def test_import_does_not_load_pyparsing(self):
+        import subprocess, sys
+        output = subprocess.check_output([sys.executable, '-c', 
+            'import sys, jsonpyth; jsonpyth.parse("$.a[?(1)]"); print("pyparsing" in sys.modules)'])
+        self.assertEqual('False', output.decode().strip())
+
+    @unittest.skipIf(pyparsing is None, 'pyparsing is not installed')
+    def test_parsers_produce_same_tree(self):
+        for dialect, exprs in ((jp.DIALECT_PYTHON, self.PYTHON_EXPRESSIONS), 
+                               (jp.DIALECT_SAFE, self.SAFE_EXPRESSIONS)):
+            for expr in exprs:
+                with self.subTest(dialect=dialect, expr=expr):
+                    self.assertEqual(jp._structure_key(jp.parse(expr, dialect, jp.PARSER_PYPARSING)),
+                                     jp._structure_key(jp.parse(expr, dialect)))
+
+    @unittest.skipIf(pyparsing is None, 'pyparsing is not installed')
+    def test_parsers_report_errors_at_same_position(self):
+        for dialect in (jp.DIALECT_PYTHON, jp.DIALECT_SAFE):
+            for expr in self.BAD_EXPRESSIONS:
+                with self.subTest(dialect=dialect, expr=expr):
+                    errors = []
+                    for parser in (jp.PARSER_NATIVE, jp.PARSER_PYPARSING):
+                        with self.assertRaises(jp.JsonPathSyntaxError) as cm:
+                            jp.parse(expr, dialect, parser)
+                        errors.append((cm.exception.linetext, cm.exception.col, cm.exception.msg))
+                    self.assertEqual(errors[1], errors[0])
+
+
 class TestEvaluate(unittest.TestCase):
 
     example = {
@@ -778,6 +857,22 @@ class TestEvaluate(unittest.TestCase):
                              [jp.PChild(targets=[jp.PSlice(start=1),jp.PSlice(end=-1)])] )
         self.assertEqual([('b', '$[1]'), ('c', '$[2]'), ('a', '$[0]'), ('b', '$[1]')], result)
 
+    def test_evaluates_slice_with_negative_start_on_long_sequence(self):
+        result = jp.evaluate(list(range(100000)),
+                             [jp.PChild(targets=[jp.PSlice(start=-3)])] )
+        self.assertEqual([(99997, '$[99997]'), (99998, '$[99998]'), (99999, '$[99999]')], result)
+
+    def test_evaluates_slice_with_negative_step_and_bounds(self):
+        result = jp.evaluate(['a','b','c','d','e'],
+                             [jp.PChild(targets=[jp.PSlice(start=-1, end=0, step=-2)])] )
+        self.assertEqual([('e', '$[4]'), ('c', '$[2]')], result)
+
+    def test_evaluates_union_of_indices_in_target_order(self):
+        result = jp.evaluate(['a','b','c','d','e'],
+                             [jp.PChild(targets=[jp.PSlice(index=3), jp.PSlice(index=0), 
+                                                 jp.PSlice(index=-1), jp.PSlice(index=7)])] )
+        self.assertEqual([('d', '$[3]'), ('a', '$[0]'), ('e', '$[-1]')], result)
+
     # recursive steps
 
     def test_evaluates_recursive_step_in_top_down_order(self):
@@ -814,6 +909,25 @@ class TestEvaluate(unittest.TestCase):
                           ({"b":2}, '$["b"]["a"]["b"]'), (1, '$["a"]["a"]["b"]'),
                           (2, '$["b"]["a"]["b"]["b"]')], result)
 
+    def test_evaluates_recursive_step_on_deeply_nested_data(self):
+        data = {"a": 0}
+        for i in range(1, 5000):
+            data = {"a": i, "b": data}
+        result = jp.jsonpath(data, '$..a')
+        self.assertEqual(list(range(4999, -1, -1)), result)
+
+    def test_evaluates_recursive_step_on_deeply_nested_sequences(self):
+        data = []
+        for i in range(5000):
+            data = [data]
+        result = jp.jsonpath(data, '$..*')
+        self.assertEqual(5000, len(result))
+
+    def test_evaluates_recursive_root_target_for_each_node_searched(self):
+        result = jp.evaluate([1,[2]],
+                             [jp.PRecursive(targets=[jp.PRoot()])] )
+        self.assertEqual([([1,[2]], '$')]*5, result)
+
     # expressions
 
     def test_evaluates_expression_child_for_key(self):
@@ -939,6 +1053,26 @@ class TestEvaluate(unittest.TestCase):
             jp.evaluate([1,2,3,4,5],
                         [jp.PChild(targets=[jp.PExpression(code='^!*&~')])] )
                         
+    def test_raises_error_for_bad_syntax_in_filter_with_no_nodes(self):
+        with self.assertRaises(jp.PythonSyntaxError):
+            jp.evaluate({}, [jp.PChild(targets=[jp.PFilter(code='^!*&~')])] )
+
+    def test_evaluates_filter_repeatedly_with_different_nodes(self):
+        filt = jp.PFilter(code='@ > $["min"]')
+        steps = [jp.PChild(targets=[jp.PProperty(name='vals')]), jp.PChild(targets=[filt])]
+        self.assertEqual([(3, '$["vals"][1]')], jp.evaluate({"min":2, "vals":[1,3]}, steps))
+        self.assertEqual([(1, '$["vals"][0]')], jp.evaluate({"min":0, "vals":[1,-1]}, steps))
+
+    def test_evaluates_comprehension_using_current_node_in_filter(self):
+        result = jp.evaluate([[1,2],[3,4]],
+                             [jp.PChild(targets=[jp.PFilter(code='any(x > 3 for x in @ if x in @)')])] )
+        self.assertEqual([([3,4], '$[1]')], result)
+
+    def test_evaluates_filter_ending_in_comment(self):
+        result = jp.evaluate([1,2],
+                             [jp.PChild(targets=[jp.PFilter(code='@ > 1 # comment')])] )
+        self.assertEqual([(2, '$[1]')], result)
+
     def test_evaluates_filter_with_builtins(self):
         result = jp.evaluate([1,2,3],
                              [jp.PChild(targets=[jp.PFilter(code='len("foo") > 2')])] )
@@ -1180,6 +1314,14 @@ class TestJsonPath(unittest.TestCase):
         result = jp.jsonpath({"a":1, "b":2, "c":"d"}, '$[*]', jp.RESULT_TYPE_BOTH)
         self.assertEqual([(1, '$["a"]'), (2, '$["b"]'), ("d", '$["c"]')], result)
 
+    def test_returns_escaped_paths_for_special_keys(self):
+        result = jp.jsonpath({'a"b': {'c\\d': 1}}, '$.*.*', jp.RESULT_TYPE_PATH)
+        self.assertEqual(['$["a\\"b"]["c\\\\d"]'], result)
+
+    def test_returns_paths_for_nested_indices_and_keys(self):
+        result = jp.jsonpath({"a":[[0,{"b":1}]]}, '$.a[0][1].b', jp.RESULT_TYPE_BOTH)
+        self.assertEqual([(1, '$["a"][0][1]["b"]')], result)
+
     def test_returns_false_on_no_match(self):
         result = jp.jsonpath({"a":1, "b":2, "c":"d"}, '$.e')
         self.assertEqual(False, result)
@@ -1188,3 +1330,1380 @@ class TestJsonPath(unittest.TestCase):
         result = jp.jsonpath({"a":1, "b":2, "c":"d"}, '$.e', always_return_list=True)
         self.assertEqual([], result)
 
+
+
+class TestCompile(unittest.TestCase):
+
+    data = {"a": [{"b": 1}, {"b": 2}, {"c": 3}]}
+
+    def setUp(self):
+        jp.cache_clear()
+
+    def test_returns_query_with_steps(self):
+        result = jp.compile('$.a')
+        self.assertIsInstance(result, jp.Query)
+        self.assertEqual('$.a', result.expr)
+        self.assertEqual((jp.PChild, jp.PChild), tuple(type(s) for s in result.steps))
+
+    def test_query_finds_values_and_paths(self):
+        result = jp.compile('$.a[*].b').find(self.data)
+        self.assertEqual([(1, '$["a"][0]["b"]'), (2, '$["a"][1]["b"]')], result)
+
+    def test_query_returns_values(self):
+        result = jp.compile('$.a[*].b').values(self.data)
+        self.assertEqual([1, 2], result)
+
+    def test_query_returns_paths(self):
+        result = jp.compile('$.a[*].b').paths(self.data)
+        self.assertEqual(['$["a"][0]["b"]', '$["a"][1]["b"]'], result)
+
+    def test_query_returns_empty_list_on_no_match(self):
+        result = jp.compile('$.z').values(self.data)
+        self.assertEqual([], result)
+
+    def test_query_is_immutable(self):
+        query = jp.compile('$.a')
+        with self.assertRaises(AttributeError):
+            query.expr = '$.b'
+
+    def test_raises_error_for_bad_syntax(self):
+        with self.assertRaises(jp.JsonPathSyntaxError):
+            jp.compile('$.~')
+
+    def test_returns_cached_query_for_same_expression(self):
+        self.assertIs(jp.compile('$.a'), jp.compile('$.a'))
+
+    def test_records_cache_hits_and_misses(self):
+        jp.compile('$.a')
+        jp.compile('$.a')
+        jp.compile('$.b')
+        info = jp.cache_info()
+        self.assertEqual(1, info.hits)
+        self.assertEqual(2, info.misses)
+        self.assertEqual(2, info.currsize)
+        self.assertEqual(jp.CACHE_SIZE, info.maxsize)
+
+    def test_jsonpath_uses_cache(self):
+        jp.jsonpath(self.data, '$.a')
+        jp.jsonpath(self.data, '$.a')
+        self.assertEqual(1, jp.cache_info().hits)
+
+    def test_raises_error_for_bad_python_syntax(self):
+        with self.assertRaises(jp.PythonSyntaxError):
+            jp.compile('$[?(@ ^!*&~)]')
+
+
+class TestOptimise(unittest.TestCase):
+
+    DATA = {"a": [{"b": {"c": 1}}, {"b": [5, 6]}, 7], "b": {"0": "zero", "c": 2}, 
+            "t": ({"b": 3},)}
+
+    def step_types(self, expr):
+        return [type(s) for s in jp.optimise(jp.parse(expr))]
+
+    def test_results_match_unoptimised(self):
+        for expr in ['$.a[*].b.c', '$.a[0].b', '$[*][0]', '$.a[-1]', '$.a[*].b[1]', '@.a.@[0]', 
+                     '@', '$.b["0"]', '$[("b")].c', '$.a[(1+1)]', '$.a[(-1.5)]', '$.a[(True)]', 
+                     '$.a[("x")]', '$..("b")', '$.a[*][*]', '$.a,b.c', '$.a[0:2].b', '$..b.c', 
+                     '$.t[*].b', '$.b[*].c', '$.*.b[0]']:
+            with self.subTest(expr=expr):
+                steps = jp.parse(expr)
+                self.assertEqual(jp.evaluate(self.DATA, steps), 
+                                 jp.evaluate(self.DATA, jp.optimise(steps)))
+
+    def test_fuses_property_and_index_chain(self):
+        steps = jp.optimise(jp.parse('$.a[0].b.c'))
+        self.assertEqual([jp.PChild, jp.PChain], [type(s) for s in steps])
+        self.assertEqual(('a', 0, 'b', 'c'), steps[1].keys)
+        self.assertFalse(steps[1].wildcard)
+
+    def test_fuses_wildcard_with_following_keys(self):
+        steps = jp.optimise(jp.parse('$.a[*][0]'))
+        self.assertEqual([jp.PChild, jp.PChain, jp.PChain], [type(s) for s in steps])
+        self.assertTrue(steps[2].wildcard)
+        self.assertEqual((0,), steps[2].keys)
+
+    def test_leaves_lone_wildcard(self):
+        self.assertEqual([jp.PChild, jp.PChild, jp.PChild], self.step_types('$[*][*]'))
+
+    def test_removes_current_node_steps(self):
+        self.assertEqual([jp.PChain], self.step_types('@.a.@'))
+        self.assertEqual([], self.step_types('@'))
+
+    def test_folds_constant_expressions(self):
+        steps = jp.optimise(jp.parse('$..("b")[(2*3-5)]'))
+        self.assertEqual(jp.PProperty, type(steps[1].targets[0]))
+        self.assertEqual('b', steps[1].targets[0].name)
+        self.assertEqual((1,), steps[2].keys)
+
+    def test_leaves_expressions_using_nodes_or_failing(self):
+        for expr in ['$[(@["a"])]', '$[($["a"])]', '$[(1/0)]', '$[(None)]', '$[(len\\(""\\))]']:
+            with self.subTest(expr=expr):
+                self.assertIs(jp.PExpression, type(jp.optimise(jp.parse(expr))[1].targets[0]))
+
+    def test_query_evaluates_plan(self):
+        query = jp.compile('$.a[0].b.c')
+        self.assertEqual([jp.PChild, jp.PChain], [type(s) for s in query.plan])
+        with unittest.mock.patch.object(jp.PProperty, 'apply_to') as apply_to:
+            self.assertEqual([1], query.values(self.DATA))
+        apply_to.assert_not_called()
+
+    def test_diagnostics_count_parsed_steps(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath(self.DATA, '$.a[*].b.c', diagnostics=diag)
+        self.assertEqual(5, len(diag.steps))
+        self.assertEqual(1, diag.steps[4].skipped)
+
+
+class TestCodegen(unittest.TestCase):
+
+    DATA = {"a": [{"b": {"c": 1}, "d": 4}, {"b": [5, 6], "d": 2}, 7], "b": {"0": "zero", "c": 2}}
+
+    def test_results_match_interpreter(self):
+        for expr in ['$.a[*].b.c', '$.a[0].b', '$[*][0]', '@.a.@[-1]', '@', '$.a[(1+1)]', 
+                     '$.a[(@["x"] if False else 0)]', '$..c', '$..*', '$.a,b[*]', '$.a.$.b', 
+                     '$.a[1:].b[::-1]', '$.a[?(@["d"] > 3)].b', '$..b[?(@ == $["a"][0]["b"]["c"])]', 
+                     '$.b..(\'c\')', '$..0,c']:
+            with self.subTest(expr=expr):
+                interpreted = jp.compile(expr)
+                generated = jp.compile(expr, backend=jp.BACKEND_CODEGEN)
+                self.assertIsNotNone(generated.source)
+                self.assertEqual(interpreted.find(self.DATA), generated.find(self.DATA))
+                self.assertEqual(interpreted.values(self.DATA), generated.values(self.DATA))
+
+    def test_results_match_interpreter_for_safe_dialect(self):
+        for expr in ['$.a[?@.d > 3].b', '$..[?@ == 2 || @.c]']:
+            with self.subTest(expr=expr):
+                interpreted = jp.compile(expr, jp.DIALECT_SAFE)
+                generated = jp.compile(expr, jp.DIALECT_SAFE, jp.BACKEND_CODEGEN)
+                self.assertEqual(interpreted.find(self.DATA), generated.find(self.DATA))
+
+    def test_evaluates_generated_function(self):
+        query = jp.compile('$.a[*].b.c', backend=jp.BACKEND_CODEGEN)
+        self.assertIn('def _jp_values(', query.source)
+        with unittest.mock.patch.object(jp.PChain, 'apply_to') as apply_to:
+            self.assertEqual([1], query.values(self.DATA))
+            self.assertEqual([(1, '$["a"][0]["b"]["c"]')], query.find(self.DATA))
+            self.assertEqual(1, query.first(self.DATA))
+            self.assertTrue(query.exists(self.DATA))
+        apply_to.assert_not_called()
+
+    def test_interprets_unsupported_steps(self):
+        query = jp.compile('$.a..$', backend=jp.BACKEND_CODEGEN)
+        self.assertIsNone(query.source)
+        self.assertEqual(jp.compile('$.a..$').values(self.DATA), query.values(self.DATA))
+
+    def test_interprets_with_diagnostics(self):
+        diag = jp.Diagnostics()
+        jp.compile('$.a[*].b.c', backend=jp.BACKEND_CODEGEN).values(self.DATA, diagnostics=diag)
+        self.assertEqual(1, diag.steps[3].skipped)
+
+    def test_logs_script_errors(self):
+        query = jp.compile('$.a[?(@["d"] > 3)]', backend=jp.BACKEND_CODEGEN)
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual([self.DATA["a"][0]], query.values(self.DATA))
+        self.assertEqual(1, len(logs.records))
+        self.assertIn('TypeError evaluating python filter script', logs.output[0])
+
+    def test_raises_error_for_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            jp.compile('$.a', backend='llvm')
+
+    def test_pickles(self):
+        query = pickle.loads(pickle.dumps(jp.compile('$.a[*].d', backend=jp.BACKEND_CODEGEN)))
+        self.assertEqual(jp.BACKEND_CODEGEN, query.backend)
+        self.assertEqual([4, 2], query.values(self.DATA))
+
+    def test_repr_includes_backend(self):
+        self.assertEqual("Query('$.a', backend='codegen')", 
+                         repr(jp.compile('$.a', backend=jp.BACKEND_CODEGEN)))
+
+
+class _CountingDict(dict):
+
+    lookups = 0
+
+    def __getitem__(self, key):
+        type(self).lookups += 1
+        return super().__getitem__(key)
+
+
+class TestIterate(unittest.TestCase):
+
+    def setUp(self):
+        _CountingDict.lookups = 0
+
+    def test_iterate_yields_values_and_paths(self):
+        result = jp.iterate({"a":[1,2]}, jp.parse('$.a[*]'))
+        self.assertEqual((1, '$["a"][0]'), next(result))
+        self.assertEqual([(2, '$["a"][1]')], list(result))
+
+    def test_iterate_raises_error_for_bad_syntax_before_iterating(self):
+        with self.assertRaises(jp.PythonSyntaxError):
+            jp.iterate([1], [jp.PChild(targets=[jp.PFilter(code='^!*&~')])])
+
+    def test_ijsonpath_yields_values_by_default(self):
+        result = jp.ijsonpath({"a":[1,2]}, '$.a[*]')
+        self.assertEqual([1, 2], list(result))
+
+    def test_ijsonpath_yields_paths_if_specified(self):
+        result = jp.ijsonpath({"a":[1,2]}, '$.a[*]', jp.RESULT_TYPE_PATH)
+        self.assertEqual(['$["a"][0]', '$["a"][1]'], list(result))
+
+    def test_ijsonpath_evaluates_lazily(self):
+        data = [_CountingDict(a=i) for i in range(10)]
+        result = jp.ijsonpath(data, '$[*].a')
+        self.assertEqual(0, next(result))
+        self.assertEqual(1, _CountingDict.lookups)
+
+    def test_jsonpath_stops_at_limit(self):
+        data = [_CountingDict(a=i) for i in range(10)]
+        result = jp.jsonpath(data, '$[*].a', limit=3)
+        self.assertEqual([0, 1, 2], result)
+        self.assertEqual(3, _CountingDict.lookups)
+
+    def test_query_find_stops_at_limit(self):
+        result = jp.compile('$[*]').find([5,6,7], limit=2)
+        self.assertEqual([(5, '$[0]'), (6, '$[1]')], result)
+
+    def test_query_first_returns_first_value(self):
+        data = [_CountingDict(a=i) for i in range(10)]
+        self.assertEqual(0, jp.compile('$[*].a').first(data))
+        self.assertEqual(1, _CountingDict.lookups)
+
+    def test_query_first_returns_default_on_no_match(self):
+        self.assertEqual('x', jp.compile('$.b').first({"a":1}, 'x'))
+
+    def test_query_exists_stops_at_first_match(self):
+        data = [_CountingDict(a=i) for i in range(10)]
+        self.assertTrue(jp.compile('$[?(@["a"] > 3)]').exists(data))
+        self.assertEqual(5, _CountingDict.lookups)
+
+    def test_query_exists_returns_false_on_no_match(self):
+        self.assertFalse(jp.compile('$.b').exists({"a":1}))
+
+    def test_query_iterate_yields_values_and_paths(self):
+        result = jp.compile('$.a').iterate({"a":1})
+        self.assertEqual([(1, '$["a"]')], list(result))
+
+
+class TestDiagnostics(unittest.TestCase):
+
+    def test_counts_skipped_nodes_for_step(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath([1, 'a', {'b':1}, [2]], '$[*].b', diagnostics=diag)
+        self.assertEqual(3, diag.steps[2].skipped)
+        self.assertEqual(0, diag.steps[2].missing)
+
+    def test_counts_missing_keys_for_step(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath([{'a':1}, {'b':2}, {'c':3}], '$[*].b', diagnostics=diag)
+        self.assertEqual(2, diag.steps[2].missing)
+
+    def test_counts_missing_indices_for_step(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath([[1], [1,2], [1,2,3]], '$[*][2]', diagnostics=diag)
+        self.assertEqual(2, diag.steps[2].missing)
+
+    def test_counts_script_errors_for_step(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath([{'a':1}, {'b':2}, 3], '$[?(@["a"] > 0)]', diagnostics=diag)
+        self.assertEqual(2, diag.steps[1].script_errors)
+
+    def test_counts_skipped_expression_keys(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath({'a':[1,2], 'b':{'c':1}}, '$.*[("c")]', diagnostics=diag)
+        self.assertEqual(1, diag.steps[2].skipped)
+
+    def test_accumulates_counts_over_evaluations(self):
+        diag = jp.Diagnostics()
+        query = jp.compile('$[*].b')
+        query.values([{}], diagnostics=diag)
+        query.values([{}, {}], diagnostics=diag)
+        self.assertEqual(3, diag.steps[2].missing)
+
+    def test_reports_counts_as_dicts(self):
+        diag = jp.Diagnostics()
+        jp.evaluate({'a':1}, [jp.PChild(targets=[jp.PProperty(name='b')])], diagnostics=diag)
+        self.assertEqual([{'step': repr(diag.steps[0].step), 'skipped': 0, 'missing': 1, 
+                           'script_evaluations': 0, 'script_errors': 0}], diag.as_dict())
+
+    def test_counts_script_evaluations_for_step(self):
+        diag = jp.Diagnostics()
+        jp.jsonpath([{'a':1}, {'a':2}, 3], '$[?(@["a"] > 1)][("a")]', diagnostics=diag)
+        self.assertEqual(3, diag.steps[1].script_evaluations)
+        self.assertEqual(1, diag.steps[2].script_evaluations)
+
+    def test_does_not_log_when_debug_disabled(self):
+        with unittest.mock.patch('logging.debug') as debug:
+            jp.jsonpath([1, {}, [0]], '$[*].b')
+            jp.jsonpath([1, {}, [0]], '$[*][5]')
+        debug.assert_not_called()
+
+    def test_does_not_log_script_errors_when_warnings_disabled(self):
+        with unittest.mock.patch('logging.warning') as warning:
+            jp.jsonpath([1, 2], '$[?(@["a"])]')
+        warning.assert_not_called()
+
+    def test_logs_when_debug_enabled(self):
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            jp.jsonpath([1], '$[*].b')
+        self.assertEqual(1, len(logs.records))
+
+
+
+class TestProfile(unittest.TestCase):
+
+    DATA = {"cats": [{"name": "Alfie", "age": 3}, {"name": "Bubbles"}, 5]}
+
+    def test_counts_nodes_in_and_out_of_each_step(self):
+        profile = jp.compile('$.cats[*].name').explain(self.DATA)
+        self.assertEqual([(0, 1), (1, 1), (1, 3), (3, 2)], 
+                         [(s.nodes_in, s.nodes_out) for s in profile.steps])
+        self.assertEqual(2, profile.results)
+
+    def test_counts_script_evaluations_and_errors(self):
+        profile = jp.compile('$.cats[?(@["age"] > 1)]').explain(self.DATA)
+        self.assertEqual(3, profile.steps[2].script_evaluations)
+        self.assertEqual(2, profile.steps[2].script_errors)
+
+    def test_times_each_step(self):
+        profile = jp.compile('$.cats[*].name').explain(self.DATA)
+        self.assertTrue(all(s.time > 0 for s in profile.steps))
+        self.assertAlmostEqual(sum(s.time for s in profile.steps), profile.time)
+
+    def test_excludes_time_of_earlier_steps(self):
+        times = iter([0.0, 1.0, 1.0, 3.0, 3.0, 3.5, 3.5, 4.0, 4.0, 6.0])
+        steps = [jp.PCurrent(), jp.PCurrent()]
+        profile = jp.Profile()
+        with unittest.mock.patch('time.perf_counter', side_effect=lambda: next(times, 10.0)):
+            jp.evaluate(1, steps, diagnostics=profile)
+        self.assertEqual(1, profile.results)
+        self.assertGreater(profile.steps[1].time, 0)
+        self.assertLess(profile.steps[1].time, profile.time)
+
+    def test_returns_results_as_normal_when_passed_to_evaluate(self):
+        profile = jp.Profile()
+        result = jp.jsonpath(self.DATA, '$..name', diagnostics=profile)
+        self.assertEqual(['Alfie', 'Bubbles'], result)
+        self.assertEqual(2, profile.results)
+
+    def test_reports_as_dict(self):
+        profile = jp.compile('$.cats').explain(self.DATA)
+        result = profile.as_dict()
+        self.assertEqual('$.cats', result['expr'])
+        self.assertEqual(1, result['results'])
+        self.assertEqual(['step', 'nodes_in', 'nodes_out', 'time', 'skipped', 'missing', 
+                          'script_evaluations', 'script_errors'], list(result['steps'][0]))
+
+    def test_prints_plan_tree(self):
+        lines = str(jp.compile('$.cats[*]').explain(self.DATA)).splitlines()
+        self.assertTrue(lines[0].startswith('$.cats[*]  (results=3, time='))
+        self.assertTrue(lines[2].startswith('   -> 1 PChild [PProperty(name=cats)]  (in=1 out=1 '))
+        self.assertTrue(lines[3].startswith('      -> 2 PChild [PWildcard()]  (in=1 out=3 '))
+
+
+class TestStream(unittest.TestCase):
+
+    DATA = {"a": [{"b": 1, "c": "x"}, {"b": 2}, {"b": 3.5, "d": [True, None]}], 
+            "e": {"b": "y\\u00e9", "f": {"b": -1e3}}}
+
+    def stream(self, data, expr, **kwargs):
+        fp = io.BytesIO(json.dumps(data).encode('utf-8'))
+        return list(jp.compile(expr).stream(fp, **kwargs))
+
+    def assert_matches_find(self, expr, **kwargs):
+        expected = sorted(jp.compile(expr).find(self.DATA), key=lambda r: r[1])
+        result = sorted(self.stream(self.DATA, expr, **kwargs), key=lambda r: r[1])
+        self.assertEqual(expected, result)
+
+    def test_matches_child_properties(self):
+        self.assert_matches_find('$.a[*].b')
+
+    def test_matches_recursive_properties(self):
+        self.assert_matches_find('$..b')
+
+    def test_matches_wildcards(self):
+        self.assert_matches_find('$..*')
+
+    def test_matches_indices_and_slices(self):
+        self.assert_matches_find('$.a[0,2]')
+        self.assert_matches_find('$.a[1:]')
+        self.assert_matches_find('$.a[::2].b')
+
+    def test_matches_filters(self):
+        self.assert_matches_find('$.a[?(@["b"] > 1)].b')
+        self.assert_matches_find('$..?("c" in @)')
+
+    def test_matches_current_node(self):
+        self.assert_matches_find('$.e..@')
+
+    def test_matches_root(self):
+        self.assert_matches_find('$')
+
+    def test_matches_with_small_chunks(self):
+        self.assert_matches_find('$..b', chunk_size=1)
+        self.assert_matches_find('$..*', chunk_size=3)
+
+    def test_yields_results_in_document_order(self):
+        result = self.stream({"b": 1, "a": {"b": 2}}, '$..b')
+        self.assertEqual([(1, '$["b"]'), (2, '$["a"]["b"]')], result)
+
+    def test_yields_nested_matches_before_their_descendants(self):
+        data = {"a": {"a": {"b": [{"a": 1}]}}}
+        for expr in ['$..a', '$.a..a', '$..a..a']:
+            with self.subTest(expr=expr):
+                self.assertEqual(jp.compile(expr).find(data), self.stream(data, expr))
+
+    def test_yields_matches_within_matched_node_in_document_order(self):
+        result = self.stream({"a": {"c": {"d": 1}, "b": 2}}, '$..*')
+        self.assertEqual(['$["a"]', '$["a"]["c"]', '$["a"]["c"]["d"]', '$["a"]["b"]'], 
+                         [path for value, path in result])
+
+    def test_reads_lazily(self):
+        fp = io.BytesIO(json.dumps([[1]] + [[i] for i in range(10000)]).encode('utf-8'))
+        result = jp.compile('$[*][0]').stream(fp, chunk_size=16)
+        self.assertEqual((1, '$[0][0]'), next(result))
+        self.assertLess(fp.tell(), 100)
+
+    def test_reads_text_files(self):
+        fp = io.StringIO('{"a": ["é"]}')
+        self.assertEqual([('é', '$["a"][0]')], list(jp.compile('$.a[0]').stream(fp)))
+
+    def test_skips_utf8_bom(self):
+        fp = io.BytesIO(b'\xef\xbb\xbf{"a": 1}')
+        self.assertEqual([(1, '$["a"]')], list(jp.compile('$.a').stream(fp)))
+
+    def test_rejects_negative_index(self):
+        with self.assertRaises(ValueError):
+            self.stream([1], '$[-1]')
+
+    def test_rejects_expression(self):
+        with self.assertRaises(ValueError):
+            self.stream([1], '$[(1)]')
+
+    def test_rejects_filter_using_root(self):
+        with self.assertRaises(ValueError):
+            self.stream([1], '$[?(@ == $[0])]')
+
+    def test_raises_decode_error_for_invalid_json(self):
+        for invalid in ['{"a": [1, 2', '{"a" 1}', '[1 2]', '[1] 2', '', '{"a": tru}', '[,]']:
+            with self.subTest(invalid=invalid):
+                with self.assertRaises(json.JSONDecodeError):
+                    list(jp.compile('$..*').stream(io.BytesIO(invalid.encode('utf-8'))))
+
+
+class TestAsync(unittest.TestCase):
+
+    DATA = TestStream.DATA
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    async def collect(self, results):
+        return [result async for result in results]
+
+    async def chunks(self, text, size):
+        for i in range(0, len(text), size):
+            yield text[i:i+size]
+
+    def test_find_async_evaluates_each_document(self):
+        async def documents():
+            yield {"a": 1}
+            yield {"b": 2}
+            yield {"a": 3}
+        result = self.run_async(self.collect(jp.compile('$.a').find_async(documents())))
+        self.assertEqual([[(1, '$["a"]')], [], [(3, '$["a"]')]], result)
+
+    def test_find_async_limits_results_per_document(self):
+        async def documents():
+            yield [1, 2, 3]
+            yield [4]
+        result = self.run_async(self.collect(jp.compile('$[*]').find_async(documents(), limit=2)))
+        self.assertEqual([[(1, '$[0]'), (2, '$[1]')], [(4, '$[0]')]], result)
+
+    def test_find_async_yields_to_other_tasks_without_matches(self):
+        data = { "a": [ { "b": [i, str(i)] } for i in range(20000) ] }
+        async def documents():
+            yield data
+        async def run():
+            ticks = []
+            async def ticker():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+            task = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            result = await self.collect(jp.compile('$..*[?(@ == "none")]').find_async(documents()))
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return result, len(ticks)
+        result, ticks = self.run_async(run())
+        self.assertEqual([[]], result)
+        self.assertGreater(ticks, 20)
+
+    def test_async_rejects_yield_every_below_one(self):
+        async def documents():
+            yield {}
+        with self.assertRaises(ValueError):
+            self.run_async(self.collect(jp.compile('$').find_async(documents(), yield_every=0)))
+        with self.assertRaises(ValueError):
+            self.run_async(self.collect(jp.compile('$').stream_async(self.chunks('{}', 1), 
+                                                                     yield_every=0)))
+
+    def test_stream_async_matches_find(self):
+        raw = json.dumps(self.DATA).encode('utf-8')
+        for expr in ['$..b', '$.a[?(@["b"] > 1)].b', '$..*']:
+            with self.subTest(expr=expr):
+                result = self.run_async(self.collect(jp.compile(expr).stream_async(self.chunks(raw, 7))))
+                self.assertEqual(sorted(jp.compile(expr).find(self.DATA), key=lambda r: r[1]),
+                                 sorted(result, key=lambda r: r[1]))
+
+    def test_stream_async_reads_from_stream_reader(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'{"a": [1, 2')
+            reader.feed_data(b', 3]}')
+            reader.feed_eof()
+            return await self.collect(jp.compile('$.a[1:]').stream_async(reader, chunk_size=4))
+        self.assertEqual([(2, '$["a"][1]'), (3, '$["a"][2]')], self.run_async(run()))
+
+    def test_stream_async_reads_text_chunks(self):
+        result = self.run_async(self.collect(
+            jp.compile('$.a[0]').stream_async(self.chunks('{"a": ["é"]}', 2))))
+        self.assertEqual([('é', '$["a"][0]')], result)
+
+    def test_stream_async_yields_to_other_tasks(self):
+        raw = json.dumps([[i] for i in range(2000)]).encode('utf-8')
+        async def run():
+            ticks = []
+            async def ticker():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+            task = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            # a single chunk with no matches, so the stream only pauses between nodes
+            async for result in jp.compile('$[*][1]').stream_async(self.chunks(raw, len(raw)), 
+                                                                yield_every=100):
+                pass
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return len(ticks)
+        self.assertGreater(self.run_async(run()), 20)
+
+    def test_stream_async_raises_decode_error_for_invalid_json(self):
+        with self.assertRaises(json.JSONDecodeError):
+            self.run_async(self.collect(jp.compile('$..*').stream_async(self.chunks(b'[1 2]', 2))))
+
+
+class _CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+class TestThreads(unittest.TestCase):
+
+    DATA = { "a": [ { "b": i, "c": [i, { "b": -i }] } for i in range(10) ], 
+             "d": { "e{}".format(i): { "b": i } for i in range(5) } }
+
+    def setUp(self):
+        self.executor = _CountingExecutor()
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_splits_child_sets_in_document_order(self):
+        exprs = ['$.a[*].b', '$.a[?(@["b"] > 4)].c[0]', '$..b', '$..*', '$.d.*.b', '$..c[*]', 
+                 '$.a[*].c[*].b', '$..b,c', '$..?(@ == 3)', '$.a[*].$']
+        with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 2), \
+                unittest.mock.patch.object(jp, 'PARALLEL_CHUNK_SIZE', 3):
+            for expr in exprs:
+                with self.subTest(expr=expr):
+                    query = jp.compile(expr)
+                    self.assertEqual(query.find(self.DATA), 
+                                     query.find(self.DATA, executor=self.executor))
+                    self.assertEqual(jp.evaluate(self.DATA, jp.parse(expr)),
+                                     jp.evaluate(self.DATA, jp.parse(expr), 
+                                                 executor=self.executor))
+        self.assertGreater(self.executor.submitted, 0)
+
+    def test_splits_child_sets_into_chunks(self):
+        with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 10), \
+                unittest.mock.patch.object(jp, 'PARALLEL_CHUNK_SIZE', 4):
+            result = jp.jsonpath(self.DATA, '$.a[*].b', executor=self.executor)
+        self.assertEqual(list(range(10)), result)
+        self.assertEqual(3, self.executor.submitted)
+
+    def test_evaluates_small_child_sets_in_calling_thread(self):
+        result = jp.jsonpath(self.DATA, '$..b', executor=self.executor)
+        self.assertEqual(jp.jsonpath(self.DATA, '$..b'), result)
+        self.assertEqual(0, self.executor.submitted)
+
+    def test_evaluates_in_calling_thread_with_diagnostics(self):
+        with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 2):
+            jp.jsonpath(self.DATA, '$..b', executor=self.executor, diagnostics=jp.Diagnostics())
+        self.assertEqual(0, self.executor.submitted)
+
+    def test_codegen_query_uses_interpreter_with_executor(self):
+        query = jp.compile('$.a[*].b', backend=jp.BACKEND_CODEGEN)
+        with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 2):
+            result = query.values(self.DATA, executor=self.executor)
+        self.assertEqual(list(range(10)), result)
+        self.assertGreater(self.executor.submitted, 0)
+
+    def test_limits_results(self):
+        with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 2), \
+                unittest.mock.patch.object(jp, 'PARALLEL_CHUNK_SIZE', 1):
+            result = jp.compile('$.a[*].b').values(self.DATA, limit=3, executor=self.executor)
+        self.assertEqual([0, 1, 2], result)
+
+    def test_query_is_shared_between_threads(self):
+        query = jp.compile('$.a[?(@["b"] % 2 == 0)].c[1].b')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(query.values, [self.DATA] * 20))
+        self.assertEqual([[0, -2, -4, -6, -8]] * 20, results)
+
+
+class TestOrder(unittest.TestCase):
+
+    DATA = { "z": { "b": 1, "a": [ { "y": 2, "x": 3 } ] }, "c": { "a": 4 } }
+
+    def test_sorts_properties_by_default(self):
+        self.assertEqual(['$["c"]', '$["z"]', '$["c"]["a"]', '$["z"]["a"]', '$["z"]["b"]', 
+                          '$["z"]["a"][0]', '$["z"]["a"][0]["x"]', '$["z"]["a"][0]["y"]'], 
+                         jp.jsonpath(self.DATA, '$..*', jp.RESULT_TYPE_PATH))
+
+    def test_visits_properties_in_insertion_order(self):
+        self.assertEqual(['$["z"]', '$["c"]', '$["z"]["b"]', '$["z"]["a"]', '$["c"]["a"]', 
+                          '$["z"]["a"][0]', '$["z"]["a"][0]["y"]', '$["z"]["a"][0]["x"]'], 
+                         jp.jsonpath(self.DATA, '$..*', jp.RESULT_TYPE_PATH, 
+                                     order=jp.ORDER_INSERTION))
+        self.assertEqual([2, 3], jp.jsonpath(self.DATA, '$.z.a[0][?(@ > 1)]', 
+                                             order=jp.ORDER_INSERTION))
+
+    def test_results_match_between_evaluations(self):
+        order = jp.ORDER_INSERTION
+        executor = _CountingExecutor()
+        self.addCleanup(executor.shutdown)
+        for expr in ['$..*', '$.*.*', '$..a[*].*', '$.*[?(@)]', '$..y,x', '$..*[?(@ > 2)]']:
+            with self.subTest(expr=expr):
+                expected = jp.compile(expr).find(self.DATA, order=order)
+                self.assertEqual(expected, jp.compile(expr, backend=jp.BACKEND_CODEGEN)
+                                           .find(self.DATA, order=order))
+                self.assertEqual(expected, jp.compile(expr).find(self.DATA, order=order, 
+                                                                 diagnostics=jp.Diagnostics()))
+                index = jp.DocumentIndex(self.DATA, order=order)
+                self.assertEqual(expected, jp.compile(expr).find(self.DATA, order=order, 
+                                                                 index=index))
+                with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 1), \
+                        unittest.mock.patch.object(jp, 'PARALLEL_CHUNK_SIZE', 1):
+                    self.assertEqual(expected, jp.compile(expr).find(self.DATA, order=order, 
+                                                                     executor=executor))
+
+    def test_generates_code_for_each_order_once(self):
+        query = jp.compile('$.*.b', backend=jp.BACKEND_CODEGEN)
+        self.assertEqual([1], query.values(self.DATA, order=jp.ORDER_INSERTION))
+        functions = query._functions[jp.ORDER_INSERTION]
+        query.values(self.DATA, order=jp.ORDER_INSERTION)
+        self.assertIs(functions, query._functions[jp.ORDER_INSERTION])
+        self.assertIn('sorted(', query.source)
+
+    def test_uses_index_only_in_its_order(self):
+        index = jp.DocumentIndex(self.DATA, order=jp.ORDER_INSERTION)
+        with unittest.mock.patch.object(jp.PRecursive, 'search') as search:
+            jp.jsonpath(self.DATA, '$..a', index=index, order=jp.ORDER_INSERTION)
+        search.assert_not_called()
+        self.assertEqual([4, [{"y": 2, "x": 3}]], jp.jsonpath(self.DATA, '$..a', index=index))
+
+    def test_rejects_unknown_order(self):
+        for backend in (jp.BACKEND_INTERPRETER, jp.BACKEND_CODEGEN):
+            with self.subTest(backend=backend):
+                with self.assertRaises(ValueError):
+                    jp.compile('$.*', backend=backend).values(self.DATA, order='reversed')
+        with self.assertRaises(ValueError):
+            jp.DocumentIndex(self.DATA, order='reversed')
+
+
+class _Pair(collections.abc.Sequence):
+
+    def __init__(self, first, second):
+        self.items = (first, second)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __len__(self):
+        return 2
+
+
+class TestContainers(unittest.TestCase):
+
+    def trades(self):
+        return numpy.array([(1, 99.5, 'ab'), (2, 101.0, 'cd'), (3, 120.25, 'ef')],
+                           dtype=[('id', 'i8'), ('price', 'f8'), ('name', 'U2')])
+
+    def test_queries_mappings_and_sequences(self):
+        data = types.MappingProxyType({ "b": _Pair({ "c": 1 }, 2), "a": [3] })
+        for backend in (jp.BACKEND_INTERPRETER, jp.BACKEND_CODEGEN):
+            with self.subTest(backend=backend):
+                self.assertEqual([3, { "c": 1 }, 2], jp.compile('$.x.*[*]', backend=backend)
+                                                     .values({ "x": data }))
+                self.assertEqual([1], jp.compile('$..c', backend=backend).values({ "x": data }))
+                self.assertEqual(['$["b"][0]["c"]'], jp.compile('$.b[0].c', backend=backend)
+                                                     .paths(data))
+                self.assertEqual([2], jp.compile('$.b[-1:]', backend=backend).values(data))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_queries_numpy_arrays(self):
+        data = { "grid": numpy.arange(6).reshape(2, 3), "scalar": numpy.array(4) }
+        for backend in (jp.BACKEND_INTERPRETER, jp.BACKEND_CODEGEN):
+            with self.subTest(backend=backend):
+                query = lambda expr: jp.compile(expr, backend=backend).values(data)
+                self.assertEqual([5], query('$.grid[1][2]'))
+                self.assertEqual([3, 4], query('$.grid[1][:2]'))
+                self.assertEqual([4, 5], query('$.grid[*][?(@ > 3)]'))
+                self.assertEqual([], query('$.scalar[0]'))
+                self.assertEqual(['$["grid"][1][0]'],
+                                 jp.compile('$.grid[(1)][(0)]', backend=backend).paths(data))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_queries_structured_arrays(self):
+        data = { "trades": self.trades() }
+        for backend in (jp.BACKEND_INTERPRETER, jp.BACKEND_CODEGEN):
+            with self.subTest(backend=backend):
+                query = lambda expr: jp.compile(expr, backend=backend).values(data)
+                self.assertEqual([2, 3], query('$.trades[?(@["price"] > 100)].id'))
+                self.assertEqual(['ab', 'cd', 'ef'], query('$.trades[*].name'))
+                self.assertEqual([1, 'ab', 99.5], query('$.trades[0].*'))
+                self.assertEqual([], query('$.trades[0].qty'))
+                self.assertEqual([3], query('$..trades[?(@["name"] == "ef")].id'))
+                self.assertIsInstance(query('$.trades[1]')[0], numpy.void)
+        self.assertEqual(['$["trades"][0]["id"]'],
+                         jp.jsonpath(data, '$.trades[?(@.id == 1)].id', jp.RESULT_TYPE_PATH,
+                                     dialect=jp.DIALECT_SAFE))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_filters_arrays_without_evaluating_scripts(self):
+        values = numpy.arange(40) % 7
+        trades = numpy.resize(self.trades(), 40)
+        with unittest.mock.patch.object(jp.PFilter, 'eval_code_for') as eval_code:
+            self.assertEqual(['$[3]', '$[10]', '$[17]', '$[24]', '$[31]', '$[38]'],
+                             jp.jsonpath(values, '$[?(@ == 3)]', jp.RESULT_TYPE_PATH))
+            self.assertEqual(13, len(jp.jsonpath(trades, '$[?(@["name"] == "cd")]')))
+        eval_code.assert_not_called()
+        expected = [v for v in values.tolist() if 2 < v <= 5]
+        self.assertEqual(expected, jp.jsonpath(values, '$[?(2 < @ <= 5)]'))
+        self.assertEqual(expected, jp.jsonpath(values.tolist(), '$[?(2 < @ <= 5)]',
+                                               engine=jp.ENGINE_NUMPY))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_filters_arrays_without_evaluating_scripts_in_threads(self):
+        data = { "trades": numpy.resize(self.trades(), 40) }
+        executor = _CountingExecutor()
+        self.addCleanup(executor.shutdown)
+        expected = jp.compile('$.trades[?(@["price"] > 100)].id').find(data)
+        with unittest.mock.patch.object(jp, 'PARALLEL_MIN_NODES', 1), \
+                unittest.mock.patch.object(jp, 'PARALLEL_CHUNK_SIZE', 4), \
+                unittest.mock.patch.object(jp.PFilter, 'eval_code_for') as eval_code:
+            self.assertEqual(expected, jp.compile('$.trades[?(@["price"] > 100)].id')
+                                       .find(data, executor=executor))
+        eval_code.assert_not_called()
+        self.assertGreater(executor.submitted, 0)
+
+
+class TestEvaluateMany(unittest.TestCase):
+
+    LINES = ['{"a": 1}', '{"a": [2, 3]}', '', b'{"b": 4}', '{"a": {"c": 5}}']
+
+    def test_pickles_query_as_expression(self):
+        query = jp.compile('$.a[?(@ > 1)]')
+        self.assertIs(query, pickle.loads(pickle.dumps(query)))
+
+    def test_evaluates_in_process_with_one_worker(self):
+        result = list(jp.evaluate_many('$.a', self.LINES, workers=1))
+        self.assertEqual([(0, [1]), (1, [[2, 3]]), (3, []), (4, [{"c": 5}])], result)
+
+    def test_evaluates_in_order_with_worker_processes(self):
+        result = list(jp.evaluate_many('$.a', self.LINES, workers=2, batch_size=1))
+        self.assertEqual([(0, [1]), (1, [[2, 3]]), (3, []), (4, [{"c": 5}])], result)
+
+    def test_evaluates_unordered_with_worker_processes(self):
+        result = jp.evaluate_many(jp.compile('$.a'), self.LINES, workers=2, batch_size=2, 
+                                  ordered=False)
+        self.assertEqual([(0, [1]), (1, [[2, 3]]), (3, []), (4, [{"c": 5}])], sorted(result))
+
+    def test_returns_requested_result_type(self):
+        result = list(jp.evaluate_many('$.a', self.LINES[:1], workers=1, 
+                                       result_type=jp.RESULT_TYPE_PATH))
+        self.assertEqual([(0, ['$["a"]'])], result)
+
+    def test_raises_decode_error_from_worker(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(jp.evaluate_many('$.a', ['{}', '{'], workers=2, batch_size=1))
+
+
+class TestEvaluatePartitioned(unittest.TestCase):
+
+    DATA = { "items": [ { "id": i, "tags": ["t{}".format(i), { "id": -i }] } for i in range(20) ], 
+             "meta": { "id": "m", "count": 20 } }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'data.json')
+        self.write(self.DATA)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, data):
+        with open(self.filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+
+    def assertMatches(self, expr, data, **options):
+        self.assertEqual(jp.compile(expr).find(data), 
+                         jp.evaluate_partitioned(expr, self.filename, result_type=jp.RESULT_TYPE_BOTH,
+                                                 **options))
+
+    def test_matches_single_process_evaluation(self):
+        exprs = ['$.items[*].id', '$.items[?(@["id"] > 15)].tags[0]', '$.items..id', '$..id',
+                 '$.items[3:7]', '$.items[::-3].id', '$.items[-1]', '$.items[*].tags[*]', 
+                 '$.items..0,id', '$.meta.*', '$.items', '$.missing[*]', '$.meta.id[*]',
+                 '$.items[?(@["id"] == $.meta.count - 1)].id']
+        for expr in exprs:
+            for size in (1, 50, 10000):
+                with self.subTest(expr=expr, partition_size=size):
+                    self.assertMatches(expr, self.DATA, workers=1, partition_size=size)
+
+    def test_splits_top_level_array(self):
+        data = [ { "name": "n{}".format(i), "tags": ['a,]}"', '[{"b\\'] } for i in range(10) ]
+        self.write(data)
+        for expr in ['$[*].name', '$..tags[1]', '$[2:4]', '$[?(@["name"] != "n1")].tags']:
+            with self.subTest(expr=expr):
+                self.assertMatches(expr, data, workers=1, partition_size=20)
+
+    def test_evaluates_ranges_with_worker_processes(self):
+        self.assertMatches('$.items..id', self.DATA, workers=2, partition_size=100)
+
+    def test_evaluates_empty_array(self):
+        self.write({ "items": [] })
+        self.assertEqual([], jp.evaluate_partitioned('$.items..id', self.filename, workers=1))
+
+    def test_evaluates_only_selected_ranges(self):
+        with unittest.mock.patch.object(jp._Partitioning, 'evaluate', 
+                                        side_effect=jp._Partitioning.evaluate, 
+                                        autospec=True) as evaluate:
+            result = jp.evaluate_partitioned('$.items[1].id', self.filename, workers=1,
+                                             partition_size=1)
+        self.assertEqual([1], result)
+        self.assertEqual(1, evaluate.call_count)
+
+    def test_raises_decode_error_with_position(self):
+        for text, pos in [('{"items": [1, 2, {"a": }]}', 23), ('{"items": [1, 2', 15), ('', 0)]:
+            with self.subTest(text=text):
+                with open(self.filename, 'w') as f:
+                    f.write(text)
+                with self.assertRaises(json.JSONDecodeError) as context:
+                    jp.evaluate_partitioned('$.items[*]', self.filename, workers=2, 
+                                            partition_size=1)
+                self.assertEqual(pos, context.exception.pos)
+
+
+class TestLazyDocument(unittest.TestCase):
+
+    DATA = { "items": [ { "id": i, "tags": ["t{}".format(i), { "id": -i }], "text": 'a"[,]}\\' } 
+                        for i in range(20) ], 
+             "meta": { "id": "m", "count": 20, "empty": [], "none": {} } }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'data.json')
+        self.write(self.DATA)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, data):
+        with open(self.filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+
+    def decoded(self, value):
+        return value.decode() if isinstance(value, (jp.LazyObject, jp.LazyArray)) else value
+
+    def test_matches_decoded_evaluation(self):
+        exprs = ['$.items[*].id', '$.items[?(@["id"] > 15)].tags[0]', '$.items..id', '$..id',
+                 '$.items[3:7]', '$.items[::-3].id', '$.items[-1]', '$.meta.*', '$.meta.empty[*]',
+                 '$.items[?(@["id"] == $.meta.count - 1)].text', r'$.items[(len\(@\)-1)].id']
+        for size in (1, 4096):
+            with unittest.mock.patch.object(jp, 'LAZY_MIN_SIZE', size):
+                with jp.LazyDocument(self.filename) as doc:
+                    for expr in exprs:
+                        with self.subTest(expr=expr, lazy_min_size=size):
+                            query = jp.compile(expr)
+                            self.assertEqual(query.find(self.DATA), 
+                                             [(self.decoded(v), p) for v,p in query.find(doc)])
+
+    def test_decodes_only_visited_containers(self):
+        with unittest.mock.patch.object(jp, 'LAZY_MIN_SIZE', 1):
+            with jp.LazyDocument(self.filename) as doc:
+                self.assertIsInstance(doc.root, jp.LazyObject)
+                items = jp.jsonpath(doc, '$.items')[0]
+                self.assertIsInstance(items, jp.LazyArray)
+                self.assertEqual(20, len(items))
+                self.assertIsInstance(items[3], jp.LazyObject)
+                self.assertEqual(self.DATA['items'][3], items[3].decode())
+                self.assertEqual(self.DATA, doc.root.decode())
+
+    def test_decodes_small_containers(self):
+        with jp.LazyDocument(self.filename) as doc:
+            self.assertIsInstance(doc.root['items'][0], dict)
+
+    def test_scans_without_numpy(self):
+        with unittest.mock.patch.object(jp, 'LAZY_MIN_SIZE', 1):
+            with jp.LazyDocument(self.filename) as doc:
+                doc.root._scanner.np = False
+                self.assertEqual(jp.jsonpath(self.DATA, '$..id'), jp.jsonpath(doc, '$..id'))
+
+    def test_supports_generated_backend(self):
+        query = jp.compile('$.items[?(@["id"] > 17)].tags[1].id', backend=jp.BACKEND_CODEGEN)
+        with unittest.mock.patch.object(jp, 'LAZY_MIN_SIZE', 1):
+            with jp.LazyDocument(self.filename) as doc:
+                self.assertEqual([-18, -19], query.values(doc))
+
+    def test_raises_decode_error(self):
+        for text in ['', '[1, 2', '[1, {"a": }]']:
+            with self.subTest(text=text):
+                with open(self.filename, 'w') as f:
+                    f.write(text)
+                with self.assertRaises(json.JSONDecodeError):
+                    with jp.LazyDocument(self.filename) as doc:
+                        jp.jsonpath(doc, '$[*]')
+
+
+class TestDecoders(unittest.TestCase):
+
+    DOCUMENT = b'{"cats": [{"name": "Alfie", "age": 3}, {"name": "Bubbles", "age": NaN}]}'
+
+    BIG_INTEGERS = b'[123456789012345678901234567890, -9223372036854775809, 18446744073709551616]'
+
+    def setUp(self):
+        patcher = unittest.mock.patch.dict(jp._decoders, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queries_bytes(self):
+        self.assertEqual(['Alfie', 'Bubbles'], jp.jsonpath(self.DOCUMENT, '$.cats[*].name'))
+        self.assertEqual([(3, '$["cats"][0]["age"]')], 
+                         jp.evaluate(bytearray(self.DOCUMENT), jp.parse('$.cats[0].age')))
+
+    def test_queries_text_only_with_decoder(self):
+        text = self.DOCUMENT.decode('utf-8')
+        self.assertEqual([text], jp.jsonpath(text, '$'))
+        self.assertEqual(['Alfie'], jp.jsonpath(text, '$.cats[0].name', decoder=jp.DECODER_AUTO))
+
+    def test_compiled_queries_accept_documents(self):
+        for backend in (jp.BACKEND_INTERPRETER, jp.BACKEND_CODEGEN):
+            with self.subTest(backend=backend):
+                query = jp.compile('$.cats[?(@["age"] == 3)].name', backend=backend)
+                self.assertEqual(['Alfie'], query.values(memoryview(self.DOCUMENT)))
+                self.assertEqual('Alfie', query.first(self.DOCUMENT.decode('utf-8'), 
+                                                      decoder=jp.DECODER_JSON))
+
+    def test_available_decoders_match_json_module(self):
+        documents = [self.DOCUMENT, b'\xef\xbb\xbf[1, 2.5, "\\u00e9", null, true]', 
+                     '{"a": {"a": [1e400, -0.0]}}', b' "x" ', self.BIG_INTEGERS, 
+                     self.BIG_INTEGERS.decode('utf-8')]
+        for decoder in jp.available_decoders():
+            for document in documents:
+                with self.subTest(decoder=decoder, document=document):
+                    self.assertEqual(repr(json.loads(document)), 
+                                     repr(jp.decode(document, decoder)))
+
+    def test_raises_json_error_for_invalid_documents(self):
+        for decoder in jp.available_decoders():
+            with self.subTest(decoder=decoder):
+                with self.assertRaises(json.JSONDecodeError) as context:
+                    jp.decode(b'{"a": [1, }', decoder)
+                self.assertEqual(10, context.exception.pos)
+
+    def test_prefers_fastest_decoder_installed(self):
+        with unittest.mock.patch.dict(sys.modules, {'orjson': None, 'msgspec': None, 'ujson': None}):
+            self.assertEqual([jp.DECODER_JSON], jp.available_decoders())
+            self.assertIs(json.loads, jp._decoder(jp.DECODER_AUTO)[0])
+            with self.assertRaises(ImportError):
+                jp.decode(b'1', jp.DECODER_ORJSON)
+
+    def test_registers_decoder(self):
+        loads = unittest.mock.Mock(return_value={"a": 1})
+        with unittest.mock.patch.dict(jp._decoder_loaders):
+            jp.register_decoder('custom', loads)
+            self.assertEqual([1], jp.jsonpath(b'{}', '$.a', decoder='custom'))
+        loads.assert_called_once_with(b'{}')
+
+    def test_decodes_big_integers_exactly(self):
+        self.assertEqual([123456789012345678901234567890], 
+                         jp.jsonpath(self.BIG_INTEGERS, '$[?(@ == 123456789012345678901234567890)]'))
+
+    def test_falls_back_on_decoder_errors(self):
+        class StubError(Exception):
+            pass
+        loads = unittest.mock.Mock(side_effect=StubError)
+        with unittest.mock.patch.dict(jp._decoder_loaders):
+            jp.register_decoder('stub', loads, errors=(StubError,))
+            self.assertEqual(['Alfie', 'Bubbles'], 
+                             jp.jsonpath(self.DOCUMENT, '$.cats[*].name', decoder='stub'))
+            with self.assertRaises(json.JSONDecodeError):
+                jp.decode(b'[1, ]', 'stub')
+            jp.register_decoder('other', loads)
+            with self.assertRaises(StubError):
+                jp.decode(b'[1]', 'other')
+        self.assertEqual(3, loads.call_count)
+
+    def test_decodes_files_with_decoder(self):
+        loads = unittest.mock.Mock(side_effect=json.loads)
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch.dict(jp._decoder_loaders):
+            jp.register_decoder('custom', loads)
+            filename = os.path.join(directory, 'data.json')
+            for document in (self.BIG_INTEGERS, b'[1, 2]'):
+                with open(filename, 'wb') as f:
+                    f.write(document)
+                expected = json.loads(document)
+                for decoder in jp.available_decoders():
+                    with self.subTest(decoder=decoder, document=document):
+                        self.assertEqual(expected, jp.evaluate_partitioned('$[*]', filename, 
+                                                                           decoder=decoder))
+                        self.assertEqual([(0, expected)], list(jp.evaluate_many(
+                            '$[*]', [document], workers=1, decoder=decoder)))
+                        with jp.LazyDocument(filename, decoder=decoder) as doc:
+                            self.assertEqual(expected, list(doc.root))
+        # the big integers are decoded with the json module instead
+        self.assertEqual(3, loads.call_count)
+
+    def test_rejects_unknown_decoder(self):
+        with self.assertRaises(ValueError):
+            jp.jsonpath(b'{}', '$', decoder='yaml')
+        with self.assertRaises(ValueError):
+            jp.LazyDocument(__file__, decoder='yaml')
+        with self.assertRaises(ValueError):
+            jp.evaluate_partitioned('$', __file__, decoder='yaml')
+        with self.assertRaises(ValueError):
+            list(jp.evaluate_many('$', ['{}'], decoder='yaml'))
+
+
+class TestQuerySet(unittest.TestCase):
+
+    DATA = {"payload": {"items": [{"a": 1, "b": "x"}, {"a": 2}, {"b": "y"}]}}
+
+    def test_returns_results_keyed_by_name(self):
+        queries = jp.QuerySet({'a': '$.payload.items[*].a', 'b': '$.payload.items[*].b'})
+        self.assertEqual({'a': [1, 2], 'b': ['x', 'y']}, queries.evaluate(self.DATA))
+
+    def test_results_match_separate_queries(self):
+        exprs = ['$.payload.items[*].a', '$.payload..b', '$.payload.items[?(@["a"] > 1)]', 
+                 '$.payload.items[1:]', '$..*', '$.payload.items[*].c']
+        queries = jp.QuerySet((e, e) for e in exprs)
+        result = queries.evaluate(self.DATA, result_type=jp.RESULT_TYPE_BOTH)
+        for e in exprs:
+            with self.subTest(expr=e):
+                self.assertEqual(jp.compile(e).find(self.DATA), result[e])
+
+    def test_accepts_compiled_queries(self):
+        queries = jp.QuerySet([('a', jp.compile('$.payload.items[0].a'))])
+        self.assertEqual({'a': [1]}, queries.evaluate(self.DATA))
+
+    def test_merges_shared_prefixes(self):
+        queries = jp.QuerySet({'a': '$.payload.items[*].a', 'b': '$.payload.items[*].b', 
+                               'c': '$.payload.c'})
+        self.assertEqual(1, len(queries._trie.children))
+        payload = next(iter(queries._trie.children.values())).children
+        self.assertEqual(1, len(payload))
+        self.assertEqual(2, len(next(iter(payload.values())).children))
+
+    def test_evaluates_shared_prefix_once(self):
+        _CountingDict.lookups = 0
+        data = {"payload": _CountingDict(items=[{"a": 1}])}
+        queries = jp.QuerySet({'a': '$.payload.items[*].a', 'b': '$.payload.items[*].b'})
+        queries.evaluate(data)
+        self.assertEqual(1, _CountingDict.lookups)
+
+    def test_pickles(self):
+        queries = jp.QuerySet({'a': '$.payload.items[*].a'})
+        self.assertEqual({'a': [1, 2]}, pickle.loads(pickle.dumps(queries)).evaluate(self.DATA))
+
+    def test_evaluates_many_documents(self):
+        queries = jp.QuerySet({'a': '$.a', 'b': '$.b'})
+        result = list(jp.evaluate_many(queries, ['{"a": 1}', '{"b": 2}'], workers=1))
+        self.assertEqual([(0, {'a': [1], 'b': []}), (1, {'a': [], 'b': [2]})], result)
+
+
+class TestDocumentIndex(unittest.TestCase):
+
+    DATA = {"store": {"book": [{"title": "a", "price": 8}, {"title": "b", "tags": ["x", "y"]}],
+                      "bicycle": {"price": 20, "title": None}},
+            "title": "c", "misc": [[1, {"title": "d"}], 2]}
+
+    def test_results_match_search(self):
+        index = jp.DocumentIndex(self.DATA)
+        for expr in ['$..title', '$..*', '$.store..price', '$..book..*', '$..title..*', 
+                     '$.*..title', '$..book[*]..title', '$..missing', '$.title..*']:
+            with self.subTest(expr=expr):
+                query = jp.compile(expr)
+                self.assertEqual(query.find(self.DATA), query.find(self.DATA, index=index))
+
+    def test_results_follow_path_taken_to_node(self):
+        data = [1, 2, [0, {"b": 3}]]
+        index = jp.DocumentIndex(data)
+        for expr in ['$[-1]..b', '$[-1:]..*', '$[1:][-1]..b', '$[::-1]..b', '$[(2)][-1]..*']:
+            with self.subTest(expr=expr):
+                query = jp.compile(expr)
+                self.assertEqual(query.find(data), query.find(data, index=index))
+        self.assertEqual(['$[-1][1]["b"]'], jp.jsonpath(data, '$[-1]..b', jp.RESULT_TYPE_PATH, 
+                                                       index=index))
+
+    def test_answers_from_index_without_searching(self):
+        index = jp.DocumentIndex(self.DATA)
+        with unittest.mock.patch.object(jp.PRecursive, 'search') as search:
+            result = jp.jsonpath(self.DATA, '$..title', index=index)
+        search.assert_not_called()
+        self.assertEqual(['c', 'd', None, 'a', 'b'], result)
+
+    def test_records_names_in_order(self):
+        index = jp.DocumentIndex(self.DATA)
+        self.assertEqual(['$["title"]', '$["misc"][0][1]["title"]', '$["store"]["bicycle"]["title"]',
+                          '$["store"]["book"][0]["title"]', '$["store"]["book"][1]["title"]'],
+                         [index.nodes[p].path + '["title"]' for p in index.names["title"]])
+        self.assertEqual(dict, index.kinds[0])
+
+    def test_searches_shared_containers(self):
+        shared = {"x": 1}
+        data = {"a": [shared, shared], "b": shared}
+        index = jp.DocumentIndex(data)
+        for expr in ['$..x', '$.a[0]..*', '$.b..x']:
+            with self.subTest(expr=expr):
+                query = jp.compile(expr)
+                self.assertEqual(query.find(data), query.find(data, index=index))
+
+    def test_ignores_index_of_other_data(self):
+        index = jp.DocumentIndex({"title": "z"})
+        self.assertEqual(['c', 'd', None, 'a', 'b'], 
+                         jp.jsonpath(self.DATA, '$..title', index=index))
+
+    def test_searches_multiple_targets(self):
+        index = jp.DocumentIndex(self.DATA)
+        query = jp.compile('$..title,price')
+        self.assertEqual(query.find(self.DATA), query.find(self.DATA, index=index))
+
+    def test_answers_safe_dialect_wildcard(self):
+        index = jp.DocumentIndex(self.DATA)
+        query = jp.compile('$.store..[*]', jp.DIALECT_SAFE)
+        with unittest.mock.patch.object(jp.PRecursive, 'search', side_effect=AssertionError):
+            result = query.find(self.DATA, index=index)
+        self.assertEqual(query.find(self.DATA), result)
+
+    def test_query_set_uses_index(self):
+        index = jp.DocumentIndex(self.DATA)
+        queries = jp.QuerySet({'titles': '$..title', 'prices': '$.store..price'})
+        with unittest.mock.patch.object(jp.PRecursive, 'search') as search:
+            result = queries.evaluate(self.DATA, index=index)
+        search.assert_not_called()
+        self.assertEqual({'titles': ['c', 'd', None, 'a', 'b'], 'prices': [20, 8]}, result)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestNumpyEngine(unittest.TestCase):
+
+    VALUES = [1, 2.5, -3, 100, 150, 0, True, False, None, 'a', 'abc', '', [1], {'x': 1}, 
+              float('nan'), 2**60, 'z']
+
+    def records(self):
+        records = []
+        for i in range(400):
+            record = {}
+            for j,field in enumerate(['price', 'qty', 'name']):
+                if (i + j) % 7 != 0:
+                    record[field] = self.VALUES[(i * (j + 3) + j) % len(self.VALUES)]
+            records.append(record)
+        return {"trades": records + [1, 'x', None, [1, 2]]}
+
+    def assert_same_as_python(self, script):
+        data = self.records()
+        query = jp.compile('$.trades[?({})]'.format(script))
+        pydiag, npdiag = jp.Diagnostics(), jp.Diagnostics()
+        expected = query.paths(data, diagnostics=pydiag)
+        result = query.paths(data, diagnostics=npdiag, engine=jp.ENGINE_NUMPY)
+        self.assertEqual(expected, result)
+        self.assertEqual(pydiag.as_dict(), npdiag.as_dict())
+
+    def test_matches_comparisons_with_constants(self):
+        for script in ['@["price"] > 100', '@["price"] == True', '-3 == @["price"]', 
+                       '@["name"] >= "ab"', '@["price"] != "a"', '@["name"] < 5']:
+            with self.subTest(script=script):
+                self.assert_same_as_python(script)
+
+    def test_matches_comparisons_between_fields(self):
+        for script in ['@["price"] != @["qty"]', '@["price"] < @["qty"]']:
+            with self.subTest(script=script):
+                self.assert_same_as_python(script)
+
+    def test_matches_boolean_operators(self):
+        for script in ['@["price"] > 100 and @["qty"] < 5', '@["price"] > 100 or @["qty"] < 5', 
+                       'not @["price"] == 1', '1 < @["price"] <= 150', 
+                       '@["name"] == "a" or not @["price"] > 2 and @["qty"] != 0']:
+            with self.subTest(script=script):
+                self.assert_same_as_python(script)
+
+    def test_matches_scripts_which_cant_be_vectorised(self):
+        for script in ['@["price"] in [1, 2]', '@["price"]', '@["price"] > $["trades"][0]["qty"]']:
+            with self.subTest(script=script):
+                self.assert_same_as_python(script)
+
+    def test_matches_dictionary_children(self):
+        data = {'m': {'k{}'.format(i): {'a': i % 5} for i in range(50)}}
+        query = jp.compile('$.m[?(@["a"] > 2)]')
+        self.assertEqual(query.paths(data), query.paths(data, engine=jp.ENGINE_NUMPY))
+
+    def test_does_not_evaluate_script_per_node(self):
+        data = [{'a': i, 'b': str(i)} for i in range(100)]
+        query = jp.compile('$[?(@["a"] > 90 and @["b"] != "95")]')
+        with unittest.mock.patch.object(jp.PFilter, 'eval_code_for') as eval_code_for:
+            result = query.values(data, engine=jp.ENGINE_NUMPY)
+        eval_code_for.assert_not_called()
+        self.assertEqual([i for i in range(91, 100) if i != 95], [r['a'] for r in result])
+
+    def test_evaluates_undecided_nodes_individually(self):
+        data = [{'a': i} for i in range(20)] + [{'a': None}, {'b': 1}, {'a': 2**60}]
+        query = jp.compile('$[?(@["a"] > 15)]')
+        with unittest.mock.patch.object(jp.PFilter, 'eval_code_for', 
+                                        side_effect=jp.PFilter.eval_code_for, autospec=True) as eval_code_for:
+            result = query.paths(data, engine=jp.ENGINE_NUMPY)
+        self.assertEqual(3, eval_code_for.call_count)
+        self.assertEqual(['$[16]', '$[17]', '$[18]', '$[19]', '$[22]'], result)
+
+    def test_supports_jsonpath_function(self):
+        data = [{'a': i} for i in range(20)]
+        self.assertEqual([{'a': 19}], jp.jsonpath(data, '$[?(@["a"] > 18)]', engine=jp.ENGINE_NUMPY))
+
+    def test_rejects_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            jp.jsonpath([], '$[*]', engine='fortran')
+
+
+class TestSafeDialect(unittest.TestCase):
+
+    DATA = {"limit": 10, "books": [
+        {"title": "a", "price": 8.95, "tags": ["x", True]},
+        {"title": "b", "price": 12, "isbn": "0-1"},
+        {"title": "c", "price": "12", "isbn": None},
+        {"title": "d", "price": 22.5, "parts": [{"n": 1}, {"n": 2}]}]}
+
+    def titles(self, expr):
+        return jp.jsonpath(self.DATA, expr, always_return_list=True, dialect=jp.DIALECT_SAFE)
+
+    def test_existence_test(self):
+        self.assertEqual(['b', 'c'], self.titles('$.books[?@.isbn].title'))
+
+    def test_existence_test_for_non_singular_query(self):
+        self.assertEqual(['d'], self.titles('$.books[?@..n].title'))
+
+    def test_number_comparisons(self):
+        self.assertEqual(['a', 'b'], self.titles('$.books[?@.price <= 12].title'))
+        self.assertEqual(['b', 'd'], self.titles('$.books[?@.price > 10].title'))
+        self.assertEqual(['b'], self.titles('$.books[?@["price"] == 12.0].title'))
+
+    def test_string_comparisons(self):
+        self.assertEqual(['c'], self.titles('$.books[?@.price == "12"].title'))
+        self.assertEqual(['c', 'd'], self.titles("$.books[?@.title >= 'c'].title"))
+
+    def test_values_of_different_types_are_not_equal_or_ordered(self):
+        self.assertEqual(['a', 'b', 'd'], self.titles('$.books[?@.price != "12"].title'))
+        self.assertEqual([], self.titles('$.books[?@.tags[1] == 1].title'))
+        self.assertEqual(['a'], self.titles('$.books[?@.tags[1] == true].title'))
+        self.assertEqual(['c'], self.titles('$.books[?@.isbn == null].title'))
+        self.assertEqual([], self.titles('$.books[?@.title < 5].title'))
+
+    def test_missing_values_are_only_equal_to_missing_values(self):
+        self.assertEqual(['b', 'c', 'd'], self.titles('$.books[?@.tags == @.nope].title'))
+        self.assertEqual([], self.titles('$.books[?@.nope < 1].title'))
+
+    def test_comparison_with_root(self):
+        self.assertEqual(['b', 'd'], self.titles('$.books[?@.price > $.limit].title'))
+
+    def test_logical_operators(self):
+        self.assertEqual(['b'], self.titles('$.books[?@.price > 10 && !(@.price > 20)].title'))
+        self.assertEqual(['a', 'd'], self.titles('$.books[?@.tags || @.parts].title'))
+        self.assertEqual(['a', 'c', 'd'], self.titles('$.books[?!@.isbn || @.price == "12"].title'))
+
+    def test_parenthesised_filter(self):
+        self.assertEqual(['a'], self.titles('$.books[?(@.price < 10)].title'))
+
+    def test_membership(self):
+        self.assertEqual(['a', 'd'], self.titles('$.books[?@.title in ["a", "d"]].title'))
+        self.assertEqual(['a'], self.titles('$.books[?"x" in @.tags].title'))
+
+    def test_nested_filter(self):
+        self.assertEqual(['d'], self.titles('$.books[?@.parts[?@.n > 1]].title'))
+
+    def test_filter_in_target_list(self):
+        self.assertEqual(['d', 'a'], self.titles('$.books[?@.price > 20, 0].title'))
+
+    def test_recursive_filter(self):
+        self.assertEqual([True], self.titles('$..[?@ == true]'))
+
+    def test_rejects_non_singular_query_in_comparison(self):
+        with self.assertRaises(jp.JsonPathSyntaxError):
+            jp.parse('$[?@.* == 1]', jp.DIALECT_SAFE)
+
+    def test_rejects_python_scripts(self):
+        for expr in ['$[(1)]', '$[?(@["a"] + 1)]', '$[?(__import__("os"))]']:
+            with self.subTest(expr=expr):
+                with self.assertRaises(jp.JsonPathSyntaxError):
+                    jp.parse(expr, jp.DIALECT_SAFE)
+
+    def test_does_not_eval(self):
+        with unittest.mock.patch('builtins.eval', side_effect=AssertionError) as eval:
+            jp.parse('$[?@.a == 1 && $.b]', jp.DIALECT_SAFE)
+        eval.assert_not_called()
+
+    def test_detects_references_to_root(self):
+        exprs = { '$[?@.a == "$"]': False, '$[?@.a in ["$"]]': False, '$[?@[?@ == 1]]': False,
+                  '$[?@.a == $.b]': True, '$[?!($.x) && @.y]': True, '$[?@.a in $.l]': True, 
+                  '$[?@.a[?$.x]]': True, '$[?$]': True }
+        for expr, uses_root in exprs.items():
+            for parser in (jp.PARSER_NATIVE, jp.PARSER_PYPARSING):
+                with self.subTest(expr=expr, parser=parser):
+                    if parser == jp.PARSER_PYPARSING and pyparsing is None:
+                        continue
+                    self.assertEqual(uses_root, jp.parse(expr, jp.DIALECT_SAFE, parser)[-1]
+                                                .targets[0].uses_root)
+        query = jp.compile('$[?@.a == "$"]', jp.DIALECT_SAFE)
+        self.assertEqual([{"a": "$"}], [value for value, path in 
+                                        query.stream(io.StringIO('[{"a": "$"}, {"a": 1}]'))])
+
+    def test_compiles_dialects_separately(self):
+        safe = jp.compile('$[?(@)]', jp.DIALECT_SAFE)
+        python = jp.compile('$[?(@)]')
+        self.assertEqual(jp.DIALECT_SAFE, safe.dialect)
+        self.assertEqual(jp.DIALECT_PYTHON, python.dialect)
+        self.assertEqual([1], python.values([0, 1, [], {}]))
+        self.assertEqual([0, 1, [], {}], safe.values([0, 1, [], {}]))
+
+    def test_pickles_dialect(self):
+        query = jp.compile('$[?@ > 1]', jp.DIALECT_SAFE)
+        self.assertIs(query, pickle.loads(pickle.dumps(query)))
+
+    def test_rejects_unknown_dialect(self):
+        with self.assertRaises(ValueError):
+            jp.parse('$', 'perl')